@@ -0,0 +1,155 @@
+# ~/raspiframe/app/bursts.py
+"""
+連写・ほぼ同じ写真をまとめる（知覚ハッシュ dHash）。
+
+- dhash(path) : 画像を 9x8 のグレースケールに縮め、横に隣り合う画素の大小を並べた 64bit。
+  JPEG に埋め込まれた EXIF サムネイルがあればそれから、無ければ draft() で 1/8 デコードした
+  元画像から作る（どちらも回転前なので、同じ写真なら同じ値になる）。
+  インデックスの Entry.dhash に保存するので、1ファイルにつき1回だけ
+- representatives(ts, hashes, sizes) : 撮影時刻順の写真のうち、window_sec 以内でハミング距離が
+  max_distance 以下のものをつないでクラスタにし、各写真の代表の添字を返す。
+  クラスタ全体（最初の1枚 → 最後の1枚）も window_sec に収まる時だけつなぐ（隣どうしが近いだけで
+  長い撮影が何分もの1つの「連写」に連なってしまわないように）。時刻の近いペアから順につなぐ。
+  numpy（requirements.txt）で「k 枚先との距離」を全件まとめて求める（k は窓に入る最大枚数まで回す）。
+  numpy が入っていない環境では同じことを純 Python で
+- 代表はクラスタの中でファイルが一番大きいもの（JPEG はブレ・ピンぼけが少ないほど大きくなりやすい）
+"""
+import io
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app import derivatives
+
+try:
+    from PIL import Image
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+try:
+    import numpy as np
+    _HAS_NUMPY = True
+except Exception:
+    _HAS_NUMPY = False
+
+
+HASH_W, HASH_H = 9, 8         # 9x8 に縮めて横の差分 → 8x8 = 64bit
+WINDOW_SEC = 60.0             # これより離れて撮った写真はまとめない
+MAX_DISTANCE = 8              # 64bit のうち、これだけしか違わなければほぼ同じ
+MAX_SPAN = 256                # 窓の中で比べる相手は先の何枚まで（連写が何百枚続いても止まらないように）
+UNHASHABLE = -1               # 読めなかった印（作り直さない。まとめる対象にしない）
+
+
+def dhash(path: str) -> Optional[int]:
+    """path の dHash（64bit の整数）。作れなければ None"""
+    if not _HAS_PIL:
+        return None
+    try:
+        got = derivatives.exif_thumbnail(path) if path.lower().endswith((".jpg", ".jpeg")) else None
+        src: Any = io.BytesIO(got[0]) if got else path
+        with Image.open(src) as im:
+            im.draft("L", (HASH_W * 8, HASH_H * 8))
+            g = im.convert("L").resize((HASH_W, HASH_H), Image.BILINEAR)
+            px = list(g.getdata())
+    except Exception as e:
+        print(f"[BURST] hash failed {path}: {e}")
+        return None
+    h = 0
+    for y in range(HASH_H):
+        row = px[y * HASH_W:(y + 1) * HASH_W]
+        for x in range(HASH_W - 1):
+            h = (h << 1) | (row[x] > row[x + 1])
+    return h
+
+
+# ==== 近いものをつなぐ =========================================================
+def _valid(h: Optional[int]) -> bool:
+    return h is not None and h >= 0
+
+
+if _HAS_NUMPY:
+    _POP8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x: "np.ndarray") -> "np.ndarray":
+        if hasattr(np, "bitwise_count"):          # numpy 2.0 以降
+            return np.bitwise_count(x)
+        return _POP8[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _links_numpy(ts: Sequence[float], hashes: Sequence[Optional[int]],
+                 window: float, max_distance: int) -> List[Tuple[int, int]]:
+    n = len(ts)
+    t = np.asarray(ts, dtype=np.float64)
+    ok = np.fromiter((_valid(h) for h in hashes), dtype=bool, count=n)
+    h = np.fromiter((h if _valid(h) else 0 for h in hashes), dtype=np.uint64, count=n)
+    # 窓に入る一番遠い相手が何枚先か（ts は昇順）
+    far = np.searchsorted(t, t + window, side="right") - np.arange(n) - 1
+    kmax = min(int(far.max()), MAX_SPAN)
+    links: List[Tuple[int, int]] = []
+    for k in range(1, kmax + 1):
+        a, b = slice(0, n - k), slice(k, n)
+        m = ok[a] & ok[b] & (t[b] - t[a] <= window)
+        if not m.any():
+            continue
+        m &= _popcount(h[a] ^ h[b]) <= max_distance
+        i = np.nonzero(m)[0]
+        links.extend(zip(i.tolist(), (i + k).tolist()))
+    return links
+
+
+def _links_python(ts: Sequence[float], hashes: Sequence[Optional[int]],
+                  window: float, max_distance: int) -> List[Tuple[int, int]]:
+    n = len(ts)
+    links: List[Tuple[int, int]] = []
+    for i in range(n):
+        hi = hashes[i]
+        if not _valid(hi):
+            continue
+        for j in range(i + 1, min(n, i + 1 + MAX_SPAN)):
+            if ts[j] - ts[i] > window:
+                break
+            hj = hashes[j]
+            if _valid(hj) and bin(hi ^ hj).count("1") <= max_distance:
+                links.append((i, j))
+    return links
+
+
+def representatives(ts: Sequence[float], hashes: Sequence[Optional[int]], sizes: Sequence[int],
+                    window_sec: float = WINDOW_SEC, max_distance: int = MAX_DISTANCE) -> List[int]:
+    """ts 昇順の写真ごとに、属するクラスタの代表の添字（まとめる相手が無ければ自分）"""
+    n = len(ts)
+    if n < 2:
+        return list(range(n))
+    find_links = _links_numpy if _HAS_NUMPY else _links_python
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    lo, hi = list(ts), list(ts)       # 根ごとのクラスタの最初・最後の撮影時刻
+    links = find_links(ts, hashes, window_sec, max_distance)
+    links.sort(key=lambda l: (ts[l[1]] - ts[l[0]], l[0]))
+    for i, j in links:
+        ri, rj = find(i), find(j)
+        if ri == rj:
+            continue
+        a, b = min(lo[ri], lo[rj]), max(hi[ri], hi[rj])
+        if b - a > window_sec:
+            continue
+        parent[rj] = ri
+        lo[ri], hi[ri] = a, b
+
+    best: Dict[int, int] = {}
+    for i in range(n):
+        r = find(i)
+        b = best.get(r)
+        if b is None or sizes[i] > sizes[b]:
+            best[r] = i
+    return [best[find(i)] for i in range(n)]
+
+
+def collapse(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """プレイリストの各クラスタを代表1枚にする（burst はクラスタの代表の id。単独の写真には無い）"""
+    return [it for it in items if it.get("burst") in (None, it["id"])]
@@ -0,0 +1,480 @@
+# ~/raspiframe/app/derivatives.py
+"""
+表示用の縮小画像（派生画像）を作ってキャッシュする。
+
+- 1024x600 のパネルに 24MP のオリジナルを毎回送るのは無駄なので、
+  表示サイズに縮小した JPEG を data/cache/display/ に置く
+- JPEG は draft() で DCT スケーリングを使い、フルデコードを避ける
+- EXIF Orientation はここで適用する（派生画像は常に正立）
+- サムネイル（thumb）は JPEG に埋め込まれた EXIF サムネイル（IFD1）を
+  そのまま使う。無ければ draft() で縮小する
+- フォルダのプレビュー用に、複数のサムネイルを1枚のスプライトシートにまとめる
+- data/cache は容量上限つきの LRU（config.json の derivative_cache_mb。既定 CACHE_MAX_MB）。
+  使った派生画像は mtime を触って新しくし、作った量が上限の数 % に達したら古い順に消す
+- photoprep.py がデスクトップで作っておいた派生画像（<写真ツリーの根>/.superphotoframe/<種類>/<相対パス>.jpg）
+  があれば、作らずにそれを返す。元ファイルと mtime が同じもの（作った時に揃えてある）だけを使う
+"""
+import io
+import json
+import math
+import os
+import hashlib
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.photo_index import PACK_DIR
+
+try:
+    from PIL import Image, ImageOps
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+
+# 派生画像の種類 -> 収める箱（長辺・短辺）
+SIZES: Dict[str, Tuple[int, int]] = {
+    "display": (1280, 800),
+    "thumb": (160, 160),
+    "micro": (320, 320),      # ノブでスクラブ中の仮表示
+}
+JPEG_QUALITY = 85
+SHEET_COLS = 6                # スプライトシートの列数
+SHEET_QUALITY = 80
+SHEET_DIR = "sheets"
+
+CACHE_MAX_MB = 2048           # data/cache の上限（derivative_cache_mb が無い時）
+PRUNE_TO = 0.9                # 上限を超えたらここまで減らす
+PRUNE_SLACK = 0.05            # 前回の掃除から上限のこれだけ作ったら、もう一度数える
+TOUCH_SEC = 3600.0            # 使った派生画像の mtime はこれより古い時だけ触る（LRU の順番用）
+
+CACHE_DIR: Optional[str] = None
+
+# 同じ派生画像を複数リクエストが同時に作らないように
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+_budget_mb: Callable[[], Any] = lambda: None
+_added = 0                    # 前回の掃除から作った派生画像のバイト数
+_prune_lock = threading.Lock()
+
+
+def init(cache_dir: str, budget_mb: Optional[Callable[[], Any]] = None) -> None:
+    """budget_mb() は data/cache の上限（MB）を返す（設定が変わったら次の掃除から効く）"""
+    global CACHE_DIR, _budget_mb
+    CACHE_DIR = cache_dir
+    if budget_mb is not None:
+        _budget_mb = budget_mb
+    for kind in list(SIZES) + [SHEET_DIR]:
+        os.makedirs(os.path.join(cache_dir, kind), exist_ok=True)
+
+
+def max_bytes() -> int:
+    try:
+        mb = float(_budget_mb() or CACHE_MAX_MB)
+    except (TypeError, ValueError):
+        mb = CACHE_MAX_MB
+    return int(max(16.0, mb) * 1024 * 1024)
+
+
+def _hit(path: str) -> bool:
+    """キャッシュにあるか。あれば mtime を新しくする（LRU で最近使ったものとして残す）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if time.time() - st.st_mtime > TOUCH_SEC:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return True
+
+
+def _note_added(*paths: str) -> None:
+    """作った分を数え、上限の PRUNE_SLACK を超えたら裏で掃除する"""
+    global _added
+    n = 0
+    for p in paths:
+        try:
+            n += os.path.getsize(p)
+        except OSError:
+            pass
+    with _locks_guard:
+        _added += n
+        due = _added > max_bytes() * PRUNE_SLACK
+    if due and not _prune_lock.locked():
+        threading.Thread(target=prune, name="derivative-prune", daemon=True).start()
+
+
+def prune() -> Optional[Dict[str, int]]:
+    """
+    data/cache が上限を超えていたら、mtime の古い順（最後に使ってから長いもの）に PRUNE_TO まで消す。
+    他のスレッドが掃除中なら何もしない。戻り値は {"files", "bytes", "removed", "removed_bytes"}
+    """
+    global _added
+    if CACHE_DIR is None or not _prune_lock.acquire(blocking=False):
+        return None
+    try:
+        with _locks_guard:
+            _added = 0
+        files = []
+        total = 0
+        for kind in list(SIZES) + [SHEET_DIR]:
+            for d, _, names in os.walk(os.path.join(CACHE_DIR, kind)):
+                for name in names:
+                    if name.endswith(".tmp"):
+                        continue
+                    p = os.path.join(d, name)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, p))
+                    total += st.st_size
+        limit = max_bytes()
+        removed = removed_bytes = 0
+        if total > limit:
+            files.sort()
+            goal = total - int(limit * PRUNE_TO)
+            for _, size, p in files:
+                if removed_bytes >= goal:
+                    break
+                try:
+                    os.unlink(p)
+                except OSError:
+                    continue
+                removed += 1
+                removed_bytes += size
+            print(f"[DERIV] cache pruned: {removed} files ({removed_bytes / 1048576:.1f} MB), "
+                  f"{(total - removed_bytes) / 1048576:.1f} / {limit / 1048576:.0f} MB left")
+        return {"files": len(files) - removed, "bytes": total - removed_bytes,
+                "removed": removed, "removed_bytes": removed_bytes}
+    finally:
+        _prune_lock.release()
+
+
+def cache_path(src: str, size: int, mtime_ns: int, kind: str) -> str:
+    """元ファイルのパス + size + mtime_ns から派生画像のファイル名を決める"""
+    key = f"{src}\x00{size}\x00{mtime_ns}".encode("utf-8", "surrogateescape")
+    name = hashlib.sha1(key).hexdigest() + ".jpg"
+    return os.path.join(CACHE_DIR or "", kind, name[:2], name)
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _locks_guard:
+        lk = _locks.get(path)
+        if lk is None:
+            lk = _locks[path] = threading.Lock()
+        return lk
+
+
+def render(src: str, dst: str, box: Tuple[int, int]) -> bool:
+    """src を box に収まるよう縮小して dst に JPEG 保存"""
+    try:
+        with Image.open(src) as im:
+            # JPEG は 1/2, 1/4, 1/8 のスケールでデコードできる
+            im.draft("RGB", (box[0] * 2, box[1] * 2))
+            im = ImageOps.exif_transpose(im)
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            im.thumbnail(box, Image.BICUBIC)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = dst + ".tmp"
+            im.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=False, progressive=True)
+        os.replace(tmp, dst)
+        return True
+    except Exception as e:
+        print(f"[DERIV] render failed {src}: {e}")
+        return False
+
+
+# ==== EXIF 埋め込みサムネイル ==================================================
+# Orientation -> 正立させる変換
+_TRANSPOSE = {
+    2: "FLIP_LEFT_RIGHT", 3: "ROTATE_180", 4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE", 6: "ROTATE_270", 7: "TRANSVERSE", 8: "ROTATE_90",
+}
+
+
+def _parse_exif_thumbnail(tiff: bytes) -> Optional[Tuple[bytes, int]]:
+    """APP1 の TIFF 部から (IFD1 の JPEG, IFD0 の Orientation) を取り出す"""
+    try:
+        e = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+        if e is None:
+            return None
+
+        def ifd(off: int) -> Tuple[Dict[int, Tuple[int, bytes]], int]:
+            n = struct.unpack(e + "H", tiff[off:off + 2])[0]
+            tags = {}
+            for i in range(n):
+                p = off + 2 + 12 * i
+                tag, typ = struct.unpack(e + "HH", tiff[p:p + 4])
+                tags[tag] = (typ, tiff[p + 8:p + 12])
+            nxt = struct.unpack(e + "I", tiff[off + 2 + 12 * n:off + 6 + 12 * n])[0]
+            return tags, nxt
+
+        def num(v: Tuple[int, bytes]) -> int:
+            typ, raw = v
+            return struct.unpack(e + "H", raw[:2])[0] if typ == 3 else struct.unpack(e + "I", raw)[0]
+
+        ifd0, ifd1_off = ifd(struct.unpack(e + "I", tiff[4:8])[0])
+        orientation = num(ifd0[0x0112]) if 0x0112 in ifd0 else 1
+        if not ifd1_off:
+            return None
+        ifd1, _ = ifd(ifd1_off)
+        if 0x0201 not in ifd1 or 0x0202 not in ifd1:
+            return None
+        start, length = num(ifd1[0x0201]), num(ifd1[0x0202])
+        data = tiff[start:start + length]
+        if len(data) != length or not data.startswith(b"\xff\xd8"):
+            return None
+        return data, orientation
+    except (struct.error, KeyError, IndexError):
+        return None
+
+
+def exif_thumbnail(src: str) -> Optional[Tuple[bytes, int]]:
+    """
+    JPEG の APP1(Exif) だけを読んで埋め込みサムネイルを返す（本体はデコードしない）。
+    戻り値: (サムネイルの JPEG バイト列, Orientation) / 無ければ None
+    """
+    try:
+        with open(src, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            for _ in range(32):
+                hdr = f.read(4)
+                if len(hdr) < 4 or hdr[0] != 0xFF:
+                    return None
+                marker = hdr[1]
+                seglen = struct.unpack(">H", hdr[2:])[0]
+                if marker in (0xDA, 0xD9):          # SOS / EOI まで来たら無い
+                    return None
+                if marker == 0xE1:
+                    seg = f.read(seglen - 2)
+                    if seg[:6] == b"Exif\x00\x00":
+                        return _parse_exif_thumbnail(seg[6:])
+                else:
+                    f.seek(seglen - 2, 1)
+    except OSError:
+        return None
+    return None
+
+
+def render_thumb(src: str, dst: str, box: Tuple[int, int]) -> bool:
+    """埋め込みサムネイルがあればそれを縮小して保存、無ければ通常の縮小"""
+    got = exif_thumbnail(src) if src.lower().endswith((".jpg", ".jpeg")) else None
+    if got:
+        data, orientation = got
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                im = im.convert("RGB")
+                op = _TRANSPOSE.get(orientation)
+                if op:
+                    im = im.transpose(getattr(getattr(Image, "Transpose", Image), op))
+                im.thumbnail(box, Image.BICUBIC)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                tmp = dst + ".tmp"
+                im.save(tmp, "JPEG", quality=JPEG_QUALITY)
+            os.replace(tmp, dst)
+            return True
+        except Exception as e:
+            print(f"[DERIV] exif thumbnail unusable {src}: {e}")
+    return render(src, dst, box)
+
+
+# 種類ごとの作り方（無ければ render）
+_RENDERERS = {
+    "thumb": render_thumb,
+    "micro": render_thumb,
+}
+
+
+def render_kind(src: str, dst: str, kind: str) -> bool:
+    """kind の作り方・大きさで src から dst を作る"""
+    return _RENDERERS.get(kind, render)(src, dst, SIZES[kind])
+
+
+# ==== 事前に作られた派生画像（photoprep.py） ==================================
+PREBUILT_TTL_SEC = 60.0       # ディレクトリ -> パックの根 の覚えておく時間
+PREBUILT_MAX_DIRS = 20000
+
+# ディレクトリ -> (調べた時刻, 根 or "")
+_prebuilt_roots: Dict[str, Tuple[float, str]] = {}
+
+
+def prebuilt_path(root: str, src: str, kind: str) -> str:
+    """root の .superphotoframe に置く src の派生画像のパス（元の拡張子も残して重ならないように）"""
+    rel = os.path.relpath(src, root)
+    return os.path.join(root, PACK_DIR, kind, rel + ".jpg")
+
+
+def make_prebuilt(src: str, st: os.stat_result, root: str, kind: str) -> bool:
+    """src の派生画像を root の .superphotoframe に作り、mtime を元ファイルに揃える"""
+    dst = prebuilt_path(root, src, kind)
+    if not render_kind(src, dst, kind):
+        return False
+    try:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    except OSError as e:
+        print(f"[DERIV] cannot stamp {dst}: {e}")
+        return False
+    return True
+
+
+def prebuilt_fresh(dst: str, mtime_ns: int) -> bool:
+    try:
+        return os.stat(dst).st_mtime_ns == mtime_ns
+    except OSError:
+        return False
+
+
+def _prebuilt_root(d: str) -> str:
+    """d かその上に .superphotoframe のあるディレクトリ（無ければ ""）"""
+    now = time.monotonic()
+    hit = _prebuilt_roots.get(d)
+    if hit is not None and now - hit[0] < PREBUILT_TTL_SEC:
+        return hit[1]
+    root, cur = "", d
+    while True:
+        if os.path.isdir(os.path.join(cur, PACK_DIR)):
+            root = cur
+            break
+        parent = os.path.dirname(cur)
+        if parent == cur:
+            break
+        cur = parent
+    if len(_prebuilt_roots) >= PREBUILT_MAX_DIRS:
+        _prebuilt_roots.clear()
+    _prebuilt_roots[d] = (now, root)
+    return root
+
+
+def prebuilt(src: str, mtime_ns: int, kind: str) -> Optional[str]:
+    """photoprep.py が作った src の派生画像（元ファイルと mtime が揃っているものだけ）"""
+    root = _prebuilt_root(os.path.dirname(src))
+    if not root:
+        return None
+    dst = prebuilt_path(root, src, kind)
+    return dst if prebuilt_fresh(dst, mtime_ns) else None
+
+
+def cached(src: str, size: int, mtime_ns: int, kind: str = "display") -> Optional[str]:
+    """元ファイルに触らずに（インデックスの size / mtime_ns で）既存の派生画像を探す"""
+    if CACHE_DIR is None or kind not in SIZES:
+        return None
+    dst = cache_path(src, size, mtime_ns, kind)
+    return dst if _hit(dst) else None
+
+
+def get(src: str, kind: str = "display",
+        pace: Optional[Callable[[], None]] = None) -> Optional[str]:
+    """
+    派生画像のパスを返す（無ければ作る）。作れなかった時は None
+    → 呼び出し側はオリジナルを返せばよい。
+    pace を渡すと、作る前に呼ぶ（裏方の先読みを温度などで待たせる用。リクエストからは渡さない）。
+    """
+    if kind not in SIZES:
+        return None
+    try:
+        st = os.stat(src)
+    except Exception:
+        return None
+    ready = prebuilt(src, st.st_mtime_ns, kind)
+    if ready:
+        return ready
+    if not _HAS_PIL or CACHE_DIR is None:
+        return None
+    dst = cache_path(src, st.st_size, st.st_mtime_ns, kind)
+    if _hit(dst):
+        return dst
+    if pace is not None:
+        pace()
+    with _lock_for(dst):
+        try:
+            if os.path.exists(dst):
+                return dst
+            if not render_kind(src, dst, kind):
+                return None
+        finally:
+            # 作れなかった時も外す（待っていたリクエストは持っているロックで続ける）
+            with _locks_guard:
+                _locks.pop(dst, None)
+    _note_added(dst)
+    return dst
+
+
+# ==== スプライトシート ========================================================
+def sheet(srcs: List[str], kind: str = "thumb") -> Optional[Dict[str, Any]]:
+    """
+    srcs のサムネイルを1枚の JPEG に並べ、座標マップを返す。
+    各セルはサムネイルを正方形に中央トリミングしたもの（プレビューの object-fit:cover 相当）。
+    シート名は元ファイルの (path, size, mtime_ns) の並びから決まるので、内容が同じなら再利用。
+    戻り値: {"key", "cell": [w, h], "cols", "rows", "width", "height",
+             "items": [{"path", "x", "y", "w", "h"}, ...]}（作れない画像は w=h=0）
+    """
+    if not _HAS_PIL or CACHE_DIR is None or kind not in SIZES:
+        return None
+    stats = []
+    for src in srcs:
+        try:
+            st = os.stat(src)
+            stats.append((src, st.st_size, st.st_mtime_ns))
+        except OSError:
+            stats.append((src, 0, 0))
+    cw = ch = min(SIZES[kind])
+    h = hashlib.sha1(f"{kind}\x00{cw}".encode())
+    for src, size, mtime_ns in stats:
+        h.update(f"\x00{src}\x00{size}\x00{mtime_ns}".encode("utf-8", "surrogateescape"))
+    key = h.hexdigest()
+    base = os.path.join(CACHE_DIR, SHEET_DIR, key[:2], key)
+    if _hit(base + ".jpg") and _hit(base + ".json"):
+        try:
+            with open(base + ".json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            pass
+
+    n = len(stats)
+    cols = max(1, min(SHEET_COLS, n))
+    rows = max(1, math.ceil(n / cols))
+    canvas = Image.new("RGB", (cols * cw, rows * ch), (240, 240, 240))
+    items = []
+    for i, (src, size, _) in enumerate(stats):
+        x, y = (i % cols) * cw, (i // cols) * ch
+        thumb = get(src, kind) if size else None
+        if not thumb:
+            items.append({"path": src, "x": x, "y": y, "w": 0, "h": 0})
+            continue
+        try:
+            with Image.open(thumb) as im:
+                canvas.paste(ImageOps.fit(im.convert("RGB"), (cw, ch), Image.BICUBIC), (x, y))
+            items.append({"path": src, "x": x, "y": y, "w": cw, "h": ch})
+        except Exception as e:
+            print(f"[DERIV] sheet cell failed {src}: {e}")
+            items.append({"path": src, "x": x, "y": y, "w": 0, "h": 0})
+
+    meta = {"key": key, "cell": [cw, ch], "cols": cols, "rows": rows,
+            "width": cols * cw, "height": rows * ch, "items": items}
+    try:
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        canvas.save(base + ".jpg.tmp", "JPEG", quality=SHEET_QUALITY)
+        os.replace(base + ".jpg.tmp", base + ".jpg")
+        with open(base + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(base + ".json.tmp", base + ".json")
+    except Exception as e:
+        print(f"[DERIV] sheet save failed: {e}")
+        return None
+    _note_added(base + ".jpg", base + ".json")
+    return meta
+
+
+def sheet_path(key: str) -> Optional[str]:
+    """シートの JPEG（key は sheet() が返した16進）"""
+    if CACHE_DIR is None or len(key) != 40 or any(c not in "0123456789abcdef" for c in key):
+        return None
+    p = os.path.join(CACHE_DIR, SHEET_DIR, key[:2], key + ".jpg")
+    return p if _hit(p) else None
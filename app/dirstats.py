@@ -0,0 +1,322 @@
+# ~/raspiframe/app/dirstats.py
+"""
+フォルダごとの統計（画像枚数・合計バイト数・最新撮影日時）のキャッシュと、
+設定画面のフォルダブラウザ用のページング。
+
+- 統計はサブフォルダ込み（再帰）。ディレクトリ単位で「自分の直下の分」と
+  子フォルダ名を持ち、ディレクトリの mtime_ns が変わっていなければ再走査しない
+  （ファイルの追加・削除・リネームでディレクトリの mtime は変わる）
+- 再検証は裏スレッドで行い、API はキャッシュから即答する（stale-while-revalidate）
+- 疑似ファイルシステム（/proc, /sys, /dev など）は辿らない。どこを数えるかは呼び出し側が決める
+  （main.py は選択フォルダとマウント先の配下だけ）
+- 大きなフォルダの一覧はメモリ上の LRU に置き、ソート＋キーセット方式の
+  カーソルで切り出して返す
+"""
+import base64
+import bisect
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import mounts
+from app.photo_index import IMAGE_EXTS, PACK_DIR
+
+
+DIRSTATS_VERSION = 2          # 1 は /proc などまで数えていた（捨てて数え直す）
+PSEUDO_TTL_SEC = 60.0         # 疑似ファイルシステムのマウント表を読み直す間隔
+LISTING_CACHE_SIZE = 8        # メモリに置くディレクトリ一覧の数
+SAVE_INTERVAL_SEC = 30.0
+
+SORTS = ("name", "date", "size", "count")
+DEFAULT_LIMIT = 200
+MAX_LIMIT = 1000
+
+
+class Listing:
+    """1ディレクトリ分の一覧（その時点の mtime_ns 付き）"""
+    __slots__ = ("mtime_ns", "dirs", "images")
+
+    def __init__(self, mtime_ns: int) -> None:
+        self.mtime_ns = mtime_ns
+        self.dirs: List[Tuple[str, bool]] = []               # (name, is_symlink)
+        self.images: List[Tuple[str, int, int]] = []         # (name, size, mtime_ns)
+
+
+def scan_listing(path: str, mtime_ns: int) -> Listing:
+    lst = Listing(mtime_ns)
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if entry.name != PACK_DIR:
+                        lst.dirs.append((entry.name, entry.is_symlink()))
+                elif entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS):
+                    st = entry.stat()
+                    lst.images.append((entry.name, st.st_size, st.st_mtime_ns))
+            except OSError:
+                continue
+    return lst
+
+
+def _add(agg: List[Any], other: List[Any]) -> None:
+    agg[0] += other[0]
+    agg[1] += other[1]
+    if other[2] is not None and (agg[2] is None or other[2] > agg[2]):
+        agg[2] = other[2]
+
+
+class DirStats:
+    """
+    ディレクトリ統計のキャッシュ（data/dirstats.json に永続化）。
+    ts_of(path, size, mtime_ns) は画像の撮影日時（epoch秒）を返す関数。
+    インデックスに無ければ None を返してよい（その時はファイルの mtime を使う）。
+    is_healthy(path) が False のディレクトリ（固まった NAS など）には触らない。
+    pace() は裏スレッドの再検証1件ごとに呼ぶ（温度などで待たせる用。無くてもよい）。
+    """
+
+    def __init__(self, path: str,
+                 ts_of: Optional[Callable[[str, int, int], Optional[float]]] = None,
+                 is_healthy: Optional[Callable[[str], bool]] = None,
+                 pace: Optional[Callable[[], None]] = None) -> None:
+        self.path = path
+        self.ts_of = ts_of
+        self.is_healthy = is_healthy
+        self.pace = pace
+        # path -> {"mtime_ns", "own": [count, bytes, newest], "children": [name...],
+        #          "agg": [count, bytes, newest], "checked": epoch}
+        self._dirs: Dict[str, Dict[str, Any]] = {}
+        self._listings: "OrderedDict[str, Listing]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._queued: set = set()
+        self._worker: Optional[threading.Thread] = None
+        self._pseudo: List[str] = []
+        self._pseudo_at = 0.0
+
+    # ---- 永続化 ----
+    def load(self) -> int:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != DIRSTATS_VERSION:
+                return 0
+            with self._lock:
+                self._dirs = data.get("dirs") or {}
+            return len(self._dirs)
+        except Exception:
+            return 0
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            data = {"version": DIRSTATS_VERSION, "dirs": self._dirs}
+            tmp = f"{self.path}.{os.getpid()}.tmp"     # ワーカーごとに別の一時ファイル
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp, self.path)
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            except Exception as e:
+                print(f"[DIRSTATS] save failed: {e}")
+
+    # ---- 一覧（LRU） ----
+    def listing(self, path: str, st: Optional[os.stat_result] = None) -> Listing:
+        """ディレクトリの一覧。mtime_ns が変わっていなければメモリ上のものを返す"""
+        if st is None:
+            st = os.stat(path)
+        with self._lock:
+            lst = self._listings.get(path)
+            if lst is not None and lst.mtime_ns == st.st_mtime_ns:
+                self._listings.move_to_end(path)
+                return lst
+        lst = scan_listing(path, st.st_mtime_ns)
+        with self._lock:
+            self._listings[path] = lst
+            self._listings.move_to_end(path)
+            while len(self._listings) > LISTING_CACHE_SIZE:
+                self._listings.popitem(last=False)
+        return lst
+
+    # ---- 統計 ----
+    def _is_pseudo(self, path: str) -> bool:
+        now = time.monotonic()
+        if now - self._pseudo_at > PSEUDO_TTL_SEC:
+            self._pseudo = mounts.pseudo_mount_points()
+            self._pseudo_at = now
+        return any(path == mp or path.startswith(mp.rstrip(os.sep) + os.sep) for mp in self._pseudo)
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みの統計（無ければ None）。ディスクには触らない"""
+        with self._lock:
+            node = self._dirs.get(path.rstrip(os.sep) or os.sep)
+            if node is None:
+                return None
+            count, total, newest = node["agg"]
+            return {"image_count": count, "total_bytes": total,
+                    "newest": newest, "checked": node["checked"]}
+
+    def _own_stats(self, path: str, lst: Listing) -> List[Any]:
+        own: List[Any] = [0, 0, None]
+        for name, size, mtime_ns in lst.images:
+            ts = self.ts_of(os.path.join(path, name), size, mtime_ns) if self.ts_of else None
+            if ts is None:
+                ts = mtime_ns / 1e9
+            _add(own, [1, size, ts])
+        return own
+
+    def refresh(self, path: str) -> Optional[List[Any]]:
+        """
+        path 以下を再検証して集計を返す。mtime の変わっていないディレクトリは
+        直下の再走査をせず、子フォルダの stat だけで済ませる。
+        """
+        path = path.rstrip(os.sep) or os.sep
+        if self._is_pseudo(path):
+            return None
+        if self.is_healthy is not None and not self.is_healthy(path):
+            with self._lock:
+                node = self._dirs.get(path)
+                return list(node["agg"]) if node else None
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._drop(path)
+            return None
+
+        with self._lock:
+            node = self._dirs.get(path)
+        if node is None or node["mtime_ns"] != st.st_mtime_ns:
+            try:
+                lst = self.listing(path, st)
+            except OSError:
+                return list(node["agg"]) if node else None
+            own = self._own_stats(path, lst)
+            # シンボリックリンクは辿らない（ループ防止）
+            children = sorted(name for name, is_link in lst.dirs if not is_link)
+            if node is not None:
+                for gone in set(node["children"]) - set(children):
+                    self._drop(os.path.join(path, gone))
+        else:
+            own, children = list(node["own"]), list(node["children"])
+
+        agg = list(own)
+        for name in children:
+            child = self.refresh(os.path.join(path, name))
+            if child is not None:
+                _add(agg, child)
+
+        with self._lock:
+            old = self._dirs.get(path)
+            self._dirs[path] = {
+                "mtime_ns": st.st_mtime_ns, "own": own, "children": children,
+                "agg": agg, "checked": time.time(),
+            }
+            if old is None or old["agg"] != agg or old["mtime_ns"] != st.st_mtime_ns:
+                self._dirty = True
+        return agg
+
+    def _drop(self, path: str) -> None:
+        prefix = path + os.sep
+        with self._lock:
+            gone = [p for p in self._dirs if p == path or p.startswith(prefix)]
+            for p in gone:
+                del self._dirs[p]
+            if gone:
+                self._dirty = True
+
+    # ---- 裏での再検証 ----
+    def request(self, path: str) -> None:
+        """path の再検証を裏スレッドに頼む（同じパスは重複して積まない）"""
+        path = path.rstrip(os.sep) or os.sep
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="dirstats", daemon=True)
+                self._worker.start()
+        self._queue.put(path)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                path = self._queue.get(timeout=SAVE_INTERVAL_SEC)
+            except queue.Empty:
+                self.save()
+                continue
+            try:
+                if self.pace is not None:
+                    self.pace()
+                self.refresh(path)
+            except Exception as e:
+                print(f"[DIRSTATS] refresh failed {path}: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+            if time.monotonic() - self._saved_at > SAVE_INTERVAL_SEC:
+                self.save()
+
+
+# ==== ソートとカーソル =========================================================
+def _name_key(name: str, desc: bool) -> Tuple[Any, ...]:
+    if not desc:
+        return (name.casefold(), name)
+    # 文字列の降順を昇順比較で表すため、コードポイントを反転し末尾に番兵を置く
+    return tuple(-ord(c) for c in name.casefold()) + (1,) + tuple(-ord(c) for c in name) + (1,)
+
+
+def row_key(row: Dict[str, Any], sort: str, desc: bool) -> Tuple[Any, ...]:
+    """フォルダが先、画像が後。値が未計算のものは昇順・降順どちらでも末尾"""
+    key: Tuple[Any, ...] = (0 if row["kind"] == "dir" else 1,)
+    if sort != "name":
+        v = row.get(sort)
+        key += (1, 0) if v is None else (0, -v if desc else v)
+    return key + _name_key(row["name"], desc)
+
+
+def encode_cursor(key: Tuple[Any, ...]) -> str:
+    raw = json.dumps(list(key), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[Any, ...]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return tuple(json.loads(raw.decode("utf-8")))
+    except Exception:
+        return None
+
+
+def paginate(rows: List[Dict[str, Any]], sort: str = "name", cursor: Optional[str] = None,
+             limit: int = DEFAULT_LIMIT) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    sort は "name" / "date" / "size" / "count"（先頭に "-" で降順）。
+    カーソルは直前のページ末尾のソートキー（オフセットではないので、
+    ページをめくる間にフォルダが変わっても重複・取りこぼしが出にくい）。
+    """
+    desc = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field not in SORTS:
+        field = "name"
+    keyed = sorted(((row_key(r, field, desc), r) for r in rows), key=lambda kr: kr[0])
+    keys = [k for k, _ in keyed]
+    start = 0
+    if cursor:
+        ck = decode_cursor(cursor)
+        if ck is not None:
+            try:
+                start = bisect.bisect_right(keys, ck)
+            except TypeError:
+                # 別のソートで作られたカーソル → 先頭から
+                start = 0
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    page = keyed[start:start + limit]
+    next_cursor = encode_cursor(page[-1][0]) if page and start + limit < len(keyed) else None
+    return [r for _, r in page], next_cursor
@@ -0,0 +1,255 @@
+# ~/raspiframe/app/discovery.py
+"""
+SMB/DLNA サービスの常駐検出（mDNS / avahi）。
+
+- `avahi-browse -p -r -k _smb._tcp` を常駐させ、+ / = / - 行を逐次テーブルに反映
+- 各エントリは TTL 付き。ブラウザを定期的に張り直して last_seen を更新する
+- /api/dlna/discover はこのテーブルから即答する（5秒待たない）
+- パースは純粋関数なので、録ったログを流せばネットワーク無しで確認できる:
+    avahi-browse -p -r -t _smb._tcp > rec.txt
+    python3 -m app.discovery < rec.txt
+"""
+import re
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+SERVICE_TYPE = "_smb._tcp"
+ENTRY_TTL_SEC = 600        # この時間見えなければ消す
+REFRESH_SEC = 240          # ブラウザを張り直してキャッシュ済みの結果を出し直させる間隔
+SWEEP_TIMEOUT = 5          # 単発スイープ（-t）のタイムアウト
+
+_ESCAPE_RE = re.compile(r"\\(\d{3})")
+
+
+def _unescape(s: str) -> str:
+    """avahi-browse -p は区切り文字などを \\DDD（10進）でエスケープする"""
+    return _ESCAPE_RE.sub(lambda m: chr(int(m.group(1))), s)
+
+
+def parse_avahi_line(line: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    avahi-browse -p の1行をパース。
+    戻り値: (event, fields)  event は "+", "=", "-" のいずれか。対象外の行は None。
+      +;eth0;IPv4;MyNAS;Microsoft Windows Network;local
+      =;eth0;IPv4;MyNAS;Microsoft Windows Network;local;mynas.local;192.168.1.10;445;
+      -;eth0;IPv4;MyNAS;Microsoft Windows Network;local
+    """
+    line = line.rstrip("\r\n")
+    if not line or line[0] not in "+=-":
+        return None
+    parts = line.split(";")
+    if len(parts) < 6:
+        return None
+    fields: Dict[str, Any] = {
+        "interface": parts[1],
+        "protocol": parts[2],
+        "name": _unescape(parts[3]),
+        "type": parts[4],
+        "domain": parts[5],
+    }
+    if parts[0] == "=":
+        if len(parts) < 9 or not parts[7]:
+            return None
+        fields["host"] = parts[6]
+        fields["address"] = parts[7]
+        try:
+            fields["port"] = int(parts[8])
+        except ValueError:
+            fields["port"] = None
+    return parts[0], fields
+
+
+class ServiceTable:
+    """
+    検出結果のテーブル。キーは (name, address)。
+    apply() はイベント発生時に ("found"|"lost", service) を返す。
+    """
+
+    def __init__(self, ttl: float = ENTRY_TTL_SEC) -> None:
+        self.ttl = ttl
+        self._rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def apply(self, event: str, f: Dict[str, Any],
+              now: Optional[float] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+        now = time.time() if now is None else now
+        with self._lock:
+            if event == "=":
+                key = (f["name"], f["address"])
+                row = self._rows.get(key)
+                if row is None:
+                    row = self._rows[key] = {
+                        "name": f["name"],
+                        "address": f["address"],
+                        "host": f.get("host"),
+                        "port": f.get("port"),
+                        "protocol": f.get("protocol"),
+                        "first_seen": now,
+                    }
+                    row["last_seen"] = now
+                    return "found", self._public(row, now)
+                row["last_seen"] = now
+                return None
+            if event == "-":
+                # 削除通知はアドレスを持たないので名前で消す（同名・同プロトコル）
+                gone = [k for k, r in self._rows.items()
+                        if r["name"] == f["name"] and r.get("protocol") == f.get("protocol")]
+                rows = [self._rows.pop(k) for k in gone]
+                if rows:
+                    return "lost", self._public(rows[0], now)
+        return None
+
+    def expire(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """TTL 切れのエントリを捨てて返す"""
+        now = time.time() if now is None else now
+        with self._lock:
+            old = [k for k, r in self._rows.items() if now - r["last_seen"] > self.ttl]
+            return [self._public(self._rows.pop(k), now) for k in old]
+
+    def services(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = [self._public(r, now) for r in self._rows.values()
+                    if now - r["last_seen"] <= self.ttl]
+        rows.sort(key=lambda r: (r["name"].lower(), r["address"]))
+        return rows
+
+    def _public(self, row: Dict[str, Any], now: float) -> Dict[str, Any]:
+        out = dict(row)
+        out["ttl"] = max(0, int(self.ttl - (now - row["last_seen"])))
+        return out
+
+
+class DiscoveryService:
+    """
+    avahi-browse を常駐させてテーブルを保つバックグラウンドサービス。
+    on_event(kind, service) は検出スレッドから呼ばれる（kind: "found" / "lost"）。
+    """
+
+    def __init__(self, service_type: str = SERVICE_TYPE,
+                 on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> None:
+        self.service_type = service_type
+        self.table = ServiceTable()
+        self.on_event = on_event
+        self.available = True          # avahi-browse が無ければ False
+        self.updated_at: Optional[float] = None
+        self._proc: Optional[subprocess.Popen] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dlna-discovery", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._kill()
+
+    def services(self) -> List[Dict[str, Any]]:
+        return self.table.services()
+
+    def feed(self, lines: Iterable[str]) -> None:
+        """avahi-browse -p の行をテーブルに流し込む（テスト・録画再生用にも使える）"""
+        for line in lines:
+            parsed = parse_avahi_line(line)
+            if not parsed:
+                continue
+            ev = self.table.apply(*parsed)
+            self.updated_at = time.time()
+            if ev and self.on_event:
+                try:
+                    self.on_event(*ev)
+                except Exception as e:
+                    print(f"[DLNA] discovery event error: {e}")
+
+    def sweep(self, timeout: int = SWEEP_TIMEOUT) -> None:
+        """単発スイープ（-t）。常駐プロセスが使えない時や手動更新用"""
+        try:
+            result = subprocess.run(
+                ['avahi-browse', '-t', '-p', '-r', self.service_type],
+                capture_output=True, text=True, timeout=timeout
+            )
+            self.feed(result.stdout.splitlines())
+        except FileNotFoundError:
+            self.available = False
+        except subprocess.TimeoutExpired as e:
+            # タイムアウトまでに出た分だけでも取り込む
+            out = e.stdout or ""
+            if isinstance(out, bytes):
+                out = out.decode(errors="ignore")
+            self.feed(out.splitlines())
+        except Exception as e:
+            print(f"[DLNA] Discovery sweep error: {e}")
+
+    # ---- 常駐ループ ----
+    def _kill(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc and proc.poll() is None:
+            try:
+                proc.terminate()
+                proc.wait(timeout=2)
+            except Exception:
+                try:
+                    proc.kill()
+                except Exception:
+                    pass
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                # -k: 名前の変換をしない（ロケール非依存）、-t 無しで常駐
+                self._proc = subprocess.Popen(
+                    ['avahi-browse', '-p', '-r', '-k', self.service_type],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    text=True, bufsize=1
+                )
+            except FileNotFoundError:
+                if self.available:
+                    print("[DLNA] avahi-browse not found. Install avahi-utils.")
+                self.available = False
+                self._stop.wait(60)
+                continue
+            self.available = True
+            started = time.monotonic()
+
+            # 一定時間で張り直す（キャッシュ済みの全エントリが再送され last_seen が更新される）
+            timer = threading.Timer(REFRESH_SEC, self._kill)
+            timer.daemon = True
+            timer.start()
+            try:
+                for line in self._proc.stdout:
+                    self.feed((line,))
+                    if self._stop.is_set():
+                        break
+            except Exception as e:
+                print(f"[DLNA] discovery reader error: {e}")
+            finally:
+                timer.cancel()
+                self._kill()
+
+            for row in self.table.expire():
+                if self.on_event:
+                    self.on_event("lost", row)
+
+            # すぐ落ちる場合（avahi-daemon 停止中など）はバックオフ
+            if time.monotonic() - started < 5:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            else:
+                backoff = 1.0
+
+
+if __name__ == "__main__":
+    # 録画した avahi-browse -p 出力をテーブルに流して結果を表示
+    svc = DiscoveryService(on_event=lambda kind, s: print(f"{kind}: {s['name']} {s['address']}"))
+    svc.feed(sys.stdin)
+    for s in svc.services():
+        print(f"{s['name']}\t{s['address']}\t{s.get('host') or ''}\tttl={s['ttl']}")
@@ -0,0 +1,202 @@
+# ~/raspiframe/app/frames.py
+"""
+フリートモード: 1台のサーバ（インデックス・派生画像）に家じゅうのフレームがつながる時の、
+フレームごとの状態（名前付きセッション）。
+
+- 各フレームはプレイヤーを http://<サーバ>:8000/static/player.html?frame=<名前> で開く
+  （ライブラリの走査と縮小はサーバで1回だけ。フレーム側の Pi はブラウザだけ）
+- フレームごとに「設定の上書き」（表示秒数・フェードなど）と「再生位置」（カーソル）を持つ
+- data/frames.json に保存。カーソルは数秒ごとに変わるので間引いて書く
+- 複数ワーカー時は、ファイルが他のワーカーに書き換えられていたら新しい方を取り込む
+"""
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+FRAMES_VERSION = 1
+SAVE_INTERVAL_SEC = 30.0      # カーソル・最終接続時刻だけの変更はこの間隔で書く
+ONLINE_SEC = 30.0             # これより最近に SSE の心拍があれば接続中とみなす
+
+# フレームごとに上書きできる設定（TZ・DLNA などサーバ全体のものは対象外）
+OVERRIDE_KEYS = ("display_ms", "fade_ms", "margin_rate", "ken_burns", "pair_photos", "order",
+                 "collapse_bursts", "show_caption", "sw_cache_mb", "server_scheduler", "playlist_mode")
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+def valid_name(name: Optional[str]) -> bool:
+    return bool(name) and bool(_NAME_RE.match(name))
+
+
+def _new_frame() -> Dict[str, Any]:
+    return {"overrides": {}, "overrides_at": 0.0, "cursor": None, "last_seen": None}
+
+
+class FrameRegistry:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._frames: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._file_mtime_ns: Optional[int] = None
+        self._removed: set = set()    # 消したフレーム（マージで復活させない）
+
+    # ---- 永続化 ----
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"[FRAMES] load failed: {e}")
+            return {}
+        if data.get("version") != FRAMES_VERSION:
+            return {}
+        return {n: {**_new_frame(), **fr} for n, fr in (data.get("frames") or {}).items()
+                if valid_name(n)}
+
+    def load(self) -> int:
+        mtime_ns = self._file_mtime()
+        frames = self._read_file()
+        with self._lock:
+            self._frames = frames
+            self._file_mtime_ns = mtime_ns
+            self._dirty = False
+        return len(frames)
+
+    def merge_from_disk(self) -> None:
+        """他のワーカーが書いていたら、フレームごとに新しい方を取り込む"""
+        mtime_ns = self._file_mtime()
+        if mtime_ns is None or mtime_ns == self._file_mtime_ns:
+            return
+        disk = self._read_file()
+        with self._lock:
+            for name, theirs in disk.items():
+                if name in self._removed:
+                    continue
+                mine = self._frames.get(name)
+                if mine is None:
+                    self._frames[name] = theirs
+                    continue
+                if theirs["overrides_at"] > mine["overrides_at"]:
+                    mine["overrides"], mine["overrides_at"] = theirs["overrides"], theirs["overrides_at"]
+                tc, mc = theirs.get("cursor"), mine.get("cursor")
+                if tc and (not mc or tc.get("at", 0) > mc.get("at", 0)):
+                    mine["cursor"] = tc
+                mine["last_seen"] = max(mine["last_seen"] or 0, theirs["last_seen"] or 0) or None
+            self._file_mtime_ns = mtime_ns
+
+    def save(self, force: bool = False) -> None:
+        self.merge_from_disk()
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            data = {"version": FRAMES_VERSION, "frames": self._frames}
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp, self.path)
+                self._file_mtime_ns = self._file_mtime()
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            except Exception as e:
+                print(f"[FRAMES] save failed: {e}")
+
+    def maybe_save(self) -> None:
+        """間引いた保存（カーソル更新などから呼ぶ）"""
+        if self._dirty and time.monotonic() - self._saved_at > SAVE_INTERVAL_SEC:
+            self.save()
+
+    # ---- フレーム ----
+    def _get(self, name: str) -> Dict[str, Any]:
+        fr = self._frames.get(name)
+        if fr is None:
+            self._removed.discard(name)
+            fr = self._frames[name] = _new_frame()
+            self._dirty = True
+            print(f"[FRAMES] registered: {name}")
+        return fr
+
+    def touch(self, name: str) -> None:
+        with self._lock:
+            self._get(name)["last_seen"] = time.time()
+            self._dirty = True
+        self.maybe_save()
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            fr = self._frames.get(name)
+            return self._public(name, fr) if fr is not None else None
+
+    def frames(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self._public(n, fr) for n, fr in sorted(self._frames.items())]
+
+    def _public(self, name: str, fr: Dict[str, Any]) -> Dict[str, Any]:
+        seen = fr.get("last_seen")
+        return {
+            "name": name,
+            "overrides": dict(fr["overrides"]),
+            "cursor": fr.get("cursor"),
+            "last_seen": seen,
+            "online": bool(seen) and time.time() - seen < ONLINE_SEC,
+        }
+
+    def remove(self, name: str) -> bool:
+        with self._lock:
+            if self._frames.pop(name, None) is None:
+                return False
+            self._removed.add(name)
+            self._dirty = True
+        self.save()
+        return True
+
+    # ---- 設定の上書き ----
+    def overrides(self, name: Optional[str]) -> Dict[str, Any]:
+        if not name:
+            return {}
+        with self._lock:
+            fr = self._frames.get(name)
+            return dict(fr["overrides"]) if fr else {}
+
+    def set_overrides(self, name: str, cfg: Dict[str, Any]) -> Dict[str, Any]:
+        """OVERRIDE_KEYS だけを取り込む（値が None のキーは上書きをやめてサーバ設定に戻す）"""
+        with self._lock:
+            fr = self._get(name)
+            for k in OVERRIDE_KEYS:
+                if k not in cfg:
+                    continue
+                if cfg[k] is None:
+                    fr["overrides"].pop(k, None)
+                else:
+                    fr["overrides"][k] = cfg[k]
+            fr["overrides_at"] = time.time()
+            self._dirty = True
+            out = dict(fr["overrides"])
+        self.save()
+        return out
+
+    def effective(self, base: Dict[str, Any], name: Optional[str]) -> Dict[str, Any]:
+        return {**base, **self.overrides(name)}
+
+    # ---- 再生位置 ----
+    def set_cursor(self, name: str, cursor: Dict[str, Any]) -> None:
+        with self._lock:
+            fr = self._get(name)
+            fr["cursor"] = {**cursor, "at": time.time()}
+            fr["last_seen"] = time.time()
+            self._dirty = True
+        self.maybe_save()
@@ -0,0 +1,225 @@
+# ~/raspiframe/app/governor.py
+"""
+裏方の仕事（インデックスの EXIF 読み・派生画像の作成・先読み・フォルダ統計）の速さを、
+SoC の温度・負荷・このフレームのクロスフェードに合わせて落とす。
+
+ファンの無い Pi 4 を額に入れると、裏方でデコード・縮小を続けるうちに温度で
+クロックが落ち、クロスフェードがカクつく。そこで裏方のループは1件ごとに pace() を呼び、
+ここで決めた段階に従って待つ:
+
+- run   : そのまま進む
+- slow  : 1件ごとに slow_sleep_ms 待つ（温度が slow_c 以上・PSI / ロードアベレージが高い）
+- pause : 段階が下がるまで待つ（温度が pause_c 以上・PSI がとても高い・フェード中）。
+          ただし1回の pace() で待つのは max_pause_sec まで（裏方が止まりきらないように）
+
+温度は resume_c まで下がるまで pause のまま（行ったり来たりしないように）。
+
+読むファイル（config.json の governor で差し替えられる。偽のファイルで試せる）:
+- thermal_path : /sys/class/thermal（thermal_zone*/temp の最大値）か、temp ファイルそのもの（ミリ度）
+- psi_cpu / psi_io : /proc/pressure/cpu・io の "some avg10"（%）
+- loadavg      : /proc/loadavg の1分値（コア数で割る）
+読めないものは無いものとして扱う（PSI の無いカーネル・温度センサーの無い PC など）。
+
+フェードはプレイヤーが表示を切り替えた時の報告（cursor / shown）から、fade_ms の間とみなす。
+"""
+import glob
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+LEVELS = ("run", "slow", "pause")
+SAMPLE_SEC = 1.0              # センサーを読み直す間隔
+WAIT_STEP_SEC = 0.25          # pause 中に段階を見直す間隔
+
+DEFAULTS: Dict[str, Any] = {
+    "enabled": True,
+    "thermal_path": "/sys/class/thermal",
+    "psi_cpu": "/proc/pressure/cpu",
+    "psi_io": "/proc/pressure/io",
+    "loadavg": "/proc/loadavg",
+    "slow_c": 65.0,           # Pi 4 はおよそ 80℃ でクロックを落とし始める
+    "pause_c": 75.0,
+    "resume_c": 70.0,
+    "psi_slow": 30.0,         # some avg10（%）
+    "psi_pause": 70.0,
+    "load_slow": 1.5,         # 1分のロードアベレージ / コア数
+    "pause_during_fade": True,
+    "slow_sleep_ms": 50,
+    "max_pause_sec": 30.0,
+}
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (OSError, ValueError):
+        return None
+
+
+def read_temp_c(path: str) -> Optional[float]:
+    """ディレクトリなら thermal_zone*/temp の最大値。単位はミリ度（小さい値なら度とみなす）"""
+    files = sorted(glob.glob(os.path.join(path, "thermal_zone*", "temp"))) if os.path.isdir(path) else [path]
+    best: Optional[float] = None
+    for f in files:
+        text = _read(f)
+        try:
+            v = float((text or "").strip())
+        except ValueError:
+            continue
+        c = v / 1000.0 if abs(v) > 200 else v
+        best = c if best is None else max(best, c)
+    return best
+
+
+def read_psi(path: str) -> Optional[float]:
+    """'some avg10=1.23 avg60=... ' の avg10"""
+    text = _read(path)
+    if not text:
+        return None
+    for line in text.splitlines():
+        if line.startswith("some "):
+            for part in line.split()[1:]:
+                if part.startswith("avg10="):
+                    try:
+                        return float(part[6:])
+                    except ValueError:
+                        return None
+    return None
+
+
+def read_load(path: str) -> Optional[float]:
+    text = _read(path)
+    try:
+        return float((text or "").split()[0]) / (os.cpu_count() or 1)
+    except (IndexError, ValueError):
+        return None
+
+
+class Governor:
+    """
+    settings() は config.json の governor（dict。無ければ既定値）を返す関数。
+    pace() は裏方のスレッドから呼ぶ（イベントループから呼ばないこと）。
+    """
+
+    def __init__(self, settings: Optional[Callable[[], Dict[str, Any]]] = None) -> None:
+        self.settings = settings or (lambda: {})
+        self._lock = threading.Lock()
+        self._sampled_at = 0.0
+        self._temp: Optional[float] = None
+        self._psi: Dict[str, Optional[float]] = {"cpu": None, "io": None}
+        self._load: Optional[float] = None
+        self._hot = False                         # 温度による pause（resume_c まで続く）
+        self._fade_until = 0.0
+        self._level = "run"
+        self._reasons: List[str] = []
+        self._since = time.time()
+        # 仕事の種類 -> {"calls", "slowed", "paused", "forced", "waited_sec"}
+        self._work: Dict[str, Dict[str, Any]] = {}
+
+    def _cfg(self) -> Dict[str, Any]:
+        cfg = self.settings()
+        return {**DEFAULTS, **(cfg if isinstance(cfg, dict) else {})}
+
+    # ---- 状態 ----
+    def fade(self, ms: Any) -> None:
+        """このフレームでクロスフェードが始まった（ms の間は pause）"""
+        try:
+            sec = max(0.0, min(float(ms), 30_000.0)) / 1000.0
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._fade_until = max(self._fade_until, time.monotonic() + sec)
+
+    def _sample(self, cfg: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        if now - self._sampled_at < SAMPLE_SEC:
+            return
+        self._sampled_at = now
+        self._temp = read_temp_c(str(cfg["thermal_path"]))
+        self._psi = {"cpu": read_psi(str(cfg["psi_cpu"])), "io": read_psi(str(cfg["psi_io"]))}
+        self._load = read_load(str(cfg["loadavg"]))
+
+    def level(self) -> str:
+        cfg = self._cfg()
+        if not cfg.get("enabled", True):
+            return "run"
+        with self._lock:
+            self._sample(cfg)
+            reasons_pause: List[str] = []
+            reasons_slow: List[str] = []
+            t = self._temp
+            if t is not None:
+                if t >= float(cfg["pause_c"]):
+                    self._hot = True
+                elif t < float(cfg["resume_c"]):
+                    self._hot = False
+                if self._hot:
+                    reasons_pause.append(f"temp {t:.1f}C")
+                elif t >= float(cfg["slow_c"]):
+                    reasons_slow.append(f"temp {t:.1f}C")
+            for name, v in self._psi.items():
+                if v is None:
+                    continue
+                if v >= float(cfg["psi_pause"]):
+                    reasons_pause.append(f"psi_{name} {v:.0f}%")
+                elif v >= float(cfg["psi_slow"]):
+                    reasons_slow.append(f"psi_{name} {v:.0f}%")
+            if self._load is not None and self._load >= float(cfg["load_slow"]):
+                reasons_slow.append(f"load {self._load:.2f}")
+            if cfg.get("pause_during_fade", True) and time.monotonic() < self._fade_until:
+                reasons_pause.append("fade")
+            level = "pause" if reasons_pause else "slow" if reasons_slow else "run"
+            reasons = reasons_pause or reasons_slow
+            if level != self._level:
+                # フェードだけの pause は表示のたびなのでログに出さない
+                if reasons != ["fade"] and self._reasons != ["fade"]:
+                    print(f"[GOV] {self._level} -> {level}" + (f" ({', '.join(reasons)})" if reasons else ""))
+                self._level, self._since = level, time.time()
+            self._reasons = reasons
+            return level
+
+    # ---- 裏方から ----
+    def pace(self, work: str) -> None:
+        """裏方の1件ごとに呼ぶ。段階に応じて待つ（run ならすぐ返る）"""
+        level = self.level()
+        with self._lock:
+            st = self._work.setdefault(work, {"calls": 0, "slowed": 0, "paused": 0,
+                                              "forced": 0, "waited_sec": 0.0})
+        st["calls"] += 1
+        if level == "run":
+            return
+        cfg = self._cfg()
+        t0 = time.monotonic()
+        if level == "pause":
+            st["paused"] += 1
+            deadline = t0 + float(cfg["max_pause_sec"])
+            while level == "pause":
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    st["forced"] += 1
+                    break
+                time.sleep(min(WAIT_STEP_SEC, left))
+                level = self.level()
+        if level == "slow":
+            st["slowed"] += 1
+            time.sleep(max(0.0, float(cfg["slow_sleep_ms"])) / 1000.0)
+        st["waited_sec"] += time.monotonic() - t0
+
+    def snapshot(self) -> Dict[str, Any]:
+        level = self.level()
+        with self._lock:
+            fade_left = max(0.0, self._fade_until - time.monotonic())
+            return {
+                "enabled": bool(self._cfg().get("enabled", True)),
+                "level": level,
+                "reasons": list(self._reasons),
+                "since": self._since,
+                "temp_c": round(self._temp, 1) if self._temp is not None else None,
+                "psi": {k: v for k, v in self._psi.items()},
+                "load_per_cpu": round(self._load, 2) if self._load is not None else None,
+                "fade_ms_left": round(fade_left * 1000),
+                "work": {k: {**v, "waited_sec": round(v["waited_sec"], 1)} for k, v in self._work.items()},
+            }
@@ -0,0 +1,198 @@
+# ~/raspiframe/app/latency.py
+"""
+ロータリー操作の遅延を区間ごとに集計する（GPIO のエッジ → ブラウザで描画されるまで）。
+
+rotary.py はトレース付きの JSON を送る（古い "rotary_left" のような文字列もそのまま使える）:
+
+    {"type": "rotary_left", "seq": 12,
+     "trace": {"edge": <monotonic>, "haptic_ms": 1.8, "queued": <monotonic>, "sent": <monotonic>,
+               "boot": <boot_id>}}
+
+monotonic は起動からの時計なので、別のマシンの値どうしは引き算できない。送り手の boot_id
+（/proc/sys/kernel/random/boot_id）がサーバと同じ時、boot が無ければ接続元がループバックの時だけ
+同じ時計とみなす。サーバは中継するトレースの boot を自分の boot_id（違う時計なら None）に付け替え、
+プレイヤーの報告にエコーされたそれで total を数えるか決める。
+
+区間:
+- haptic        : ハプティクスの I2C 書き込み（rotary.py が測る）
+- queue         : コールバック → ws_loop のキューから取り出して送るまで
+- ws_transit    : rotary.py の送信 → サーバの受信（同じ時計の時だけ）
+- relay         : サーバが他のクライアントへ中継し終わるまで
+- delivery      : 中継 → プレイヤーの受信（プレイヤーの報告が届いた時刻から逆算する上限値）
+- player_handle : 受信 → nudgeDays() が返るまで
+- player_fetch  : nudgeDays() → スクラブ用の micro 画像を show() するまで
+- player_paint  : show() → 実際に描画されるまで（requestAnimationFrame 2回）
+- total         : エッジ → 描画（報告の送信時間を含む上限値。同じ時計の時だけ）
+
+区間ごとに固定の対数バケットのヒストグラムと、直近のサンプル（正確な p50/p99 用）を持つ。
+"""
+import ipaddress
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+
+STAGES = ("haptic", "queue", "ws_transit", "relay", "delivery",
+          "player_handle", "player_fetch", "player_paint", "total")
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+RECENT = 1000                 # 区間ごとに残す直近のサンプル数
+MAX_SANE_MS = 60_000.0        # これより大きい・負の値は時計が揃っていないとみなして捨てる
+
+
+def _boot_id() -> str:
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "r", encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+BOOT_ID = _boot_id()          # このマシンの起動ごとの ID（読めなければ空）
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS_MS) + 1)   # 最後は BUCKETS_MS[-1] 超
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: deque = deque(maxlen=RECENT)
+
+    def add(self, ms: float) -> None:
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.recent.append(ms)
+
+    def summary(self) -> Dict[str, Any]:
+        r = sorted(self.recent)
+
+        def pct(p: float) -> Optional[float]:
+            return round(r[min(len(r) - 1, int(p / 100.0 * len(r)))], 2) if r else None
+
+        labels = [f"<={b}" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 2) if self.count else None,
+            "p50_ms": pct(50), "p90_ms": pct(90), "p99_ms": pct(99),
+            "max_ms": round(self.max, 2),
+            "buckets_ms": dict(zip(labels, self.counts)),
+        }
+
+
+class StageLatency:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Histogram] = {}
+        self.since = time.time()
+
+    def record(self, samples: Dict[str, float]) -> Dict[str, float]:
+        """{区間: ms}。おかしな値は捨て、記録したものを返す（他のワーカーへ回す用）"""
+        kept: Dict[str, float] = {}
+        with self._lock:
+            for stage, ms in samples.items():
+                if stage not in STAGES or not isinstance(ms, (int, float)):
+                    continue
+                if ms < 0 or ms > MAX_SANE_MS:
+                    continue
+                self._stages.setdefault(stage, Histogram()).add(float(ms))
+                kept[stage] = float(ms)
+        return kept
+
+    def snapshot(self, full: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            out = {}
+            for stage in STAGES:
+                h = self._stages.get(stage)
+                if h is None:
+                    continue
+                s = h.summary()
+                out[stage] = s if full else {k: s[k] for k in ("count", "p50_ms", "p99_ms")}
+            return {"since": self.since, "stages": out}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages = {}
+            self.since = time.time()
+
+
+def parse_rotary(text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """受信したテキスト → (種類 "rotary_left" など, トレース付きメッセージ or None)"""
+    t = text.strip()
+    if t.startswith("{"):
+        try:
+            msg = json.loads(t)
+        except Exception:
+            return t.lower(), None
+        if isinstance(msg, dict):
+            return str(msg.get("type") or "").lower(), msg
+    return t.lower(), None
+
+
+def _loopback(host: Optional[str]) -> bool:
+    try:
+        ip = ipaddress.ip_address(host or "")
+    except ValueError:
+        return host == "localhost"
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_loopback
+
+
+def same_clock(trace: Dict[str, Any], peer: Optional[str]) -> bool:
+    """送り手の monotonic がサーバと同じ時計か（boot_id が同じ。boot が無ければループバックの接続）"""
+    boot = trace.get("boot")
+    if isinstance(boot, str) and boot and BOOT_ID:
+        return boot == BOOT_ID
+    return _loopback(peer)
+
+
+def _ms(a: Any, b: Any) -> Optional[float]:
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return (b - a) * 1000.0
+    return None
+
+
+def server_samples(msg: Dict[str, Any], recv: float, relay_ms: float, local: bool) -> Dict[str, float]:
+    """
+    サーバで受けた時点で分かる区間（rotary.py 側の区間・送信 → 受信・中継）。
+    local: 送り手がサーバと同じ時計か（same_clock）。違えば送信 → 受信は出さない
+    """
+    tr = msg.get("trace") or {}
+    out: Dict[str, float] = {"relay": relay_ms}
+    if isinstance(tr.get("haptic_ms"), (int, float)):
+        out["haptic"] = tr["haptic_ms"]
+    spans = [("queue", tr.get("queued"), tr.get("sent"))]
+    if local:
+        spans.append(("ws_transit", tr.get("sent"), recv))
+    for stage, a, b in spans:
+        v = _ms(a, b)
+        if v is not None:
+            out[stage] = v
+    return out
+
+
+def player_samples(report: Dict[str, Any], now: float) -> Dict[str, float]:
+    """プレイヤーの描画報告（エコーされたトレース + ブラウザ内の区間）から残りの区間"""
+    tr = report.get("trace") or {}
+    pl = report.get("player") or {}
+    out: Dict[str, float] = {}
+    for stage in ("player_handle", "player_fetch", "player_paint"):
+        v = pl.get(stage.replace("player_", "") + "_ms")
+        if isinstance(v, (int, float)):
+            out[stage] = v
+    browser = pl.get("total_ms")
+    relayed = _ms(tr.get("relayed"), now)
+    if relayed is not None and isinstance(browser, (int, float)):
+        out["delivery"] = relayed - browser
+    # edge は rotary.py の時計。中継した時にサーバが同じ時計と確かめたものだけ
+    total = _ms(tr.get("edge"), now) if tr.get("boot") == BOOT_ID else None
+    if total is not None:
+        out["total"] = total
+    return out
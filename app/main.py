@@ -2,13 +2,17 @@
 import os
 import json
 import asyncio
-import random
+import threading
+import time
 
 from pathlib import Path
 import socket
 import qrcode
 
-from typing import List, Dict, Any, Optional
+from app import photo_index, derivatives, discovery, mounts, usbwatch, dirstats, workers, frames, scheduler, ordering, query, latency, governor, bursts
+
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
 
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
@@ -66,6 +70,19 @@ def _generate_qr_png(page: str = "/static/settings.html", port: int = _QR_PORT)
 # ---- playlist cache ----
 PLAYLIST_CACHE = None
 PLAYLIST_CACHE_KEY = None
+PLAYLIST_CACHE_AT = 0.0
+PLAYLIST_TTL_SEC = 60.0      # これより古ければ差分スキャンし直す（新規ファイル取り込み用）
+_PLAYLIST_LOCK = threading.Lock()
+
+
+def _playlist_tzname() -> str:
+    """TZの決定: CONFIG["tz"] → CONFIG["timezone"] → システムTZ → UTC"""
+    tzname = (CONFIG.get("tz") or CONFIG.get("timezone") or _system_tz_name()).strip()
+    try:
+        _ = ZoneInfo(tzname)   # 妥当性チェック
+    except Exception:
+        tzname = "UTC"
+    return tzname
 
 
 def _current_playlist_key():
@@ -75,121 +92,551 @@ def _current_playlist_key():
     """
     sel = load_json(SEL_FILE, {"folders": []})
     folders = tuple(sorted(sel.get("folders", [])))
+    return (folders, _playlist_tzname())
 
-    cfg = load_json(CONFIG_FILE, {"tz": "Asia/Tokyo"})
-    tz = cfg.get("tz", "Asia/Tokyo")
 
-    return (folders, tz)
+# ---- スキャンジョブ（新しい選択が来たら古いスキャンは止める） ----
+SCAN_FOLDER_DEADLINE_SEC = 20.0   # 1フォルダにかける最大時間（超えたら途中結果で返す）
+_SCAN_LOCK = threading.Lock()
+_SCAN_JOB: Optional[photo_index.ScanJob] = None
+_SCAN_GENERATION = 0
 
+_EMPTY_PLAYLIST = {"images": [], "incomplete": [], "generation": 0}
 
+# /media/{id} の許可リスト: 今のプレイリスト（＝選択フォルダ配下）の画像だけ
+# id -> (path, Entry)。プレイリストを作り直す度に丸ごと差し替える
+_MEDIA: Dict[str, Tuple[str, photo_index.Entry]] = {}
 
 
+def _new_scan_job(key) -> photo_index.ScanJob:
+    """（_SCAN_LOCK を持って呼ぶ）世代番号を進めて新しいジョブを作る。走っている古いジョブはキャンセル"""
+    global _SCAN_JOB, _SCAN_GENERATION
+    if _SCAN_JOB is not None and not _SCAN_JOB.done.is_set():
+        _SCAN_JOB.cancel()
+    _SCAN_GENERATION += 1
+    _SCAN_JOB = photo_index.ScanJob(_SCAN_GENERATION, key)
+    return _SCAN_JOB
 
 
+def _start_scan_job(key) -> photo_index.ScanJob:
+    """中身が変わった（選択・パック・ハッシュ）ので、同じキーでも走っているものを止めて新しく始める"""
+    with _SCAN_LOCK:
+        return _new_scan_job(key)
 
-# 画像拡張子（必要なら増やしてOK）
-_IMG_EXTS = {".jpg",".jpeg",".png",".webp",".tif",".tiff",".gif",".heic",".bmp"}
 
-def _iter_all_images_from_selection():
-    """selection.json の folders を再帰で走査してフルパスを yield"""
-    sel = load_json(SEL_FILE, {"folders": []})
-    for root in sel.get("folders", []):
-        if not os.path.isdir(root):
-            continue
-        for dirpath, _, filenames in os.walk(root):
-            for name in filenames:
-                if os.path.splitext(name)[1].lower() in _IMG_EXTS:
-                    yield os.path.join(dirpath, name)
-
-def _rebuild_playlist():
-    """TZを効かせて day_key を作り直し、キャッシュを更新"""
-    global PLAYLIST_CACHE, PLAYLIST_CACHE_KEY
-    key = _current_playlist_key()
+def _join_or_start_scan_job(key) -> Tuple[photo_index.ScanJob, bool]:
+    """同じキーのスキャンが走っていれば相乗り (job, False)、無ければ新しく始める (job, True)"""
+    with _SCAN_LOCK:
+        job = _SCAN_JOB
+        if job is not None and job.key == key and not job.done.is_set() and not job.cancelled:
+            return job, False
+        return _new_scan_job(key), True
+
+
+# ---- 持ち運べるインデックス（<写真ツリーの根>/.superphotoframe/index.json.gz） ----
+# パックを取り込めたフォルダは走査せずにインデックスの分ですぐプレイリストを作り、
+# 本当の走査（確かめ）は裏で1回だけ行う（governor に合わせて）。違っていたら作り直して知らせる
+_PACK_PENDING: set = set()     # 取り込んだが、まだ確かめていないフォルダ
+_PACK_VERIFIED: set = set()    # 確かめ終わったフォルダ（同じパックでは取り込み直さない）
+_PACK_VERIFYING: set = set()   # 確かめの走査中
+_PACK_LOCK = threading.Lock()
 
-    # TZ名
-    cfg = load_json(CONFIG_FILE, {"tz": "Asia/Tokyo"})
-    tzname = cfg.get("tz", "Asia/Tokyo")
 
-    images = []
-    for path in _iter_all_images_from_selection():
-        ts, day_key = _ts_and_day_from_exif_or_mtime(path, tzname)
-        images.append({"path": path, "ts": ts, "day_key": day_key})
-    images.sort(key=lambda x: x["ts"])
+def _adopt_pack(folder: str) -> bool:
+    """folder をパックの内容で即答してよいか（パックを見つけて確かめられたら True）"""
+    info = INDEX.import_pack(folder)
+    if not info or not info["ok"]:
+        return False
+    with _PACK_LOCK:
+        if info["fresh"]:
+            _PACK_VERIFIED.discard(folder)
+        if folder in _PACK_VERIFIED:
+            return False
+        _PACK_PENDING.add(folder)
+    return True
+
+
+def _verify_packs(folders: List[str]) -> None:
+    """パックで即答したフォルダを実際に走査して確かめる（裏スレッド）"""
+    before = {p: e for f in folders for p, e in INDEX.cached(f)}
+    items, _ = INDEX.scan(folders, pace=lambda: GOVERNOR.pace("index"))
+    changed = len(items) != len(before) or any(before.get(p) is not e for p, e in items)
+    with _PACK_LOCK:
+        _PACK_PENDING.difference_update(folders)
+        _PACK_VERIFIED.update(folders)
+    INDEX.save()
+    print(f"[INDEX] pack verified for {len(folders)} folder(s): {'changed' if changed else 'unchanged'}")
+    if changed and _LOOP is not None and not _LOOP.is_closed():
+        def rebuild():
+            job = _start_scan_job(_current_playlist_key())
+            _spawn(_build_and_notify(job))
+        _LOOP.call_soon_threadsafe(rebuild)
+
+
+# ---- 連写のまとめ（知覚ハッシュ。bursts.py） ----
+# リーダーが裏で、プレイリストの写真のうちまだハッシュの無いものの dHash を作ってインデックスに足す
+# （governor に合わせて。collapse_bursts をどこかで使っている間だけ）。
+# クラスタはプレイリストを作る時に求め、collapse_bursts で代表1枚にする
+HASH_SAVE_EVERY = 500         # これだけ作るごとに index.json に書く（途中で止まっても続きから）
+_HASH_LOCK = threading.Lock()
+BURSTS: Dict[str, Any] = {"running": False, "hashed": 0, "unhashable": 0, "pending": 0,
+                          "clusters": 0, "clustered": 0}
+
+
+def _collapse_in_use() -> bool:
+    return bool(CONFIG.get("collapse_bursts")) or any(
+        fr["overrides"].get("collapse_bursts") for fr in FRAMES.frames())
+
+
+def _hash_job() -> None:
+    """今のプレイリストでまだハッシュの無い写真の dHash を作る（裏スレッド）"""
+    todo = [(p, e) for p, e in list(_MEDIA.values()) if e.dhash is None]
+    BURSTS["pending"] = len(todo)
+    done = 0
+    for p, e in todo:
+        if not LEADER.is_leader or not _collapse_in_use():
+            break
+        BURSTS["pending"] -= 1
+        if not MOUNTS.is_healthy(p):
+            continue
+        GOVERNOR.pace("hashes")
+        h = bursts.dhash(p)
+        INDEX.set_hash(p, e, h if h is not None else bursts.UNHASHABLE)
+        BURSTS["hashed" if h is not None else "unhashable"] += 1
+        done += 1
+        if done % HASH_SAVE_EVERY == 0:
+            INDEX.save()
+    BURSTS["pending"] = 0
+    if not done:
+        return
+    global PLAYLIST_CACHE_AT
+    INDEX.save()
+    print(f"[BURST] hashed {done} photo(s)")
+    # 全ワーカーで次の取得時に作り直す（burst を付け直す）。まとめて表示しているフレームが
+    # あれば今すぐ作り直して知らせる
+    PLAYLIST_CACHE_AT = 0.0
+    BUS.publish({"ch": "playlist"})
+    if _collapse_in_use() and _LOOP is not None and not _LOOP.is_closed():
+        def rebuild():
+            job = _start_scan_job(_current_playlist_key())
+            _spawn(_build_and_notify(job))
+        _LOOP.call_soon_threadsafe(rebuild)
+
+
+def _kick_hash_job() -> None:
+    """
+    ハッシュの無い写真があれば裏で作り始める（リーダーだけ。走っていれば何もしない）。
+    連写をまとめているフレームが無ければ作らない（有効にした時に _request_hashes から呼ばれる）
+    """
+    if not LEADER.is_leader or not _collapse_in_use():
+        return
+    if not any(e.dhash is None for _, e in _MEDIA.values()):
+        return
+    with _HASH_LOCK:
+        if BURSTS["running"]:
+            return
+        BURSTS["running"] = True
+
+    def run():
+        try:
+            _hash_job()
+        except Exception as e:
+            print("[BURST] hash job failed:", repr(e))
+        finally:
+            BURSTS["running"] = False
+    threading.Thread(target=run, name="burst-hash", daemon=True).start()
+
 
-    PLAYLIST_CACHE = {"images": images}
-    PLAYLIST_CACHE_KEY = key
+async def _request_hashes() -> None:
+    """collapse_bursts が有効になった: リーダーならハッシュを作り始める。フォロワーはリーダーに頼む"""
+    if LEADER.is_leader:
+        await asyncio.to_thread(_kick_hash_job)
+    else:
+        BUS.publish({"ch": "hashes"})
+
+
+def _mark_bursts(images: List[Dict[str, Any]], media: Dict[str, Tuple[str, photo_index.Entry]]) -> None:
+    """ts 昇順の images に、まとめられる写真どうしで同じ burst（代表の id）を付ける"""
+    es = [media[it["id"]][1] for it in images]
+    reps = bursts.representatives([it["ts"] for it in images], [e.dhash for e in es], [e.size for e in es])
+    sizes = Counter(reps)
+    clusters = clustered = 0
+    for i, r in enumerate(reps):
+        if sizes[r] > 1:
+            images[i]["burst"] = images[r]["id"]
+            clustered += 1
+            clusters += r == i
+    BURSTS["clusters"], BURSTS["clustered"] = clusters, clustered
+
+
+def _scan_selection(folders, job: photo_index.ScanJob):
+    """（リーダー）選択フォルダを差分スキャンして (found, incomplete, packed)。キャンセルされたら None"""
+    # 固まったマウント配下はスキャンせず、インデックスにある分だけ使う
+    live = [f for f in folders if MOUNTS.is_healthy(f)]
+    offline = [f for f in folders if f not in live]
+    # パックで即答できるフォルダは走査しない（確かめは最後に裏で）
+    packed = [f for f in live if _adopt_pack(f)]
+    live = [f for f in live if f not in packed]
+
+    found, incomplete = INDEX.scan(live, job=job, folder_deadline=SCAN_FOLDER_DEADLINE_SEC,
+                                   pace=lambda: GOVERNOR.pace("index"))
+    if job.cancelled:
+        return None
+    for f in packed:
+        cached = INDEX.cached(f)
+        found.extend(cached)
+        incomplete.append({"folder": f, "reason": "pack", "scanned": len(cached)})
+    for f in offline:
+        print(f"[PLAYLIST] {f}: mount is not healthy, using cached index")
+        cached = INDEX.cached(f)
+        found.extend(cached)
+        incomplete.append({"folder": f, "reason": "offline", "scanned": 0})
+    return found, incomplete, packed
+
+
+def _indexed_selection(folders):
+    """（フォロワー）走査はリーダーに任せ、インデックス（リーダーが書いた data/index.json）から (found, incomplete, packed)"""
+    found: List[Tuple[str, photo_index.Entry]] = []
+    incomplete: List[Dict[str, Any]] = []
+    for f in folders:
+        found.extend(INDEX.cached(f))
+        if not MOUNTS.is_healthy(f):
+            incomplete.append({"folder": f, "reason": "offline", "scanned": 0})
+    return found, incomplete, []
+
+
+def _rebuild_playlist(job: Optional[photo_index.ScanJob] = None):
+    """
+    インデックスを差分スキャンして day_key を付け直し、キャッシュを更新。
+    走査するのはリーダーだけで、終わったら他のワーカーに知らせる（"playlist"）。フォロワーは
+    インデックスのファイルから作り、リーダーに走査を頼む（"scan"。走査済みなら何も起きない）。
+    """
+    global PLAYLIST_CACHE, PLAYLIST_CACHE_KEY, PLAYLIST_CACHE_AT, _MEDIA
+    if job is None:
+        job = _start_scan_job(_current_playlist_key())
+    key = job.key
+    leader = LEADER.is_leader
+    try:
+        with _PLAYLIST_LOCK:
+            # 待っている間にもっと新しい選択が来ていたら、そちらに任せる
+            if job.cancelled:
+                return PLAYLIST_CACHE or _EMPTY_PLAYLIST
+            folders, tzname = key
+            tz = _tz_from_name(tzname)
+
+            if leader:
+                # 他のワーカーが先に読んだ EXIF があれば使う
+                INDEX.merge_from_disk()
+                got = _scan_selection(folders, job)
+                if got is None:
+                    return PLAYLIST_CACHE or _EMPTY_PLAYLIST
+            elif not INDEX.reload() and PLAYLIST_CACHE is not None and PLAYLIST_CACHE_KEY == key:
+                # インデックスも選択も変わっていない → 作り直さない（リーダーには走査を頼む）
+                PLAYLIST_CACHE_AT = time.monotonic()
+                got = None
+            else:
+                got = _indexed_selection(folders)
+            if got is None:
+                BUS.publish({"ch": "scan"})
+                return PLAYLIST_CACHE
+            found, incomplete, packed = got
+
+            images = []
+            media: Dict[str, Tuple[str, photo_index.Entry]] = {}
+            for path, e in found:
+                mid = photo_index.media_id(path)
+                media[mid] = (path, e)
+                w, h = e.upright_size()
+                images.append({
+                    "id": mid,
+                    "path": path,
+                    "ts": e.ts,
+                    "day_key": photo_index.day_key(e.ts, tz),
+                    "model": e.model,
+                    "exposure": e.exposure,
+                    "w": w,
+                    "h": h,
+                    "orient": e.orientation,
+                    "v": e.version(),
+                })
+            images.sort(key=lambda x: x["ts"])
+            _mark_bursts(images, media)
+
+            PLAYLIST_CACHE = {"images": images, "incomplete": incomplete,
+                              "generation": job.generation}
+            _MEDIA = media
+            PLAYLIST_CACHE_KEY = key
+            PLAYLIST_CACHE_AT = time.monotonic()
+        if not leader:
+            BUS.publish({"ch": "scan"})
+            return PLAYLIST_CACHE
+        INDEX.save()
+        BUS.publish({"ch": "playlist"})
+        if packed:
+            with _PACK_LOCK:
+                verifying = [f for f in packed if f not in _PACK_VERIFYING]
+                _PACK_VERIFYING.update(verifying)
+            if verifying:
+                def verify():
+                    try:
+                        _verify_packs(verifying)
+                    finally:
+                        with _PACK_LOCK:
+                            _PACK_VERIFYING.difference_update(verifying)
+                threading.Thread(target=verify, name="pack-verify", daemon=True).start()
+        _kick_hash_job()
+        return PLAYLIST_CACHE
+    finally:
+        job.done.set()
 
 def _get_playlist():
-    """キーが変わってたら再構築してから返す"""
-    key = _current_playlist_key()
-    if PLAYLIST_CACHE is None or PLAYLIST_CACHE_KEY != key:
-        _rebuild_playlist()
-    return PLAYLIST_CACHE
+    """キーが変わってたら（または古くなってたら）再構築してから返す"""
+    while True:
+        key = _current_playlist_key()
+        stale = (time.monotonic() - PLAYLIST_CACHE_AT) > PLAYLIST_TTL_SEC
+        if PLAYLIST_CACHE is not None and PLAYLIST_CACHE_KEY == key and not stale:
+            return PLAYLIST_CACHE
+        # 同じ内容のスキャンが進行中なら相乗りして待つ（二重に走らせない・互いに止め合わない）
+        job, started = _join_or_start_scan_job(key)
+        if started:
+            pl = _rebuild_playlist(job)
+            if not job.cancelled:
+                return pl
+        else:
+            job.done.wait()
+            if not job.cancelled and PLAYLIST_CACHE_KEY == key:
+                return PLAYLIST_CACHE
+        # もっと新しいスキャンに取って代わられた。空を返さず、そちらを待ち直す
 
 
+app = FastAPI()
 
 
+# ==== 起動パイプライン（バックグラウンド） ====================================
+# サーバはすぐに応答を返し始め、重い処理は段階ごとに裏で進める:
+#   index(永続インデックス読込) → qr → dlna(自動マウント) → playlist → derivatives
+# 進捗は /api/ready で公開し、start.html / startup_pipeline.sh はそれをポーリングする。
+STARTUP_STAGES = ("index", "qr", "dlna", "playlist", "derivatives")
+LEADER_STAGES = ("qr", "dlna", "derivatives")   # 複数ワーカー時はリーダーだけが行う
+WARM_DERIVATIVES = 3          # 起動時に先に作っておく表示用派生画像の枚数
 
+_SERVER_T0 = time.monotonic()
+STARTUP: Dict[str, Any] = {
+    "stages": {name: {"state": "pending", "ms": None} for name in STARTUP_STAGES},
+    "first_photo": None,
+}
+_startup_task: Optional[asyncio.Task] = None
 
-app = FastAPI()
 
+def _boot_uptime() -> Optional[float]:
+    """カーネル起動からの経過秒（/proc/uptime）"""
+    try:
+        with open("/proc/uptime", "r") as f:
+            return float(f.read().split()[0])
+    except Exception:
+        return None
+
+
+def _stage(name: str, state: str, **extra) -> None:
+    st = STARTUP["stages"][name]
+    st["state"] = state
+    st.update(extra)
+    if state in ("done", "failed", "skipped"):
+        st["ms"] = int((time.monotonic() - _SERVER_T0) * 1000)
+        print(f"[STARTUP] {name}: {state} at +{st['ms']}ms")
+    if name in LEADER_STAGES and LEADER.is_leader:
+        _publish_shared()
+
+
+def _stage_done(name: str) -> bool:
+    return _stage_state(name) in ("done", "failed", "skipped", "waiting_usb")
+
+
+def _stage_state(name: str) -> str:
+    """リーダーが受け持つステージは、フォロワーではリーダーの進捗を見る"""
+    if name in LEADER_STAGES and not LEADER.is_leader:
+        st = SHARED.read().get("stages", {}).get(name)
+        if st:
+            return st["state"]
+    return STARTUP["stages"][name]["state"]
+
+
+async def _wait_leader_stage(name: str, timeout: float) -> None:
+    """フォロワー用: リーダーのステージが終わるまで待つ（共有状態をポーリング）"""
+    deadline = time.monotonic() + timeout
+    while not _stage_done(name) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+
+
+async def _startup_dlna_mount() -> None:
+    """DLNA自動マウント（USBマウントを待つためリトライ付き）"""
+    dlna_config = CONFIG.get("dlna", {})
+    if not (dlna_config.get("auto_mount") and dlna_config.get("address")):
+        _stage("dlna", "skipped")
+        return
+    print("[DLNA] Auto-mount enabled, attempting to mount...")
+    _stage("dlna", "running")
+
+    # USBがまだなら挿入イベントを待つ（最大30秒。挿さった瞬間に起きる）
+    creds = await asyncio.to_thread(load_usb_credentials)
+    if not creds and not find_usb_mount():
+        print("[DLNA] Waiting for USB mount...")
+        try:
+            await asyncio.wait_for(_USB_PRESENT.wait(), USB_WAIT_SEC)
+        except asyncio.TimeoutError:
+            pass
+        creds = await asyncio.to_thread(load_usb_credentials)
+
+    if not creds:
+        # 後から USB が挿されたら usb_changed から再試行される
+        print("[DLNA] Auto-mount pending: credentials not found in USB")
+        _stage("dlna", "waiting_usb")
+        return
+
+    address = dlna_config.get("address")
+    name = dlna_config.get("name", "DLNA")
+    share = dlna_config.get("share", "photo_resized")
+
+    safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', name)
+    mount_point = os.path.join(DLNA_MOUNT_BASE, safe_name)
+
+    # サービス再起動時など、既にマウント済みならそのまま見張るだけ
+    if mounts.is_mounted(mount_point):
+        CONFIG["dlna"]["mount_point"] = mount_point
+        _save_config()      # 他のワーカーにもマウント先を見せる
+        MOUNTS.manage(mount_point)
+        _stage("dlna", "done")
+        return
 
-@app.on_event("startup")
-async def _on_startup_generate_qr():
     try:
-        url = _generate_qr_png("/static/settings.html", _QR_PORT)
-        print(f"[QR] generated: {url} -> {QR_PATH}")
+        os.makedirs(mount_point, exist_ok=True)
+
+        mount_cmd = _cifs_mount_cmd(address, share, mount_point, creds)
+
+        result = await asyncio.to_thread(
+            subprocess.run, mount_cmd,
+            capture_output=True, text=True, timeout=10
+        )
+
+        if result.returncode == 0:
+            CONFIG["dlna"]["mount_point"] = mount_point
+            _save_config()
+            MOUNTS.manage(mount_point)
+            print(f"[DLNA] Auto-mounted {address}/{share} to {mount_point}")
+            _stage("dlna", "done")
+            return
+        print(f"[DLNA] Auto-mount failed: {result.stderr}")
     except Exception as e:
-        print("[QR] generate failed:", e)
-    
-    # DLNA自動マウント（USBマウントを待つためリトライ付き）
-    dlna_config = CONFIG.get("dlna", {})
-    if dlna_config.get("auto_mount") and dlna_config.get("address"):
-        print("[DLNA] Auto-mount enabled, attempting to mount...")
-        
-        # USBがマウントされるまで待つ（最大30秒、5秒間隔）
-        creds = None
-        for attempt in range(6):
-            if attempt > 0:
-                print(f"[DLNA] Waiting for USB mount... (attempt {attempt + 1}/6)")
-                await asyncio.sleep(5)
-            
-            creds = load_usb_credentials()
-            if creds:
-                break
-        
-        if creds:
-            address = dlna_config.get("address")
-            name = dlna_config.get("name", "DLNA")
-            share = dlna_config.get("share", "photo_resized")
-            
-            safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', name)
-            mount_point = os.path.join(DLNA_MOUNT_BASE, safe_name)
-            
-            try:
-                os.makedirs(mount_point, exist_ok=True)
-                
-                mount_cmd = [
-                    'sudo', 'mount', '-t', 'cifs',
-                    f'//{address}/{share}',
-                    mount_point,
-                    '-o', f'username={creds["username"]},password={creds["password"]},vers=3.0'
-                ]
-                
-                result = await asyncio.to_thread(
-                    subprocess.run, mount_cmd,
-                    capture_output=True, text=True, timeout=10
-                )
-                
-                if result.returncode == 0:
-                    CONFIG["dlna"]["mount_point"] = mount_point
-                    print(f"[DLNA] Auto-mounted {address}/{share} to {mount_point}")
-                else:
-                    print(f"[DLNA] Auto-mount failed: {result.stderr}")
-            except Exception as e:
-                print(f"[DLNA] Auto-mount exception: {e}")
-        else:
-            print("[DLNA] Auto-mount failed: credentials not found in USB after 30 seconds")
+        print(f"[DLNA] Auto-mount exception: {e}")
+    _stage("dlna", "failed")
+
+
+def _selection_needs_dlna() -> bool:
+    """選択フォルダに DLNA マウント配下が含まれるか（含むならマウントを待ってから温める）"""
+    sel = load_json(SEL_FILE, {"folders": []})
+    base = DLNA_MOUNT_BASE.rstrip(os.sep) + os.sep
+    return any(str(f).startswith(base) for f in sel.get("folders", []))
+
+
+def _warm_derivatives(n: int) -> int:
+    """プレイリスト先頭 n 枚の表示用派生画像を作っておく"""
+    images = (PLAYLIST_CACHE or {}).get("images") or []
+    made = 0
+    for it in images[:n]:
+        if derivatives.get(it["path"], "display", pace=lambda: GOVERNOR.pace("derivatives")):
+            made += 1
+    return made
+
+
+async def _startup_pipeline() -> None:
+    # 1) 永続インデックス読み込み
+    _stage("index", "running")
+    try:
+        n = await asyncio.to_thread(INDEX.load)
+        await asyncio.to_thread(DIRSTATS.load)
+        await asyncio.to_thread(FRAMES.load)
+        await asyncio.to_thread(ORDER.load)
+        _stage("index", "done", entries=n)
+    except Exception as e:
+        print("[STARTUP] index load failed:", e)
+        _stage("index", "failed")
+
+    # qr / dlna / derivatives はリーダーだけ（フォロワーの /api/ready はリーダーの進捗を返す）
+    leader = LEADER.is_leader
+    if not leader:
+        for name in LEADER_STAGES:
+            _stage(name, "skipped", by="leader")
+
+    # 2) QR
+    if leader:
+        _stage("qr", "running")
+        try:
+            url = await asyncio.to_thread(_generate_qr_png, "/static/settings.html", _QR_PORT)
+            print(f"[QR] generated: {url} -> {QR_PATH}")
+            _stage("qr", "done", url=url)
+        except Exception as e:
+            print("[QR] generate failed:", e)
+            _stage("qr", "failed")
+
+    # 3) DLNA は裏で（プレイリストが NAS 上の時だけ待つ）
+    if leader:
+        dlna_task = asyncio.create_task(_startup_dlna_mount())
+    else:
+        dlna_task = asyncio.create_task(_wait_leader_stage("dlna", USB_WAIT_SEC + 30))
+    if _selection_needs_dlna():
+        await dlna_task
+
+    # 4) プレイリストを温める（最初の /api/playlist を即答できるように）
+    _stage("playlist", "running")
+    try:
+        pl = await asyncio.to_thread(_get_playlist)
+        _stage("playlist", "done", images=len(pl["images"]))
+    except Exception as e:
+        print("[STARTUP] playlist warm failed:", e)
+        _stage("playlist", "failed")
+
+    # 5) 先頭数枚の表示用派生画像
+    if leader:
+        _stage("derivatives", "running")
+        try:
+            made = await asyncio.to_thread(_warm_derivatives, WARM_DERIVATIVES)
+            _stage("derivatives", "done", count=made)
+        except Exception as e:
+            print("[STARTUP] derivative warm failed:", e)
+            _stage("derivatives", "failed")
+        # 前回までに溜まった派生画像が上限を超えていれば裏で減らす
+        threading.Thread(target=derivatives.prune, name="derivative-prune", daemon=True).start()
+
+    await dlna_task
+
+
+@app.on_event("startup")
+async def _on_startup_generate_qr():
+    global _startup_task, _LOOP
+    _LOOP = asyncio.get_running_loop()
+    BUS.start()
+    USB.start()
+    if USB.current():
+        _USB_PRESENT.set()
+    if LEADER.start():
+        _start_leader_services()
+    else:
+        print(f"[LEADER] pid {os.getpid()} is a follower")
+        _refresh_shared()
+    _startup_task = asyncio.create_task(_startup_pipeline())
+
+
+@app.on_event("shutdown")
+async def _on_shutdown():
+    DIRSTATS.save()
+    FRAMES.save()
+    ORDER.save()
+    USB.stop()
+    DISCOVERY.stop()
+    MOUNTS.stop()
+    SCHED.stop()
+    BUS.stop()
+    LEADER.stop()
 
 
 # ==== TimeZone Helper ==========================================================
@@ -252,12 +699,34 @@ def _localize_naive(dt_naive: datetime, tz):
 # ==== パス設定 ================================================================
 BASE_DIR   = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR   = os.path.dirname(BASE_DIR)
-DATA_DIR   = os.path.join(ROOT_DIR, "data")
+# RASPIFRAME_DATA_DIR で差し替え可（loadtest.py が使い捨てのデータで起動する時など）
+DATA_DIR   = os.environ.get("RASPIFRAME_DATA_DIR") or os.path.join(ROOT_DIR, "data")
+# RASPIFRAME_LOADTEST=1 の時だけ負荷試験用のルート（/api/events/probe）を足す（本番では出さない）
+LOADTEST   = os.environ.get("RASPIFRAME_LOADTEST", "") not in ("", "0", "false", "False")
 STATIC_DIR = os.path.join(ROOT_DIR, "static")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 SEL_FILE    = os.path.join(DATA_DIR, "selection.json")
+INDEX_FILE  = os.path.join(DATA_DIR, "index.json")
+DIRSTATS_FILE = os.path.join(DATA_DIR, "dirstats.json")
+FRAMES_FILE = os.path.join(DATA_DIR, "frames.json")
+ORDER_FILE  = os.path.join(DATA_DIR, "order.json")
+CACHE_DIR   = os.path.join(DATA_DIR, "cache")
+
+# 写真メタデータの永続インデックス / 表示用派生画像
+INDEX = photo_index.PhotoIndex(INDEX_FILE)
+# data/cache の上限は config.json の derivative_cache_mb（無ければ derivatives.CACHE_MAX_MB）
+derivatives.init(CACHE_DIR, budget_mb=lambda: CONFIG.get("derivative_cache_mb"))
+
+# フリートモード: このサーバにつながるフレームごとの設定の上書き・再生位置
+FRAMES = frames.FrameRegistry(FRAMES_FILE)
+
+# 並び順（シャッフルのシード・写真ごとの最終表示）
+ORDER = ordering.Ordering(ORDER_FILE)
+
+# テーマ別プレイリスト（playlist_mode: 毎年の今日・期間・最近 N 日・機種）
+QUERY = query.PlaylistQuery()
 
 # USB/DLNA関連パス
 USB_MOUNT_POINTS = [
@@ -278,12 +747,21 @@ def load_json(path: str, default: Any) -> Any:
         return default
 
 def save_json(path: str, data: Any) -> None:
-    with open(path, "w", encoding="utf-8") as f:
+    # 他のワーカーが書きかけを読まないよう一時ファイル経由で置き換える
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
 
 # ==== USB認証情報読み込み ======================================================
 def find_usb_mount() -> Optional[str]:
-    """USBメモリのマウントポイントを検出（ユーザー非依存）"""
+    """USBメモリのマウントポイント（USB 監視のキャッシュから即答）"""
+    if USB.running:
+        return USB.current()
+    return _scan_usb_mount()
+
+def _scan_usb_mount() -> Optional[str]:
+    """USBメモリのマウントポイントをディレクトリ走査で検出（監視が使えない環境用）"""
     # 固定マウントポイントをチェック
     for mount_point in USB_MOUNT_POINTS:
         if os.path.exists(mount_point) and os.path.isdir(mount_point):
@@ -326,6 +804,20 @@ def find_usb_photo_folder() -> Optional[str]:
     
     return None
 
+def _auto_select_usb_sample(sel: Dict[str, Any]) -> bool:
+    """初期状態（foldersが空）なら USB の Photo/sample を選択して保存。選択したら True"""
+    if sel.get("folders"):
+        return False
+    photo_path = find_usb_photo_folder()
+    if not photo_path:
+        return False
+    sample_path = os.path.join(photo_path, "sample")
+    if not (os.path.exists(sample_path) and os.path.isdir(sample_path)):
+        return False
+    sel["folders"] = [sample_path]
+    save_json(SEL_FILE, sel)
+    return True
+
 def load_usb_credentials() -> Optional[Dict[str, str]]:
     """USBメモリからcredentials.txtを読み込み
     フォーマット:
@@ -360,49 +852,14 @@ def load_usb_credentials() -> Optional[Dict[str, str]]:
 import subprocess
 import re
 
-def discover_dlna_services(timeout: int = 5) -> List[Dict[str, str]]:
-    """avahi-browseでDLNAサービスを検出
-    戻り値: [{"name": "MyNAS", "address": "192.168.1.100"}, ...]
-    """
-    try:
-        # avahi-browse -t _smb._tcp で SMBサービスを検索
-        result = subprocess.run(
-            ['avahi-browse', '-t', '-p', '-r', '_smb._tcp'],
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
-        
-        services = []
-        seen = set()
-        
-        # avahi-browse の出力をパース
-        for line in result.stdout.splitlines():
-            if line.startswith('='):
-                parts = line.split(';')
-                if len(parts) >= 8:
-                    name = parts[3]
-                    address = parts[7]
-                    
-                    # 重複除外
-                    key = f"{name}:{address}"
-                    if key not in seen and address:
-                        seen.add(key)
-                        services.append({
-                            "name": name,
-                            "address": address
-                        })
-        
-        return services
-    except FileNotFoundError:
-        print("[DLNA] avahi-browse not found. Install avahi-utils.")
-        return []
-    except subprocess.TimeoutExpired:
-        print("[DLNA] Discovery timeout")
-        return []
-    except Exception as e:
-        print(f"[DLNA] Discovery error: {e}")
-        return []
+def _cifs_mount_cmd(address: str, share: str, mount_point: str, creds: Dict[str, str]) -> List[str]:
+    """CIFS マウントコマンドを組み立てる"""
+    return [
+        'sudo', 'mount', '-t', 'cifs',
+        f'//{address}/{share}',
+        mount_point,
+        '-o', f'username={creds["username"]},password={creds["password"]},vers=3.0'
+    ]
 
 def mount_dlna_service(address: str, name: str, username: str, password: str) -> Dict[str, Any]:
     """DLNAサービスをマウント
@@ -415,13 +872,9 @@ def mount_dlna_service(address: str, name: str, username: str, password: str) ->
     try:
         os.makedirs(mount_point, exist_ok=True)
         
-        # マウントコマンド
-        mount_cmd = [
-            'sudo', 'mount', '-t', 'cifs',
-            f'//{address}/photo_resized',  # 共有フォルダ名（要調整）
-            mount_point,
-            '-o', f'username={username},password={password},vers=3.0'
-        ]
+        # マウントコマンド（共有フォルダ名は要調整）
+        mount_cmd = _cifs_mount_cmd(address, 'photo_resized', mount_point,
+                                    {"username": username, "password": password})
         
         result = subprocess.run(mount_cmd, capture_output=True, text=True, timeout=10)
         
@@ -450,10 +903,12 @@ def mount_dlna_service(address: str, name: str, username: str, password: str) ->
         }
 
 def unmount_dlna_service(mount_point: str) -> bool:
-    """DLNAサービスをアンマウント"""
+    """DLNAサービスをアンマウント（固まっている時は lazy で切り離す）"""
+    lazy = ['-l'] if not MOUNTS.is_healthy(mount_point) else []
+    MOUNTS.unmanage(mount_point)
     try:
         result = subprocess.run(
-            ['sudo', 'umount', mount_point],
+            ['sudo', 'umount', *lazy, mount_point],
             capture_output=True,
             text=True,
             timeout=10
@@ -480,6 +935,8 @@ CONFIG: Dict[str, Any] = load_json(CONFIG_FILE, {
     "fade_ms": 3000,
     "margin_rate": "5%",
     "ken_burns": False,
+    "pair_photos": False,
+    "collapse_bursts": False,
     "order": "date",
     "show_caption": False,
     "timezone": "Asia/Tokyo",   # ★追加
@@ -491,37 +948,380 @@ CONFIG: Dict[str, Any] = load_json(CONFIG_FILE, {
         "auto_mount": False
     }
 })
+# 他のワーカーが config.json を書き換えたら読み直す（_refresh_shared から）
+_CONFIG_WATCH = workers.FileWatch(CONFIG_FILE)
+
+def _save_config() -> None:
+    save_json(CONFIG_FILE, CONFIG)
+    _CONFIG_WATCH.mark()
+
+# ==== 裏方の仕事の抑制 =======================================================
+# 温度・PSI・このフレームのクロスフェードに合わせて、インデックス・派生画像・先読み・
+# フォルダ統計の裏方を遅らせる（governor.py。閾値やセンサーのパスは config.json の governor）
+GOVERNOR = governor.Governor(settings=lambda: CONFIG.get("governor") or {})
+_LOOPBACK = ("127.0.0.1", "::1", "localhost")
+
+def _note_fade(request: Optional[Request], fade_ms: Any) -> None:
+    """この Pi のキオスク（ループバックからの報告）がクロスフェードを始めた"""
+    if request is not None and (request.client is None or request.client.host not in _LOOPBACK):
+        return
+    if not isinstance(fade_ms, (int, float)) or fade_ms <= 0:
+        return
+    GOVERNOR.fade(fade_ms)
+    BUS.publish({"ch": "gov", "fade_ms": fade_ms})
+
 # ==== SSE: 購読者キュー ======================================================
-subscribers: List[asyncio.Queue] = []
+# キュー -> フレーム名（?frame= 無しで購読したものは None）
+subscribers: Dict[asyncio.Queue, Optional[str]] = {}
+
+async def _notify_all(message: Dict[str, Any], to: Optional[List[str]] = None) -> None:
+    """
+    JSONメッセージをブロードキャスト（SSE用。他のワーカーへは Bus 経由）。
+    to を渡すとそのフレームのセッションにだけ送る（フレーム別の設定変更など）。
+    """
+    await _notify_local(message, to)
+    BUS.publish({"ch": "sse", "msg": message, "to": to})
 
-async def _notify_all(message: Dict[str, Any]) -> None:
-    """全クライアントにJSONメッセージをブロードキャスト（SSE用）"""
+async def _notify_local(message: Dict[str, Any], to: Optional[List[str]] = None) -> None:
+    """このワーカーにつながっている SSE クライアントへ"""
     dead: List[asyncio.Queue] = []
-    for q in subscribers:
+    for q, frame in list(subscribers.items()):
+        if to is not None and frame not in to:
+            continue
         try:
             await q.put(message)
         except Exception:
             dead.append(q)
     for q in dead:
-        try:
-            subscribers.remove(q)
-        except ValueError:
-            pass
+        subscribers.pop(q, None)
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_BG_TASKS: set = set()
+
+def _spawn(coro) -> asyncio.Task:
+    """投げっぱなしのタスク（参照を持っておかないと GC で消えることがある）"""
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+def _notify_threadsafe(message: Dict[str, Any]) -> None:
+    """バックグラウンドスレッドから SSE を送る"""
+    if _LOOP is None or _LOOP.is_closed():
+        return
+    asyncio.run_coroutine_threadsafe(_notify_all(message), _LOOP)
+
+# ==== DLNA 常駐検出 ==========================================================
+def _on_discovery_event(kind: str, service: Dict[str, Any]) -> None:
+    print(f"[DLNA] service {kind}: {service['name']} ({service['address']})")
+    if not LEADER.is_leader:
+        return      # フォロワーの単発スイープ。通知はリーダーの常駐検出に任せる
+    _notify_threadsafe({"type": f"dlna_service_{kind}", "service": service})
+    _publish_shared()
+
+DISCOVERY = discovery.DiscoveryService(on_event=_on_discovery_event)
+
+# ==== マウント管理（stale CIFS 検出・自動再マウント） ========================
+def _remount_dlna(mount_point: str) -> bool:
+    """MountManager から呼ばれる（監視スレッド）。設定済みの NAS を同じ場所に再マウント"""
+    dlna = CONFIG.get("dlna", {})
+    if (dlna.get("mount_point") or "").rstrip(os.sep) != mount_point or not dlna.get("address"):
+        return False
+    creds = load_usb_credentials()
+    if not creds:
+        print("[DLNA] Remount skipped: credentials not found in USB")
+        return False
+    try:
+        os.makedirs(mount_point, exist_ok=True)
+        cmd = _cifs_mount_cmd(dlna["address"], dlna.get("share") or "photo_resized", mount_point, creds)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        if result.returncode != 0:
+            print(f"[DLNA] Remount failed: {result.stderr.strip()}")
+        return result.returncode == 0
+    except Exception as e:
+        print(f"[DLNA] Remount exception: {e}")
+        return False
+
+def _on_mount_change(mount_point: str, state: str, info: Dict[str, Any]) -> None:
+    _notify_threadsafe({"type": "mount_state", "mount_point": mount_point, "state": state, **info})
+    _publish_shared()
+
+MOUNTS = mounts.MountManager(remount=_remount_dlna, on_change=_on_mount_change)
+
+# ==== USB 抜き差し監視 ========================================================
+USB_WAIT_SEC = 30             # 起動時に USB（認証情報）を待つ上限
+_USB_PRESENT = asyncio.Event()
+
+def _on_usb_change(old: Optional[str], new: Optional[str]) -> None:
+    """UsbWatcher から呼ばれる（監視スレッド）"""
+    if _LOOP is None or _LOOP.is_closed():
+        return
+    _LOOP.call_soon_threadsafe(_usb_changed_on_loop, new)
+
+def _usb_changed_on_loop(mount: Optional[str]) -> None:
+    if mount:
+        _USB_PRESENT.set()
+    else:
+        _USB_PRESENT.clear()
+    # 自動選択・DLNA 再試行・通知は1回だけでよいのでリーダーが行う
+    if LEADER.is_leader:
+        _spawn(_handle_usb_change(mount))
+
+async def _handle_usb_change(mount: Optional[str]) -> None:
+    """挿入時に Photo フォルダ自動選択と保留中の DLNA 自動マウントをすぐ行う"""
+    photo = await asyncio.to_thread(find_usb_photo_folder) if mount else None
+    creds = await asyncio.to_thread(load_usb_credentials) if mount else None
+    if photo:
+        # 持ち運べるインデックスがあれば先に取り込んでおく（選択された時に走査せずに即答できる）
+        await asyncio.to_thread(INDEX.import_pack, photo)
+    await _notify_all({"type": "usb_changed", "mount": mount, "photo": photo,
+                       "credentials": bool(creds)})
+    if not mount:
+        return
+
+    sel = load_json(SEL_FILE, {"folders": []})
+    if _auto_select_usb_sample(sel):
+        job = _start_scan_job(_current_playlist_key())
+        await _build_and_notify(job)
+
+    # 起動時に USB が間に合わず保留になっていた DLNA 自動マウント
+    if creds and STARTUP["stages"]["dlna"]["state"] == "waiting_usb":
+        await _startup_dlna_mount()
+        if CONFIG.get("dlna", {}).get("mount_point") and _selection_needs_dlna():
+            job = _start_scan_job(_current_playlist_key())
+            await _build_and_notify(job)
+
+USB = usbwatch.UsbWatcher(USB_MOUNT_POINTS, on_change=_on_usb_change)
+
+# ==== 複数ワーカー（uvicorn --workers N） =====================================
+# - SSE / ロータリーの中継は Bus（data/run/bus-<pid>.sock）で全ワーカーに配る
+# - 常駐検出・マウント監視・USB 挿入時の処理・QR・派生画像の先読みはリーダーだけ
+# - リーダーはマウント状態や検出済み NAS を data/run/shared.json に書き、
+#   フォロワーはリクエストごとに（mtime が変わっていれば）取り込む
+# - 設定・選択フォルダ・インデックスは data/ のファイルを読み直して揃える
+# 単一ワーカーならリーダー1つだけで、これまでと同じ動きになる。
+RUN_DIR = os.path.join(DATA_DIR, "run")
+SHARED_REFRESH_SEC = 15.0     # リーダーが共有状態を書き直す間隔（検出の TTL 更新用）
+
+def _on_bus_message(msg: Dict[str, Any]) -> None:
+    """Bus の受信スレッドから呼ばれる"""
+    if _LOOP is None or _LOOP.is_closed():
+        return
+    _LOOP.call_soon_threadsafe(_bus_on_loop, msg)
+
+def _bus_on_loop(msg: Dict[str, Any]) -> None:
+    global PLAYLIST_CACHE_AT
+    ch = msg.get("ch")
+    if ch == "config":
+        _spawn(_refresh_shared_async())
+    elif ch == "sse":
+        message = msg.get("msg") or {}
+        _spawn(_relay_sse(message, msg.get("to")))
+    elif ch == "ws":
+        _spawn(_ws_broadcast(msg.get("text") or "", msg.get("frame")))
+        if LEADER.is_leader:
+            SCHED.rotary(msg.get("frame"), latency.parse_rotary(msg.get("text") or "")[0])
+    elif ch == "rtrace":
+        if msg.get("reset"):
+            ROTARY_LATENCY.reset()
+        else:
+            ROTARY_LATENCY.record(msg.get("samples") or {})
+    elif ch == "sched":
+        if LEADER.is_leader:
+            SCHED.attach(msg.get("frame"), bool(msg.get("resend")))
+    elif ch == "gov":
+        GOVERNOR.fade(msg.get("fade_ms"))
+    elif ch == "playlist":
+        # リーダーが走査し終えた / ハッシュを足した。次の取得でインデックスを読み直して作り直す
+        PLAYLIST_CACHE_AT = 0.0
+    elif ch == "scan":
+        if LEADER.is_leader:
+            _spawn(_scan_for_follower())
+    elif ch == "hashes":
+        if LEADER.is_leader:
+            # 設定を書いたワーカーの config.json / frames.json を取り込んでから
+            async def kick():
+                await _refresh_shared_async()
+                await asyncio.to_thread(_kick_hash_job)
+            _spawn(kick())
+    elif ch == "first_photo":
+        if STARTUP["first_photo"] is None:
+            STARTUP["first_photo"] = msg.get("first_photo")
+
+def _publish_shared() -> None:
+    """リーダーだけが持つ状態をフォロワー向けに書き出す（どのスレッドからでも可）"""
+    if not LEADER.is_leader:
+        return
+    SHARED.write({
+        "leader": os.getpid(),
+        "updated_at": time.time(),
+        "mounts": MOUNTS.snapshot(),
+        "services": DISCOVERY.services(),
+        "discovery_live": DISCOVERY.available,
+        "discovery_updated_at": DISCOVERY.updated_at,
+        "stages": {name: STARTUP["stages"][name] for name in LEADER_STAGES},
+        "scheduler": SCHED.sessions(),
+    })
+
+_shared_seen: Optional[Dict[str, Any]] = None
+
+def _refresh_shared() -> None:
+    """他のワーカーが書いた設定・共有状態を取り込む（ほとんどの場合 stat だけで済む）"""
+    global _shared_seen
+    FRAMES.merge_from_disk()
+    ORDER.merge_from_disk()
+    if _CONFIG_WATCH.changed():
+        fresh = load_json(CONFIG_FILE, None)
+        if isinstance(fresh, dict):
+            # dict は差し替えずに中身を入れ替える（参照を持っている箇所があるので）。
+            # 裏スレッドから呼ばれるので、空になる瞬間を作らない
+            CONFIG.update(fresh)
+            for k in [k for k in CONFIG if k not in fresh]:
+                CONFIG.pop(k, None)
+            if LEADER.is_leader:
+                # 別のワーカーで NAS をマウント / アンマウントしたかもしれない
+                _sync_managed_mounts()
+    if LEADER.is_leader:
+        return
+    st = SHARED.read()
+    if st is not _shared_seen:
+        _shared_seen = st
+        MOUNTS.mirror(st.get("mounts") or [])
+
+_SHARED_REFRESH: Optional["asyncio.Future[None]"] = None
+_SHARED_REFRESH_AT = 0.0
+SHARED_REFRESH_MIN_SEC = 1.0   # リクエストごとの取り込みはこれ以上間を空ける（通知が来た時はすぐ）
+
+async def _refresh_shared_async() -> None:
+    """_refresh_shared を裏スレッドで（stat と JSON 読みをイベントループでしない）。同時に来たら走っている1本を待つ"""
+    global _SHARED_REFRESH, _SHARED_REFRESH_AT
+    fut = _SHARED_REFRESH
+    if fut is None or fut.done():
+        _SHARED_REFRESH_AT = time.monotonic()
+        fut = _SHARED_REFRESH = asyncio.ensure_future(asyncio.to_thread(_refresh_shared))
+    try:
+        await asyncio.shield(fut)
+    except Exception as e:
+        print("[SHARED] refresh failed:", repr(e))
+
+async def _relay_sse(message: Dict[str, Any], to: Optional[List[str]]) -> None:
+    """他のワーカーからの通知を配る（設定・選択の変更なら先に取り込んでから）"""
+    if message.get("type") in ("config_changed", "selection_changed"):
+        await _refresh_shared_async()
+    await _notify_local(message, to)
+
+def _sync_managed_mounts() -> None:
+    """監視対象を設定に合わせる（設定済みの NAS がマウントされていれば見張る）"""
+    mp = (CONFIG.get("dlna", {}).get("mount_point") or "").rstrip(os.sep)
+    for m in MOUNTS.snapshot():
+        if m["mount_point"] != mp:
+            MOUNTS.unmanage(m["mount_point"])
+    if mp and mounts.is_mounted(mp):
+        MOUNTS.manage(mp)
+    _publish_shared()
+
+async def _leader_heartbeat() -> None:
+    while LEADER.is_leader:
+        await asyncio.sleep(SHARED_REFRESH_SEC)
+        await _refresh_shared_async()
+        await asyncio.to_thread(_publish_shared)
+        await _check_day_rollover()
+
+_last_day: Optional[Any] = None
+
+async def _check_day_rollover() -> None:
+    """日付が変わったら、日付で絞るプレイリスト（毎年の今日・最近 N 日）のフレームに取り直させる"""
+    global _last_day
+    today = _today()
+    if _last_day is None or today == _last_day:
+        _last_day = today
+        return
+    _last_day = today
+    modes = [CONFIG.get("playlist_mode")] + [fr["overrides"].get("playlist_mode") for fr in FRAMES.frames()]
+    if any(query.normalize(m)["mode"] in query.DAY_RELATIVE for m in modes):
+        print(f"[QUERY] day rolled over to {today}, refreshing playlists")
+        await _notify_all({"type": "selection_changed", "reason": "day_rollover"})
+
+def _start_leader_services() -> None:
+    DISCOVERY.start()
+    _sync_managed_mounts()
+    MOUNTS.start()
+    _spawn(_leader_heartbeat())
+
+def _on_leader_acquired() -> None:
+    """LeaderLock の監視スレッドから呼ばれる（前のリーダーが落ちた）"""
+    if _LOOP is None or _LOOP.is_closed():
+        return
+    _LOOP.call_soon_threadsafe(_take_over)
+
+def _take_over() -> None:
+    print(f"[LEADER] pid {os.getpid()} took over background services")
+    _start_leader_services()
+    dlna = CONFIG.get("dlna", {})
+    if dlna.get("auto_mount") and dlna.get("address"):
+        # 前のリーダーで保留・失敗していた自動マウントもやり直す（マウント済みなら見張るだけ）
+        _spawn(_startup_dlna_mount())
+
+BUS = workers.Bus(RUN_DIR, on_message=_on_bus_message)
+LEADER = workers.LeaderLock(os.path.join(RUN_DIR, "leader.lock"), on_acquire=_on_leader_acquired)
+SHARED = workers.SharedState(os.path.join(RUN_DIR, "shared.json"))
+
+class _SharedStateMiddleware:
+    """
+    リクエストの前に他のワーカーの変更を取り込む（素の ASGI なので SSE を包まない）。
+    ワーカーが1つなら何もしない。複数でも SHARED_REFRESH_MIN_SEC に1回まで
+    （/media の取得ごとに stat しない。変更は Bus の通知でもすぐ取り込む）
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] in ("http", "websocket")
+                and time.monotonic() - _SHARED_REFRESH_AT >= SHARED_REFRESH_MIN_SEC
+                and BUS.peers()):
+            await _refresh_shared_async()
+        await self.app(scope, receive, send)
+
+app.add_middleware(_SharedStateMiddleware)
 
 # ==== 設定API ================================================================
 @app.get("/api/config")
-async def get_config():
-    cfg = dict(CONFIG)
+async def get_config(frame: Optional[str] = None):
+    """frame を付けるとそのフレームの上書きを反映した設定（overrides に上書き中のキー）"""
+    cfg = FRAMES.effective(CONFIG, frame) if frame else dict(CONFIG)
     if not cfg.get("tz"):
         cfg["tz"] = _system_tz_name()
+    if frame:
+        cfg["frame"] = frame
+        cfg["overrides"] = sorted(FRAMES.overrides(frame))
     return cfg
 
 
 
+LINEUP_KEYS = {"order", "playlist_mode", "collapse_bursts"}   # 変わったらプレイリストの中身・順番が変わる
+
 @app.post("/api/config")
-async def set_config(cfg: Dict[str, Any]):
+async def set_config(cfg: Dict[str, Any], frame: Optional[str] = None):
     incoming = dict(cfg or {})
 
+    # フレーム別の上書き（表示系のキーだけ。そのフレームにだけ知らせる）
+    if frame is not None:
+        if not frames.valid_name(frame):
+            return JSONResponse({"error": "Invalid frame name"}, status_code=400)
+        # tz や dlna などサーバ全体の設定は上書きにできない。黙って捨てずに断る（何も保存しない）
+        rejected = sorted(k for k in incoming if k not in frames.OVERRIDE_KEYS)
+        if rejected:
+            return JSONResponse({"error": "Not a per-frame setting; post it without ?frame=",
+                                 "keys": rejected}, status_code=400)
+        overrides = await asyncio.to_thread(FRAMES.set_overrides, frame, incoming)
+        await _notify_all({"type": "config_changed", "frame": frame}, to=[frame])
+        if LINEUP_KEYS & incoming.keys():
+            await _notify_all({"type": "selection_changed", "frame": frame}, to=[frame])
+        if overrides.get("collapse_bursts"):
+            await _request_hashes()
+        return {"ok": True, "frame": frame, "overrides": overrides}
+
     # 旧キー 'timezone' → 'tz'
     if "timezone" in incoming and not incoming.get("tz"):
         incoming["tz"] = incoming["timezone"]
@@ -535,10 +1335,13 @@ async def set_config(cfg: Dict[str, Any]):
 
     # 変更前のTZ（現状）
     old_tz = CONFIG.get("tz") or CONFIG.get("timezone")
+    old_lineup = {k: CONFIG.get(k) for k in LINEUP_KEYS}
 
     # 反映＆保存
     CONFIG.update(incoming)
-    save_json(CONFIG_FILE, CONFIG)
+    _save_config()
+    if incoming.get("collapse_bursts") and not old_lineup["collapse_bursts"]:
+        await _request_hashes()
 
     # ★ tz_changed は「今回のリクエストに tz が含まれていて、値が変わった時だけ True」
     tz_changed = ("tz" in incoming) and (old_tz != incoming["tz"])
@@ -551,6 +1354,9 @@ async def set_config(cfg: Dict[str, Any]):
             await _notify_all({"type": "selection_changed"})
         else:
             await _notify_all({"type": "config_changed"})
+            # 設定画面は毎回全部のキーを送ってくるので、値が変わった時だけ
+            if any(k in incoming and incoming[k] != old_lineup[k] for k in LINEUP_KEYS):
+                await _notify_all({"type": "selection_changed"})
     except Exception as e:
         # 落ちても 200 返す（UIの "FAILED" を防ぐ）＋ログ出力
         print("[set_config] post-notify error:", repr(e))
@@ -564,55 +1370,77 @@ async def get_selection():
     sel = load_json(SEL_FILE, {"folders": []})
     
     # 初期状態（foldersが空）の場合、USBのPhoto/sampleフォルダを自動選択
-    if not sel.get("folders"):
-        photo_path = find_usb_photo_folder()
-        if photo_path:
-            sample_path = os.path.join(photo_path, "sample")
-            if os.path.exists(sample_path) and os.path.isdir(sample_path):
-                sel["folders"] = [sample_path]
-                save_json(SEL_FILE, sel)
-                # プレイリストを再構築
-                await asyncio.to_thread(_rebuild_playlist)
+    if _auto_select_usb_sample(sel):
+        # プレイリストを再構築
+        await asyncio.to_thread(_rebuild_playlist)
     
     return sel
 
+async def _scan_for_follower() -> None:
+    """（リーダー）フォロワーに頼まれた走査。選択が変わっていれば作って知らせ、同じなら TTL 切れの時だけ差分スキャン"""
+    key = _current_playlist_key()
+    if PLAYLIST_CACHE_KEY != key:
+        job, started = _join_or_start_scan_job(key)
+        if started:
+            await _build_and_notify(job)
+    else:
+        await asyncio.to_thread(_get_playlist)
+
+async def _build_and_notify(job: photo_index.ScanJob) -> None:
+    """裏でプレイリストを作り、キャンセルされずに終わった時だけ再取得を促す"""
+    try:
+        await asyncio.to_thread(_rebuild_playlist, job)
+    except Exception as e:
+        print("[PLAYLIST] rebuild failed:", repr(e))
+    if not job.cancelled:
+        await _notify_all({"type": "selection_changed", "generation": job.generation})
+
 @app.post("/api/selection")
 async def save_selection(sel: Dict[str, Any]):
     save_json(SEL_FILE, sel or {"folders": []})
-    await _notify_all({"type": "selection_changed"})
-    return {"ok": True}
+    # 連打されても走るスキャンは最新の1本だけ
+    job = _start_scan_job(_current_playlist_key())
+    _spawn(_build_and_notify(job))
+    return {"ok": True, "generation": job.generation}
 
 # ==== DLNA API ================================================================
 @app.get("/api/dlna/discover")
-async def dlna_discover():
-    """DLNAサービスを検出"""
-    services = await asyncio.to_thread(discover_dlna_services, 5)
-    return {"services": services}
+async def dlna_discover(refresh: bool = False):
+    """DLNAサービス一覧（常駐検出のテーブルから即答。refresh=1 で単発スイープも行う）"""
+    if not LEADER.is_leader:
+        # 常駐検出はリーダーにある。単発スイープの結果はこのワーカーの表に足して返す
+        st = SHARED.read()
+        if refresh:
+            await asyncio.to_thread(DISCOVERY.sweep)
+        services = {(s["name"], s["address"]): s for s in st.get("services") or []}
+        for s in DISCOVERY.services():
+            services.setdefault((s["name"], s["address"]), s)
+        return {
+            "services": sorted(services.values(), key=lambda r: (r["name"].lower(), r["address"])),
+            "live": st.get("discovery_live", False),
+            "updated_at": st.get("discovery_updated_at"),
+        }
+    if refresh or not DISCOVERY.available:
+        await asyncio.to_thread(DISCOVERY.sweep)
+    return {
+        "services": DISCOVERY.services(),
+        "live": DISCOVERY.available,
+        "updated_at": DISCOVERY.updated_at,
+    }
 
 @app.get("/api/dlna/status")
 async def dlna_status():
     """現在のDLNAマウント状態"""
     dlna_config = CONFIG.get("dlna", {})
     
-    # マウントポイントが存在するか確認
+    # /proc/self/mountinfo で確認（fork しない / 固まった NAS に触らない）
     mount_point = dlna_config.get("mount_point")
-    is_mounted = False
-    
-    if mount_point and os.path.exists(mount_point):
-        # 実際にマウントされているか確認
-        try:
-            result = subprocess.run(
-                ['mountpoint', '-q', mount_point],
-                capture_output=True,
-                timeout=2
-            )
-            is_mounted = (result.returncode == 0)
-        except Exception:
-            is_mounted = False
+    is_mounted = bool(mount_point) and mounts.is_mounted(mount_point)
     
     return {
         "enabled": dlna_config.get("enabled", False),
         "mounted": is_mounted,
+        "health": MOUNTS.state(mount_point) if mount_point else None,
         "address": dlna_config.get("address"),
         "name": dlna_config.get("name"),
         "mount_point": mount_point
@@ -645,7 +1473,7 @@ async def dlna_mount(request: Request):
     
     # 既存のマウントを解除
     old_mount = CONFIG.get("dlna", {}).get("mount_point")
-    if old_mount and os.path.exists(old_mount):
+    if old_mount and mounts.is_mounted(old_mount):
         await asyncio.to_thread(unmount_dlna_service, old_mount)
     
     # マウント実行（共有フォルダ名を指定可能に）
@@ -655,12 +1483,7 @@ async def dlna_mount(request: Request):
     try:
         os.makedirs(mount_point, exist_ok=True)
         
-        mount_cmd = [
-            'sudo', 'mount', '-t', 'cifs',
-            f'//{address}/{share}',
-            mount_point,
-            '-o', f'username={creds["username"]},password={creds["password"]},vers=3.0'
-        ]
+        mount_cmd = _cifs_mount_cmd(address, share, mount_point, creds)
         
         result = await asyncio.to_thread(
             subprocess.run, mount_cmd,
@@ -677,7 +1500,10 @@ async def dlna_mount(request: Request):
                 "mount_point": mount_point,
                 "auto_mount": True
             }
-            save_json(CONFIG_FILE, CONFIG)
+            _save_config()
+            MOUNTS.manage(mount_point)
+            BUS.publish({"ch": "config"})     # リーダーが別のワーカーなら見張りを引き継ぐ
+            _publish_shared()
             
             print(f"[DLNA] Mounted {address}/{share} to {mount_point}")
             return {
@@ -713,7 +1539,8 @@ async def dlna_unmount():
         # 設定を更新
         CONFIG["dlna"]["enabled"] = False
         CONFIG["dlna"]["mount_point"] = None
-        save_json(CONFIG_FILE, CONFIG)
+        _save_config()
+        BUS.publish({"ch": "config"})
         
         return {"success": True}
     else:
@@ -729,20 +1556,21 @@ async def get_usb_photo_info():
     photo_path = find_usb_photo_folder()
     
     if photo_path:
-        # フォルダ内の画像数をカウント
-        image_count = 0
-        try:
-            for root, _, files in os.walk(photo_path):
-                for fn in files:
-                    if fn.lower().endswith(IMAGE_EXTS):
-                        image_count += 1
-        except Exception:
-            pass
+        # 画像数はフォルダ統計のキャッシュから（初回だけ数える。以降は裏で再検証）
+        stats = DIRSTATS.get(photo_path)
+        if stats is None:
+            await asyncio.to_thread(DIRSTATS.refresh, photo_path)
+            stats = DIRSTATS.get(photo_path)
+        else:
+            DIRSTATS.request(photo_path)
+        stats = stats or {}
         
         return {
             "available": True,
             "path": photo_path,
-            "image_count": image_count
+            "image_count": stats.get("image_count", 0),
+            "total_bytes": stats.get("total_bytes", 0),
+            "newest": stats.get("newest"),
         }
     else:
         return {
@@ -752,260 +1580,369 @@ async def get_usb_photo_info():
         }
 
 # ==== ファイルシステムブラウズ ===============================================
-IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif")
-
-@app.get("/api/fs/list")
-async def fs_list(path: str = "/mnt/photos"):
-    if not os.path.exists(path):
-        return {"dirs": [], "images": [], "up": None}
-    dirs, images = [], []
-    try:
-        for entry in os.scandir(path):
-            if entry.is_dir():
-                dirs.append(entry.path)
-            elif entry.is_file():
-                if entry.name.lower().endswith(IMAGE_EXTS):
-                    images.append(entry.path)
-    except Exception as e:
-        print("fs_list error:", e)
-    up = os.path.dirname(path) if path not in ("/", "") else None
-    return {"dirs": dirs, "images": images, "up": up}
-
-
-# ==== プレイリスト（並び順はサーバ側で確定） ================================
-# EXIF → 撮影日優先で ts を作る
-from typing import Optional
-
-try:
-    from PIL import Image, ExifTags  # Pillow がある場合は EXIF を使う
-    _EXIF_TAGS = {v: k for k, v in ExifTags.TAGS.items()}
-    _HAS_PIL = True
-except Exception:
-    _HAS_PIL = False
-
-
-def _parse_exif_datetime(val: str) -> Optional[float]:
-    """
-    "YYYY:MM:DD HH:MM:SS" 形式の EXIF 日付文字列を epoch 秒に。
-    サブ秒やヌル文字が混ざっていても極力捌く（ローカルタイムとして解釈）。
-    """
-    if not isinstance(val, str):
-        return None
-    s = val.strip().split("\x00", 1)[0]        # 末尾のヌル除去
-    if "." in s:                               # サブ秒を落とす
-        s = s.split(".", 1)[0]
-    if len(s) < 19:
-        return None
-    try:
-        import time
-        t = time.strptime(s, "%Y:%m:%d %H:%M:%S")
-        return float(int(time.mktime(t)))
-    except Exception:
-        return None
-
+IMAGE_EXTS = photo_index.IMAGE_EXTS
 
+def _index_ts(path: str, size: int, mtime_ns: int) -> Optional[float]:
+    """インデックスに載っていて変わっていなければ撮影日時を返す"""
+    e = INDEX.entries.get(path)
+    if e is not None and e.size == size and e.mtime_ns == mtime_ns:
+        return e.ts
+    return None
 
+# フォルダごとの画像枚数・合計サイズ・最新撮影日時（data/dirstats.json）
+DIRSTATS = dirstats.DirStats(DIRSTATS_FILE, ts_of=_index_ts, is_healthy=MOUNTS.is_healthy,
+                             pace=lambda: GOVERNOR.pace("dirstats"))
+
+# 再帰の統計を数えるのはこの配下（＋選択フォルダ・DLNA のマウント先）だけ。
+# "/" を開いても /usr や /proc まで辿って data/dirstats.json に書かない
+DIRSTATS_ROOTS = ["/mnt", "/media"] + USB_MOUNT_POINTS + [DLNA_MOUNT_BASE]
+
+def _dirstats_roots() -> List[str]:
+    roots = list(load_json(SEL_FILE, {"folders": []}).get("folders") or []) + DIRSTATS_ROOTS
+    mp = (CONFIG.get("dlna") or {}).get("mount_point")
+    if mp:
+        roots.append(mp)
+    return [r.rstrip(os.sep) for r in roots if r and r.rstrip(os.sep)]
+
+def _fs_page(path: str, sort: str, cursor: Optional[str], limit: int) -> Dict[str, Any]:
+    lst = DIRSTATS.listing(path)
+    rows: List[Dict[str, Any]] = []
+    for name, _ in lst.dirs:
+        p = os.path.join(path, name)
+        st = DIRSTATS.get(p)
+        rows.append({
+            "kind": "dir", "name": name, "path": p,
+            "date": st["newest"] if st else None,
+            "size": st["total_bytes"] if st else None,
+            "count": st["image_count"] if st else None,
+        })
+    for name, size, mtime_ns in lst.images:
+        p = os.path.join(path, name)
+        ts = _index_ts(p, size, mtime_ns)
+        rows.append({
+            "kind": "image", "name": name, "path": p,
+            "date": ts if ts is not None else mtime_ns / 1e9,
+            "size": size, "count": 1,
+        })
+    page, next_cursor = dirstats.paginate(rows, sort, cursor, limit)
+    # 返すページのフォルダだけ、キャッシュを返しつつ裏で再検証（mtime が同じなら stat だけ）
+    roots = _dirstats_roots()
+    pending = 0
+    for r in page:
+        if r["kind"] != "dir":
+            continue
+        p = r["path"]
+        if not any(p == root or p.startswith(root + os.sep) for root in roots):
+            continue
+        DIRSTATS.request(p)
+        if r["count"] is None:
+            pending += 1
+    return {
+        "dirs": [r["path"] for r in page if r["kind"] == "dir"],
+        "images": [r["path"] for r in page if r["kind"] == "image"],
+        "stats": {
+            r["path"]: {"image_count": r["count"], "total_bytes": r["size"], "newest": r["date"]}
+            for r in page if r["kind"] == "dir" and r["count"] is not None
+        },
+        "total": {"dirs": len(lst.dirs), "images": len(lst.images)},
+        "pending": pending,
+        "next_cursor": next_cursor,
+    }
 
-def _ts_and_day_from_exif_or_mtime(path: str, tzname: str) -> tuple[float, str]:
+@app.get("/api/fs/list")
+async def fs_list(path: str = "/mnt/photos", sort: str = "name",
+                  cursor: Optional[str] = None, limit: int = dirstats.DEFAULT_LIMIT):
     """
-    画像ファイルから (epoch秒, YYYY-MM-DD) を返す。
-    EXIF(DateTimeOriginal→CreateDate→Digitized→DateTime) を優先。
-    取れない時は mtime を使用。どちらも tzname を適用して day_key を作る。
+    フォルダ一覧（フォルダ → 画像の順、ソート＋カーソルでページング）。
+    - sort   : name / date / size / count（"-date" のように先頭 "-" で降順）
+    - cursor : 前のレスポンスの next_cursor
+    - stats  : サブフォルダごとの image_count / total_bytes / newest（キャッシュから即答）
+    - pending: このページで統計がまだ無いサブフォルダの数（裏で計算中。選択フォルダ・マウント先の配下だけ数える）
     """
-    # 1) TZ 準備
-    try:
-        tz = ZoneInfo(tzname)
-    except Exception:
-        tz = ZoneInfo("UTC")
-
-    # 2) EXIF 優先
-    if _HAS_PIL:
-        try:
-            with Image.open(path) as im:
-                exif = im._getexif() or {}
-            for key_name in ("DateTimeOriginal", "CreateDate", "DateTimeDigitized", "DateTime"):
-                tag_id = _EXIF_TAGS.get(key_name)
-                if not tag_id:
-                    continue
-                val = exif.get(tag_id)
-                if isinstance(val, bytes):
-                    try:
-                        val = val.decode(errors="ignore")
-                    except Exception:
-                        val = None
-                if isinstance(val, str):
-                    s = val.strip().split("\x00", 1)[0]
-                    if "." in s:
-                        s = s.split(".", 1)[0]
-                    if len(s) >= 19:
-                        try:
-                            # EXIFはナイーブ。tz を付与して確定させる
-                            dt = datetime.strptime(s, "%Y:%m:%d %H:%M:%S").replace(tzinfo=ZoneInfo("Asia/Tokyo"))
-                            dt = dt.astimezone(tz)
-                            return (float(dt.timestamp()), dt.strftime("%Y-%m-%d"))
-                        except Exception:
-                            pass
-
-        except Exception:
-            pass
-
-
-    # 3) フォールバック: mtime（epochはTZ不要、day_key生成だけTZ使用）
+    up = os.path.dirname(path) if path not in ("/", "") else None
+    empty = {"dirs": [], "images": [], "stats": {}, "total": {"dirs": 0, "images": 0},
+             "pending": 0, "next_cursor": None, "up": None}
+    if not MOUNTS.is_healthy(path) or not os.path.exists(path):
+        return empty
     try:
-        mtime = float(os.path.getmtime(path))
-        dt_local = datetime.fromtimestamp(mtime, tz)
-        return (mtime, dt_local.strftime("%Y-%m-%d"))
-    except Exception:
-        dt_local = datetime.fromtimestamp(0, tz)
-        return (0.0, dt_local.strftime("%Y-%m-%d"))
-
-
-
+        res = await asyncio.to_thread(_fs_page, path, sort, cursor, limit)
+    except Exception as e:
+        print("fs_list error:", e)
+        return {**empty, "up": up}
+    res["up"] = up
+    return res
 
 
+# ==== プレイリスト（並び順はサーバ側で確定） ================================
 @app.get("/api/playlist")
-async def playlist():
+async def playlist(paths: bool = False, frame: Optional[str] = None):
     """
-    選択フォルダから画像一覧を作成して返す。
+    選択フォルダから画像一覧を作成して返す（永続インデックス経由）。
+    - id      : /media/{id} で配信する短い ID（paths=1 の時だけ path も返す）
+    - v       : ファイルの版（size / mtime から）。/media/{id}?v=... として、写真が変わったら別の URL にする
     - ts      : UTC基準のepoch秒
     - day_key : 指定TZでの撮影日 (YYYY-MM-DD)
     - model / exposure : EXIF由来の表示用キャプション
+    - w / h   : Orientation を当てた後の画素数（読めなかった時は 0）、orient : EXIF Orientation
+    - burst   : 連写・ほぼ同じ写真のまとまりの代表の id（まとまりに入っている写真だけ）
     TZの決定: CONFIG["tz"] → CONFIG["timezone"] → システムTZ → UTC
+    frame を付けるとそのフレームの絞り込み・並び順（playlist_mode / order の上書き）を使う
+    playlist_mode: all / on_this_day / range / last_days / camera（query.py）
+    order: date / random（シード固定）/ shuffle_day / least_recent（ordering.py）
     """
-    # ---- TZ 決定（後方互換あり） ----
-    tzname = (CONFIG.get("tz") or CONFIG.get("timezone") or _system_tz_name()).strip()
-    try:
-        _ = ZoneInfo(tzname)   # 妥当性チェック
-    except Exception:
-        tzname = "UTC"
-
-    sel = load_json(SEL_FILE, {"folders": []})
-    
     # 初期状態（foldersが空）の場合、USBのPhoto/sampleフォルダを自動選択
-    if not sel.get("folders"):
-        photo_path = find_usb_photo_folder()
-        if photo_path:
-            sample_path = os.path.join(photo_path, "sample")
-            if os.path.exists(sample_path) and os.path.isdir(sample_path):
-                sel["folders"] = [sample_path]
-                save_json(SEL_FILE, sel)
+    _auto_select_usb_sample(load_json(SEL_FILE, {"folders": []}))
     
-    items: List[Dict[str, Any]] = []
-
-    for folder in sel.get("folders", []):
-        if not os.path.exists(folder):
-            continue
-        for root, _, files in os.walk(folder):
-            for fn in files:
-                if not fn.lower().endswith(IMAGE_EXTS):
-                    continue
-                p = os.path.join(root, fn)
-
-                # ts(UTC) と day_key(TZ適用) を取得
-                ts, day_key = _ts_and_day_from_exif_or_mtime(p, tzname)
-
-                model, exposure = _exif_model_and_exposure(p)
-                items.append({
-                    "path": p,
-                    "ts": ts,
-                    "day_key": day_key,
-                    "model": model,
-                    "exposure": exposure,
-                })
-
-    # 並び順
-    order = (CONFIG.get("order") or "date").lower()
-    if order == "random":
-        random.shuffle(items)
+    pl = await asyncio.to_thread(_get_playlist)
+    # 絞り込み → 並び順（キャッシュは ts 昇順で持っている。大きなライブラリでは重いのでスレッドで）
+    ordered, mode = await asyncio.to_thread(_lineup, pl, frame)
+    if paths:
+        items: List[Dict[str, Any]] = list(ordered)
     else:
-        items.sort(key=lambda x: x["ts"])
-
-    return {"images": items}
-
+        items = [{k: v for k, v in it.items() if k != "path"} for it in ordered]
 
-# ==== キャプション ==========================================================
+    # incomplete: 期限内に走査し終わらなかった / マウントが固まっているフォルダ
+    return {
+        "images": items,
+        "incomplete": pl.get("incomplete", []),
+        "generation": pl.get("generation", 0),
+        "mode": mode,
+    }
 
+def _today():
+    """プレイリストの TZ での今日"""
+    return datetime.now(_tz_from_name(_playlist_tzname())).date()
 
-def _exposure_to_text(val) -> str:
+def _collapsed(pl: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
-    EXIF ExposureTime なら 1/125s などに、ShutterSpeedValue(APEX) なら近い分数へ。
+    連写を代表1枚にした images。プレイリスト（の世代）ごとに1回だけ作って pl に持つ
+    （毎回同じリストを返すので、元リストの同一性で引く query / ordering のメモが効く）
     """
+    out = pl.get("collapsed")
+    if out is None:
+        out = pl.setdefault("collapsed", bursts.collapse(pl["images"]))
+    return out
+
+def _lineup(pl: Dict[str, Any], frame: Optional[str]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """（collapse_bursts なら連写を代表1枚にして）playlist_mode で絞り込み、order で並べる（フレーム別の上書きを反映）"""
+    cfg = FRAMES.effective(CONFIG, frame)
+    images = pl["images"]
+    collapsed = 0
+    if cfg.get("collapse_bursts"):
+        n = len(images)
+        images = _collapsed(pl)
+        collapsed = n - len(images)
+    selected, mode = QUERY.select(images, cfg.get("playlist_mode"), _today())
+    if collapsed:
+        mode = {**mode, "collapsed": collapsed}
+    return ORDER.arrange(selected, cfg.get("order")), mode
+
+@app.get("/api/playlist/cameras")
+async def playlist_cameras():
+    """選択フォルダにある機種と枚数（playlist_mode: camera 用）"""
+    pl = await asyncio.to_thread(_get_playlist)
+    return {"cameras": QUERY.index(pl["images"]).cameras()}
+
+
+@app.post("/api/playlist/shown")
+async def playlist_shown(request: Request):
+    """プレイヤーが表示した写真（order: least_recent 用。名前付きフレームは cursor で記録される）"""
     try:
-        # ExposureTime は (num, den) のタプルで来ることが多い
-        if isinstance(val, tuple) and len(val) == 2 and val[1] != 0:
-            num, den = int(val[0]), int(val[1])
-            # 1秒未満は 1/x 表記、1秒以上は x"s
-            if num/den < 1:
-                return f"1/{int(round(den/num))}s"
-            else:
-                return f"{num/den:.1f}s"
-        # 既に float の場合
-        v = float(val)
-        if v < 1:
-            return f"1/{int(round(1.0/v))}s"
-        return f"{v:.1f}s"
+        body = await request.json()
     except Exception:
-        return ""
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Invalid report"}, status_code=400)
+    mid = body.get("id")
+    if not isinstance(mid, str) or len(mid) > 32:
+        return JSONResponse({"error": "id is required"}, status_code=400)
+    # 今のプレイリストに無い ID は記録しない（order.json が際限なく増えないように）
+    if mid not in _MEDIA:
+        return JSONResponse({"error": "Unknown id"}, status_code=404)
+    await asyncio.to_thread(ORDER.mark_shown, mid)
+    _note_fade(request, body.get("fade_ms"))
+    return {"ok": True}
 
-def _exif_model_and_exposure(path: str) -> tuple[str, str]:
+@app.post("/api/playlist/reshuffle")
+async def playlist_reshuffle():
+    """random / shuffle_day の順番を新しいシードで作り直す"""
+    seed = await asyncio.to_thread(ORDER.reshuffle)
+    await _notify_all({"type": "selection_changed", "reason": "reshuffle"})
+    return {"ok": True, "seed": seed}
+
+def _export_pack(folder: str) -> Dict[str, Any]:
+    if not os.path.isdir(folder) or not MOUNTS.is_healthy(folder):
+        raise ValueError("folder is not available")
+    # 書き出す前に最後まで走査する（途中までのパックは作らない）
+    _, incomplete = INDEX.scan([folder])
+    if incomplete:
+        raise ValueError("scan did not finish")
+    INDEX.save()
+    return INDEX.export_pack(folder)
+
+@app.post("/api/index/export")
+async def index_export(request: Request):
     """
-    (model_text, exposure_text) を返す。取れなければ空文字。
+    選択フォルダ（folder を渡せばそれだけ）の持ち運べるインデックスを
+    <フォルダ>/.superphotoframe/index.json.gz に書き出す。別のフレームに挿すとすぐ使える
     """
-    if not _HAS_PIL:
-        return ("", "")
     try:
-        with Image.open(path) as im:
-            exif = im._getexif() or {}
-        if not exif:
-            return ("", "")
-        # Model / Make
-        model = exif.get(_EXIF_TAGS.get("Model"), "") or ""
-        make  = exif.get(_EXIF_TAGS.get("Make"), "") or ""
-        model_text = (f"{make} {model}".strip() or model or make).strip()
-
-        # 露出: ExposureTime優先、なければ ShutterSpeedValue(APEX)
-        exp = exif.get(_EXIF_TAGS.get("ExposureTime"))
-        exposure_text = ""
-        if exp is not None:
-            exposure_text = _exposure_to_text(exp)
-        else:
-            # APEX → 秒へ: t = 2^(-APEX)
-            sv = exif.get(_EXIF_TAGS.get("ShutterSpeedValue"))
-            if sv is not None:
-                try:
-                    import math
-                    if isinstance(sv, tuple) and len(sv) == 2 and sv[1] != 0:
-                        apex = float(sv[0]) / float(sv[1])
-                    else:
-                        apex = float(sv)
-                    sec = 2 ** (-apex)
-                    exposure_text = _exposure_to_text(sec)
-                except Exception:
-                    pass
-
-        return (model_text, exposure_text)
+        body = await request.json()
     except Exception:
-        return ("", "")
-
-
-# ==== Timestamp & DayKey (TZ適用) =============================================
+        body = {}
+    folders = sorted(load_json(SEL_FILE, {"folders": []}).get("folders") or [])
+    want = (body or {}).get("folder") if isinstance(body, dict) else None
+    if want:
+        if not any(want == f or want.startswith(f.rstrip(os.sep) + os.sep) for f in folders):
+            return JSONResponse({"error": "folder must be a selected folder"}, status_code=400)
+        folders = [want]
+    results = []
+    for f in folders:
+        try:
+            results.append({"folder": f, **(await asyncio.to_thread(_export_pack, f))})
+        except Exception as e:
+            print(f"[INDEX] export failed {f}: {e}")
+            results.append({"folder": f, "error": str(e)})
+    return {"exported": results}
+
+
+# ==== 起動状態 / readiness ===================================================
+@app.get("/api/ready")
+async def ready():
+    """起動パイプラインの進捗。ready=True ならプレイヤーへ遷移してよい"""
+    stages = dict(STARTUP["stages"])
+    if not LEADER.is_leader:
+        stages.update(SHARED.read().get("stages") or {})
+    return {
+        "ready": _stage_done("playlist"),
+        "qr": _stage_done("qr"),
+        "stages": stages,
+        "server_uptime_s": round(time.monotonic() - _SERVER_T0, 3),
+        "boot_uptime_s": _boot_uptime(),
+        "first_photo": STARTUP["first_photo"],
+    }
 
+@app.post("/api/ready/first_photo")
+async def ready_first_photo():
+    """プレイヤーが最初の1枚を描画した時に呼ぶ。起動→初回表示の時間を記録"""
+    if STARTUP["first_photo"] is None:
+        boot = _boot_uptime()
+        server = round(time.monotonic() - _SERVER_T0, 3)
+        STARTUP["first_photo"] = {
+            "boot_to_first_photo_s": round(boot, 3) if boot is not None else None,
+            "server_to_first_photo_s": server,
+        }
+        print(f"[STARTUP] first photo: boot+{boot}s / server+{server}s")
+        BUS.publish({"ch": "first_photo", "first_photo": STARTUP["first_photo"]})
+    return {"ok": True, **STARTUP["first_photo"]}
 
 
 # ==== 実ファイル配信 =========================================================
-@app.get("/files")
-async def serve_file(path: str):
-    if os.path.exists(path) and os.path.isfile(path):
-        return FileResponse(path)
-    return JSONResponse({"error": "Not found"}, status_code=404)
+@app.get("/media/{media_id}")
+async def serve_media(media_id: str, size: str = ""):
+    """
+    プレイリストの ID で配信する。許可リスト（今の選択フォルダ配下の画像）を1回引くだけで、
+    パスの正規化はしない。派生画像はインデックスの size / mtime で引く。
+    オリジナルは stat し直して配る（インデックスの後でファイルが変わっていたら、Content-Length と
+    ETag が合わなくなるので。その時はプレイリストを作り直させて、新しい版 v を配る）。
+    URL の v（版）はキャッシュを分けるためだけのもので、ここでは見ない。
+    サーバが http.response.pathsend 拡張を持っていれば Starlette がそのまま sendfile に渡す。
+    """
+    global PLAYLIST_CACHE_AT
+    hit = _MEDIA.get(media_id)
+    if hit is None:
+        # 複数ワーカー時: プレイリストを返したのが別のワーカーなら、こちらの許可リストが古い
+        hit = await asyncio.to_thread(_media_lookup_fresh, media_id)
+    if hit is None:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    path, e = hit
+    if size:
+        derived = derivatives.cached(path, e.size, e.mtime_ns, size)
+        if derived is None and MOUNTS.is_healthy(path):
+            derived = await asyncio.to_thread(derivatives.get, path, size)
+        if derived:
+            return FileResponse(derived, media_type="image/jpeg")
+    if not MOUNTS.is_healthy(path):
+        return JSONResponse({"error": "Storage unavailable"}, status_code=503)
+    try:
+        st = await asyncio.to_thread(os.stat, path)
+    except OSError:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    if not e.matches(st):
+        print(f"[MEDIA] {media_id}: file changed since indexing, rebuilding playlist")
+        PLAYLIST_CACHE_AT = 0.0
+    return FileResponse(path, stat_result=st)
+
+MEDIA_MISS_REBUILD_SEC = 5.0  # 未知の ID で作り直すのはこの間隔まで（でたらめな ID 対策）
+
+def _media_lookup_fresh(media_id: str) -> Optional[Tuple[str, photo_index.Entry]]:
+    if PLAYLIST_CACHE_KEY != _current_playlist_key():
+        _get_playlist()
+    elif time.monotonic() - PLAYLIST_CACHE_AT > MEDIA_MISS_REBUILD_SEC:
+        _rebuild_playlist()
+    return _MEDIA.get(media_id)
+
+# ==== サムネイル / スプライトシート ===========================================
+THUMB_SHEET_LIMIT = 60        # 1枚のシートに並べる最大数
+
+def _thumb_page(path: str, sort: str, cursor: Optional[str], limit: int) -> Dict[str, Any]:
+    lst = DIRSTATS.listing(path)
+    rows = []
+    for name, size, mtime_ns in lst.images:
+        p = os.path.join(path, name)
+        ts = _index_ts(p, size, mtime_ns)
+        rows.append({"kind": "image", "name": name, "path": p,
+                     "date": ts if ts is not None else mtime_ns / 1e9, "size": size, "count": 1})
+    page, next_cursor = dirstats.paginate(rows, sort, cursor, min(limit, THUMB_SHEET_LIMIT))
+    meta = derivatives.sheet([r["path"] for r in page]) if page else None
+    if page and meta is None:
+        raise RuntimeError("sheet unavailable")
+    out: Dict[str, Any] = dict(meta or {"items": []})
+    if meta:
+        out["url"] = f"/thumbs/sheet/{meta['key']}.jpg"
+    out["total"] = len(lst.images)
+    out["next_cursor"] = next_cursor
+    return out
+
+@app.get("/api/thumbs/sheet")
+async def thumbs_sheet(path: str, sort: str = "name", cursor: Optional[str] = None,
+                       limit: int = THUMB_SHEET_LIMIT):
+    """
+    フォルダ直下の画像のサムネイルを1枚のスプライトシートにまとめ、座標マップを返す。
+    画像本体は url（/thumbs/sheet/<key>.jpg、内容で名前が決まるので長期キャッシュ可）。
+    sort / cursor は /api/fs/list と同じ。
+    """
+    if not MOUNTS.is_healthy(path):
+        return JSONResponse({"error": "Storage unavailable"}, status_code=503)
+    if not os.path.isdir(path):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    try:
+        return await asyncio.to_thread(_thumb_page, path, sort, cursor, limit)
+    except Exception as e:
+        print("[THUMB] sheet failed:", e)
+        return JSONResponse({"error": "Thumbnail unavailable"}, status_code=500)
+
+@app.get("/thumbs/sheet/{name}")
+async def thumbs_sheet_image(name: str):
+    p = derivatives.sheet_path(name[:-4]) if name.endswith(".jpg") else None
+    if not p:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return FileResponse(p, media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 # ==== Server-Sent Events (即時反映: 心拍 + 再接続短縮) =======================
 @app.get("/api/events")
-async def sse(request: Request):
+async def sse(request: Request, frame: Optional[str] = None):
+    """frame を付けるとそのフレームのセッションとして購読する（フレーム宛てのイベントも届く）"""
+    if frame is not None and not frames.valid_name(frame):
+        return JSONResponse({"error": "Invalid frame name"}, status_code=400)
+
     async def event_stream():
         yield "retry: 1000\n\n"  # 再接続間隔 1s
         q: asyncio.Queue = asyncio.Queue()
-        subscribers.append(q)
+        subscribers[q] = frame
+        if frame:
+            await asyncio.to_thread(FRAMES.touch, frame)
         try:
             while True:
                 try:
@@ -1014,13 +1951,12 @@ async def sse(request: Request):
                 except asyncio.TimeoutError:
                     # コメント行で心拍（接続維持）
                     yield ": ping\n\n"
+                    if frame:
+                        await asyncio.to_thread(FRAMES.touch, frame)
                 if await request.is_disconnected():
                     break
         finally:
-            try:
-                subscribers.remove(q)
-            except ValueError:
-                pass
+            subscribers.pop(q, None)
     headers = {
         "Cache-Control": "no-cache",
         "Connection": "keep-alive",
@@ -1028,12 +1964,33 @@ async def sse(request: Request):
     }
     return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
 
+async def sse_probe(request: Request):
+    """
+    負荷試験（loadtest.py）用: 受け取った seq / t をそのまま SSE "probe" で全員に送る。
+    受信側は到着時刻との差で配信遅延、届かなかった seq で取りこぼしを数える。
+    誰でも全フレームに送れてしまうので、RASPIFRAME_LOADTEST=1 で起動した時だけ登録する。
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Invalid probe"}, status_code=400)
+    await _notify_all({"type": "probe", "seq": body.get("seq"), "t": body.get("t")})
+    return {"ok": True, "local_streams": len(subscribers)}
+
+if LOADTEST:
+    app.post("/api/events/probe")(sse_probe)
+
 # ==== Rotary 用 WebSocket ====================================================
-ws_clients: List[WebSocket] = []
+# WebSocket -> フレーム名（ロータリーの中継は同じフレームの中だけ）
+ws_clients: Dict[WebSocket, Optional[str]] = {}
 
-async def _ws_broadcast(text: str) -> None:
+async def _ws_broadcast(text: str, frame: Optional[str] = None) -> None:
     dead: List[WebSocket] = []
-    for ws in ws_clients:
+    for ws, f in list(ws_clients.items()):
+        if f != frame:
+            continue
         try:
             await ws.send_text(text)
         except Exception:
@@ -1044,28 +2001,184 @@ async def _ws_broadcast(text: str) -> None:
                 await ws.close()
             except Exception:
                 pass
-            ws_clients.remove(ws)
+            ws_clients.pop(ws, None)
 
 @app.websocket("/ws/rotary")
-async def websocket_rotary(ws: WebSocket):
+async def websocket_rotary(ws: WebSocket, frame: Optional[str] = None):
+    """frame を付けると同じフレームのプレイヤーにだけ中継する（rotary.py は ROTARY_WS_URL に付ける）"""
+    if frame is not None and not frames.valid_name(frame):
+        await ws.close(code=1008)
+        return
     await ws.accept()
-    ws_clients.append(ws)
+    ws_clients[ws] = frame
     try:
         while True:
             # rotary.py からの "rotary_left" / "rotary_right" / "rotary_push" を受信
+            # （トレース付きの JSON なら中継の直前の時刻を足して送る）
             msg = await ws.receive_text()
-            # 他のクライアント（主に player.html）へ転送
-            for client in ws_clients:
-                if client is not ws:
+            recv = time.monotonic()
+            kind, traced = latency.parse_rotary(msg)
+            local = False
+            if traced is not None and isinstance(traced.get("trace"), dict):
+                # 別のマシンの rotary.py なら monotonic どうしを引き算しない（プレイヤーの報告にも boot で伝える）
+                tr = traced["trace"]
+                local = latency.same_clock(tr, ws.client.host if ws.client else None)
+                tr["boot"] = latency.BOOT_ID if local else None
+                tr["relayed"] = time.monotonic()
+                msg = json.dumps(traced, separators=(",", ":"))
+            # 他のクライアント（主に player.html）へ転送。別のワーカーにつながっている分は Bus で
+            for client, f in list(ws_clients.items()):
+                if client is not ws and f == frame:
                     try:
                         await client.send_text(msg)
                     except Exception:
                         pass
+            BUS.publish({"ch": "ws", "text": msg, "frame": frame})
+            if traced is not None:
+                _record_rotary_latency(latency.server_samples(traced, recv, (time.monotonic() - recv) * 1000.0, local))
+            # サーバ側スケジューラで再生しているフレームなら、回転はサーバで処理する
+            if LEADER.is_leader:
+                SCHED.rotary(frame, kind)
     except WebSocketDisconnect:
         pass
     finally:
-        if ws in ws_clients:
-            ws_clients.remove(ws)
+        ws_clients.pop(ws, None)
+
+# ==== ロータリーの遅延計測 ====================================================
+# 区間ごとのヒストグラム（latency.py）。どのワーカーで受けた分も Bus で全ワーカーに記録する
+ROTARY_LATENCY = latency.StageLatency()
+
+def _record_rotary_latency(samples: Dict[str, float]) -> None:
+    kept = ROTARY_LATENCY.record(samples)
+    if kept:
+        BUS.publish({"ch": "rtrace", "samples": kept})
+
+@app.post("/api/rotary/trace")
+async def rotary_trace(request: Request):
+    """プレイヤーがトレース付きの回転を描画し終えた時の報告（エコーしたトレース + ブラウザ内の区間）"""
+    now = time.monotonic()
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Invalid report"}, status_code=400)
+    _record_rotary_latency(latency.player_samples(body, now))
+    return {"ok": True}
+
+@app.get("/api/rotary/latency")
+async def rotary_latency():
+    return ROTARY_LATENCY.snapshot()
+
+@app.delete("/api/rotary/latency")
+async def rotary_latency_reset():
+    ROTARY_LATENCY.reset()
+    BUS.publish({"ch": "rtrace", "reset": True})
+    return {"ok": True}
+
+# ==== フリート（フレームごとのセッション） ====================================
+# 他の Pi のプレイヤーは ?frame=<名前> を付けてこのサーバにつなぐ。
+# 設定の上書きは POST /api/config?frame=<名前>、再生位置はプレイヤーが報告する。
+@app.get("/api/frames")
+async def list_frames():
+    streams = Counter(f for f in subscribers.values() if f)
+    return {"frames": [{**fr, "streams": streams.get(fr["name"], 0)} for fr in FRAMES.frames()]}
+
+@app.get("/api/frames/{name}")
+async def get_frame(name: str):
+    fr = FRAMES.get(name)
+    if fr is None:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return fr
+
+@app.post("/api/frames/{name}/cursor")
+async def set_frame_cursor(name: str, request: Request):
+    """プレイヤーが今表示している写真（再起動・再接続時にそこから再開する）"""
+    if not frames.valid_name(name):
+        return JSONResponse({"error": "Invalid frame name"}, status_code=400)
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    mid = body.get("id")
+    if not isinstance(mid, str) or len(mid) > 32:
+        return JSONResponse({"error": "id is required"}, status_code=400)
+    await asyncio.to_thread(_note_shown, name, {"id": mid, "idx": body.get("idx")})
+    _note_fade(request, body.get("fade_ms"))
+    return {"ok": True}
+
+@app.delete("/api/frames/{name}")
+async def delete_frame(name: str):
+    if not await asyncio.to_thread(FRAMES.remove, name):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return {"ok": True}
+
+# ==== サーバ側の再生スケジューラ（server_scheduler: true の時） ================
+# 再生位置とタイミングはリーダーのワーカーが持ち、SSE の "show" でプレイヤーに送る。
+def _sched_items(frame: Optional[str]) -> Tuple[Any, List[Dict[str, Any]]]:
+    pl = _get_playlist()
+    cfg = FRAMES.effective(CONFIG, frame)
+    items, mode = _lineup(pl, frame)
+    # least_recent は表示のたびに順番が変わるので、作り直すのはプレイリスト・シード・条件・日付が変わった時だけ
+    key = (pl.get("generation"), ordering.normalize(cfg.get("order")), ORDER.seed,
+           json.dumps(query.normalize(cfg.get("playlist_mode")), sort_keys=True, default=str), _today())
+    return key, items
+
+def _sched_settings(frame: Optional[str]) -> Dict[str, Any]:
+    return FRAMES.effective(CONFIG, frame)
+
+async def _sched_send(frame: Optional[str], message: Dict[str, Any]) -> None:
+    await _notify_all(message, to=[frame])
+
+def _warm_upcoming(paths: List[str]) -> None:
+    """これから出す数枚の表示用派生画像を先に作る（作成済みならすぐ返る）"""
+    for p in paths:
+        if MOUNTS.is_healthy(p):
+            derivatives.get(p, "display", pace=lambda: GOVERNOR.pace("prefetch"))
+
+def _note_shown(frame: Optional[str], cursor: Dict[str, Any]) -> None:
+    """表示した写真を記録（frames.json / order.json に間引いて書くので、イベントループの外で呼ぶ）"""
+    if frame:
+        FRAMES.set_cursor(frame, cursor)
+    # 表示の記録は今のプレイリストにある写真だけ（知らない ID で order.json を増やさない）
+    if cursor["id"] in _MEDIA:
+        ORDER.mark_shown(cursor["id"])
+
+def _sched_on_show(frame: Optional[str], item: Dict[str, Any],
+                   upcoming: List[Dict[str, Any]]) -> None:
+    _spawn(asyncio.to_thread(_note_shown, frame, {"id": item["id"]}))
+    if frame is None:
+        # 名前の無いフレーム＝この Pi のキオスク（名前付きはよその Pi のことが多い）
+        _note_fade(None, _sched_settings(frame).get("fade_ms"))
+    _spawn(asyncio.to_thread(_warm_upcoming, [it["path"] for it in upcoming]))
+
+def _sched_resume(frame: Optional[str]) -> Optional[str]:
+    fr = FRAMES.get(frame) if frame else None
+    return ((fr or {}).get("cursor") or {}).get("id")
+
+SCHED = scheduler.Scheduler(items=_sched_items, settings=_sched_settings, send=_sched_send,
+                            on_show=_sched_on_show, resume=_sched_resume)
+
+@app.post("/api/scheduler/attach")
+async def scheduler_attach(frame: Optional[str] = None, resend: bool = False):
+    """
+    server_scheduler のプレイヤーが SSE 接続時（resend=1）と1分ごとに呼ぶ（リーダーのワーカーで動く）。
+    セッションが無ければ作る。resend なら今の1枚を送り直す。1分ごとの合図はセッションを生かすだけ
+    """
+    if frame is not None and not frames.valid_name(frame):
+        return JSONResponse({"error": "Invalid frame name"}, status_code=400)
+    if LEADER.is_leader:
+        SCHED.attach(frame, resend)
+    else:
+        BUS.publish({"ch": "sched", "frame": frame, "resend": resend})
+    return {"ok": True}
+
+@app.get("/api/scheduler")
+async def scheduler_status():
+    sessions = SCHED.sessions() if LEADER.is_leader else SHARED.read().get("scheduler", [])
+    return {"sessions": sessions}
 
 # ==== システム終了API ========================================================
 @app.post("/api/shutdown")
@@ -1078,9 +2191,72 @@ async def shutdown():
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+# ==== メトリクス ==============================================================
+# 各所から報告・集計される数値をまとめて /api/metrics で返す
+METRICS: Dict[str, Any] = {}
+
+@app.post("/api/metrics/sw_cache")
+async def metrics_sw_cache(request: Request):
+    """player.html が Service Worker のキャッシュ統計を定期的に送ってくる"""
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Invalid report"}, status_code=400)
+    # 数えられない値（文字列・配列・負の数など）は None にして捨てる
+    counts: Dict[str, Optional[int]] = {}
+    for k in ("hits", "misses", "errors", "evictions", "stale_api", "bytes", "entries", "quota"):
+        try:
+            v = int(body.get(k))
+        except (TypeError, ValueError, OverflowError):
+            v = None
+        counts[k] = v if v is not None and v >= 0 else None
+    hits, misses = counts["hits"] or 0, counts["misses"] or 0
+    METRICS["sw_cache"] = {
+        **counts,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        "reported_at": time.time(),
+    }
+    return {"ok": True}
+
+def _rss_mb() -> Optional[float]:
+    """このワーカーの常駐メモリ（/proc/self/status の VmRSS）"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except Exception:
+        pass
+    return None
+
+@app.get("/api/metrics")
+async def metrics():
+    return {
+        **METRICS,
+        "startup": STARTUP,
+        "index_entries": len(INDEX),
+        "index_packs": {"pending": sorted(_PACK_PENDING), "verified": sorted(_PACK_VERIFIED)},
+        "bursts": dict(BURSTS),
+        "order": ORDER.stats(),
+        "rotary_latency": ROTARY_LATENCY.snapshot(full=False),
+        "governor": GOVERNOR.snapshot(),
+        "mounts": MOUNTS.snapshot(),
+        "worker": {"pid": os.getpid(), "leader": LEADER.is_leader,
+                   "peers": len(BUS.peers()), "bus_dropped": BUS.dropped,
+                   "rss_mb": _rss_mb()},
+    }
+
 # ==== 静的ファイルとルート ===================================================
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+@app.get("/sw.js")
+async def service_worker():
+    """スコープを / にするためルートから配る（/media/ を横取りできるように）"""
+    return FileResponse(os.path.join(STATIC_DIR, "sw.js"), media_type="application/javascript",
+                        headers={"Service-Worker-Allowed": "/", "Cache-Control": "no-cache"})
+
 @app.get("/")
 async def root():
     return FileResponse(os.path.join(STATIC_DIR, "settings.html"))
@@ -0,0 +1,313 @@
+# ~/raspiframe/app/mounts.py
+"""
+マウント管理（NAS の CIFS マウントの健康状態を見張る）。
+
+- マウント表は /proc/self/mountinfo から読む（mountpoint コマンドを fork しない）
+- 健康診断は使い捨てスレッドで readdir してタイムアウト付きで待つ。
+  眠った NAS で固まったプローブは放置し、戻ってくるまで次のプローブは出さない
+- 固まった（stale）マウントは is_healthy() が False を返すので、
+  スキャンやファイル配信はそこに触らない
+- stale / 外れたマウントはバックオフ付きで裏で再マウントする
+"""
+import os
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+PROBE_INTERVAL_SEC = 15.0     # 健康診断の間隔
+PROBE_TIMEOUT_SEC = 3.0       # これ以上 readdir が返らなければ stale
+REMOUNT_BACKOFF_MIN = 5.0
+REMOUNT_BACKOFF_MAX = 300.0
+
+# 状態
+OK = "ok"
+STALE = "stale"
+UNMOUNTED = "unmounted"
+REMOUNTING = "remounting"
+
+
+def _unescape(s: str) -> str:
+    """mountinfo はスペース等を \\040 のような8進でエスケープする"""
+    if "\\" not in s:
+        return s
+    out, i = [], 0
+    while i < len(s):
+        if s[i] == "\\" and len(s[i+1:i+4]) == 3 and s[i+1:i+4].isdigit():
+            out.append(chr(int(s[i+1:i+4], 8)))
+            i += 4
+        else:
+            out.append(s[i])
+            i += 1
+    return "".join(out)
+
+
+def parse_mountinfo(text: str) -> Dict[str, Dict[str, str]]:
+    """
+    mountinfo の本文をパースして mount_point -> {"fstype", "source", "options"} を返す。
+      36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+    """
+    table: Dict[str, Dict[str, str]] = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 10:
+            continue
+        try:
+            sep = parts.index("-", 6)
+        except ValueError:
+            continue
+        mp = _unescape(parts[4])
+        table[mp] = {
+            "fstype": parts[sep + 1],
+            "source": _unescape(parts[sep + 2]) if len(parts) > sep + 2 else "",
+            "options": parts[5],
+        }
+    return table
+
+
+def read_mountinfo(path: str = MOUNTINFO) -> Dict[str, Dict[str, str]]:
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            return parse_mountinfo(f.read())
+    except Exception:
+        return {}
+
+
+# 中身が写真になりえない疑似ファイルシステム（フォルダ統計などで辿らない）
+PSEUDO_FSTYPES = frozenset({
+    "proc", "sysfs", "devtmpfs", "devpts", "cgroup", "cgroup2", "securityfs", "debugfs",
+    "tracefs", "configfs", "fusectl", "mqueue", "hugetlbfs", "pstore", "bpf", "binfmt_misc",
+    "efivarfs", "autofs", "rpc_pipefs", "nsfs",
+})
+
+
+def pseudo_mount_points(table: Optional[Dict[str, Dict[str, str]]] = None) -> List[str]:
+    """疑似ファイルシステムのマウントポイント（/proc, /sys, /dev など）"""
+    if table is None:
+        table = read_mountinfo()
+    return sorted(mp for mp, row in table.items() if row["fstype"] in PSEUDO_FSTYPES)
+
+
+def is_mounted(mount_point: str, table: Optional[Dict[str, Dict[str, str]]] = None) -> bool:
+    """mountpoint -q 相当（fork しない）"""
+    if table is None:
+        table = read_mountinfo()
+    return mount_point.rstrip(os.sep) in table
+
+
+def _probe(path: str, result: Dict[str, Any]) -> None:
+    """実際にサーバまで行く操作（readdir 1件）。固まったらこのスレッドごと放置される"""
+    try:
+        with os.scandir(path) as it:
+            next(it, None)
+        result["ok"] = True
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = str(e)
+
+
+class MountManager:
+    """
+    管理対象のマウントポイントを見張るバックグラウンドスレッド。
+    remount(mount_point) -> bool は再マウントを実際に行う関数（呼び出し側が用意）。
+    on_change(mount_point, state, info) は状態が変わった時に監視スレッドから呼ばれる。
+    """
+
+    def __init__(self,
+                 remount: Optional[Callable[[str], bool]] = None,
+                 on_change: Optional[Callable[[str, str, Dict[str, Any]], None]] = None) -> None:
+        self.remount_cb = remount
+        self.on_change = on_change
+        self._mounts: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- 管理対象 ----
+    def manage(self, mount_point: str, auto_remount: bool = True) -> None:
+        mp = mount_point.rstrip(os.sep)
+        with self._lock:
+            if mp not in self._mounts:
+                self._mounts[mp] = {
+                    "state": OK if is_mounted(mp) else UNMOUNTED,
+                    "auto_remount": auto_remount,
+                    "since": time.time(),
+                    "failures": 0,
+                    "next_retry": 0.0,
+                    "probe": None,        # 進行中のプローブスレッド
+                    "error": None,
+                }
+            else:
+                self._mounts[mp]["auto_remount"] = auto_remount
+        self._wake.set()
+
+    def unmanage(self, mount_point: str) -> None:
+        with self._lock:
+            self._mounts.pop(mount_point.rstrip(os.sep), None)
+
+    def _owner(self, path: str) -> Optional[str]:
+        """path を含む管理対象マウントポイント（最長一致）"""
+        best = None
+        for mp in self._mounts:
+            if path == mp or path.startswith(mp + os.sep):
+                if best is None or len(mp) > len(best):
+                    best = mp
+        return best
+
+    def is_healthy(self, path: str) -> bool:
+        """path が固まったマウント配下なら False（管理対象外のパスは常に True）"""
+        with self._lock:
+            mp = self._owner(path)
+            return mp is None or self._mounts[mp]["state"] == OK
+
+    def state(self, mount_point: str) -> Optional[str]:
+        with self._lock:
+            m = self._mounts.get(mount_point.rstrip(os.sep))
+            return m["state"] if m else None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"mount_point": mp, "state": m["state"], "since": m["since"],
+                 "failures": m["failures"], "error": m["error"]}
+                for mp, m in self._mounts.items()
+            ]
+
+    def mirror(self, snapshot: List[Dict[str, Any]]) -> None:
+        """
+        他のプロセス（リーダーのワーカー）の snapshot() を写す。監視スレッドを動かさない
+        ワーカーでも is_healthy() / state() が同じ答えを返すように。
+        """
+        with self._lock:
+            old = self._mounts
+            self._mounts = {}
+            for s in snapshot:
+                mp = s["mount_point"]
+                m = old.get(mp) or {"auto_remount": False, "next_retry": 0.0, "probe": None}
+                m.update(state=s["state"], since=s["since"],
+                         failures=s["failures"], error=s["error"])
+                self._mounts[mp] = m
+
+    # ---- 監視ループ ----
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mount-manager", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def _set_state(self, mp: str, state: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            m = self._mounts.get(mp)
+            if m is None or m["state"] == state:
+                return
+            m["state"] = state
+            m["since"] = time.time()
+            m["error"] = error
+            info = {"failures": m["failures"], "error": error}
+        print(f"[MOUNT] {mp}: {state}" + (f" ({error})" if error else ""))
+        if self.on_change:
+            try:
+                self.on_change(mp, state, info)
+            except Exception as e:
+                print(f"[MOUNT] on_change error: {e}")
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            table = read_mountinfo()
+            with self._lock:
+                targets = list(self._mounts.keys())
+            for mp in targets:
+                try:
+                    self._check(mp, table)
+                except Exception as e:
+                    print(f"[MOUNT] check error {mp}: {e}")
+            self._wake.wait(PROBE_INTERVAL_SEC)
+            self._wake.clear()
+
+    def _check(self, mp: str, table: Dict[str, Dict[str, str]]) -> None:
+        with self._lock:
+            m = self._mounts.get(mp)
+            if m is None:
+                return
+            hung = m["probe"]
+            if m["state"] == REMOUNTING:
+                return
+        # 前回のプローブがまだ戻らない → stale のまま（新しいスレッドは積まない）
+        if hung is not None and hung.is_alive():
+            self._set_state(mp, STALE, "probe still blocked")
+            self._maybe_remount(mp, lazy=True)
+            return
+
+        if mp not in table:
+            self._set_state(mp, UNMOUNTED)
+            self._maybe_remount(mp, lazy=False)
+            return
+
+        result: Dict[str, Any] = {}
+        t = threading.Thread(target=_probe, args=(mp, result), name=f"probe:{mp}", daemon=True)
+        t.start()
+        t.join(PROBE_TIMEOUT_SEC)
+        if t.is_alive():
+            with self._lock:
+                if mp in self._mounts:
+                    self._mounts[mp]["probe"] = t
+            self._set_state(mp, STALE, f"no response in {PROBE_TIMEOUT_SEC:.0f}s")
+            self._maybe_remount(mp, lazy=True)
+            return
+        with self._lock:
+            if mp in self._mounts:
+                self._mounts[mp]["probe"] = None
+        if result.get("ok"):
+            with self._lock:
+                if mp in self._mounts:
+                    self._mounts[mp]["failures"] = 0
+                    self._mounts[mp]["next_retry"] = 0.0
+            self._set_state(mp, OK)
+        else:
+            self._set_state(mp, STALE, result.get("error"))
+            self._maybe_remount(mp, lazy=True)
+
+    def _maybe_remount(self, mp: str, lazy: bool) -> None:
+        with self._lock:
+            m = self._mounts.get(mp)
+            if m is None or not m["auto_remount"] or self.remount_cb is None:
+                return
+            if time.monotonic() < m["next_retry"]:
+                return
+            m["failures"] += 1
+            delay = min(REMOUNT_BACKOFF_MIN * (2 ** (m["failures"] - 1)), REMOUNT_BACKOFF_MAX)
+            m["next_retry"] = time.monotonic() + delay
+        self._set_state(mp, REMOUNTING)
+        threading.Thread(target=self._remount, args=(mp, lazy), name=f"remount:{mp}",
+                         daemon=True).start()
+
+    def _remount(self, mp: str, lazy: bool) -> None:
+        if lazy:
+            # 固まった CIFS は通常の umount も固まるので lazy で切り離す
+            try:
+                subprocess.run(['sudo', 'umount', '-l', mp], capture_output=True, timeout=10)
+            except Exception as e:
+                print(f"[MOUNT] lazy umount failed {mp}: {e}")
+            # 切り離したので、固まっていたプローブはもう待たない
+            with self._lock:
+                if mp in self._mounts:
+                    self._mounts[mp]["probe"] = None
+        try:
+            ok = bool(self.remount_cb(mp))
+        except Exception as e:
+            print(f"[MOUNT] remount error {mp}: {e}")
+            ok = False
+        if ok:
+            self._set_state(mp, OK)
+        else:
+            self._set_state(mp, UNMOUNTED, "remount failed")
+        self._wake.set()
@@ -0,0 +1,268 @@
+# ~/raspiframe/app/ordering.py
+"""
+プレイリストの並び順。インデックス由来のキャッシュ（ts 昇順の画像リスト）の上で並べ替えるだけで、
+ライブラリにもディスクにも触らない。
+
+- date         : 撮影日時順（キャッシュがもともと ts 昇順なのでそのまま返す）
+- random       : シード付きシャッフル。写真ごとに hash(seed, id) の順位を持ち、その順に並べる。
+                 シードは data/order.json に保存するので、再起動・再接続・別のワーカーでも同じ順番。
+                 写真が増減しても残りの写真の前後関係は変わらない（1周の途中で重複も取りこぼしも出ない）
+- shuffle_day  : 日付の順番はそのまま、同じ日の中だけシャッフル（同じシード）
+- least_recent : 最後に表示してから長い順（未表示が先頭）。写真ごとに「何回目の表示だったか」の
+                 通し番号（int）だけを持つ
+
+並べた結果は（元のリスト・シード）が同じ間は使い回す。プレイリストが作り直されて元のリストが
+変わっても、前の並びを新しいリストに写して増えた分だけ差し込む（並べ直さない。O(n)）。
+least_recent は並びを dict（挿入順）で持ち、表示されたら末尾へ動かすだけ（リクエストごとに並べない）。
+"""
+import hashlib
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+ORDER_VERSION = 1
+ORDERS = ("date", "random", "shuffle_day", "least_recent")
+SAVE_INTERVAL_SEC = 30.0      # 表示の記録だけの変更はこの間隔で書く
+LEAST_RECENT_SLOTS = 4        # least_recent の並びを持っておく元リストの数（フレームごとの絞り込みなど）
+
+
+def _carry(prev: List[Dict[str, Any]], images: List[Dict[str, Any]],
+           key: Callable[[Dict[str, Any]], Any]) -> List[Dict[str, Any]]:
+    """
+    key で並んでいる prev（前のプレイリストの項目）を images の項目に写す。
+    prev に無かった写真だけ key で並べて差し込み、消えた写真は落とす
+    """
+    by_id = {it["id"]: it for it in images}
+    kept = [by_id[it["id"]] for it in prev if it["id"] in by_id]
+    if len(kept) == len(by_id):
+        return kept
+    seen = {it["id"] for it in kept}
+    new = sorted((it for it in images if it["id"] not in seen), key=key)
+    return list(heapq.merge(kept, new, key=key))
+
+
+def normalize(order: Optional[str]) -> str:
+    o = (order or "date").lower()
+    return o if o in ORDERS else "date"
+
+
+class Ordering:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.seed = 0
+        self.seed_at = 0.0
+        self._lock = threading.RLock()
+        self._tick = 0                         # 表示の通し番号
+        self._shown: Dict[str, int] = {}       # id -> 最後に表示した時の通し番号
+        self._rank: Dict[str, int] = {}        # id -> 今のシードでの順位キー
+        self._memo: Dict[str, Tuple[List[Dict[str, Any]], int, List[Dict[str, Any]]]] = {}
+        # id(元リスト) -> [元リスト, シード, id -> 項目（least_recent の順）, 他のワーカーで表示が変わった id]
+        self._lr: "OrderedDict[int, list]" = OrderedDict()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._file_mtime_ns: Optional[int] = None
+
+    # ---- 永続化 ----
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[ORDER] load failed: {e}")
+            return None
+        if data.get("version") != ORDER_VERSION:
+            return None
+        return data
+
+    def load(self) -> None:
+        mtime_ns = self._file_mtime()
+        data = self._read_file()
+        with self._lock:
+            if data is None:
+                # 初回はシードを決めてすぐ書く（他のワーカーと揃えるため）
+                self._set_seed(random.getrandbits(32))
+                self._file_mtime_ns = None
+                fresh = True
+            else:
+                self._set_seed(int(data.get("seed") or 0), float(data.get("seed_at") or 0.0))
+                self._tick = int(data.get("tick") or 0)
+                self._shown = {k: int(v) for k, v in (data.get("shown") or {}).items()}
+                self._file_mtime_ns = mtime_ns
+                self._dirty = False
+                fresh = False
+        if fresh:
+            self.save(force=True)
+
+    def merge_from_disk(self) -> None:
+        """他のワーカーが書いていたら取り込む（新しいシードが勝ち、表示の記録は新しい方）"""
+        mtime_ns = self._file_mtime()
+        if mtime_ns is None or mtime_ns == self._file_mtime_ns:
+            return
+        data = self._read_file()
+        with self._lock:
+            if data is not None:
+                if float(data.get("seed_at") or 0.0) > self.seed_at:
+                    self._set_seed(int(data.get("seed") or 0), float(data["seed_at"]))
+                self._tick = max(self._tick, int(data.get("tick") or 0))
+                shown = self._shown
+                changed = set()
+                for k, v in (data.get("shown") or {}).items():
+                    if v > shown.get(k, 0):
+                        shown[k] = v
+                        changed.add(k)
+                if changed:
+                    # least_recent の並びは次に使う時にその分だけ直す
+                    for slot in self._lr.values():
+                        slot[3] |= changed
+            self._file_mtime_ns = mtime_ns
+
+    def save(self, force: bool = False) -> None:
+        self.merge_from_disk()
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            data = {"version": ORDER_VERSION, "seed": self.seed, "seed_at": self.seed_at,
+                    "tick": self._tick, "shown": self._shown}
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp, self.path)
+                self._file_mtime_ns = self._file_mtime()
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            except Exception as e:
+                print(f"[ORDER] save failed: {e}")
+
+    def maybe_save(self) -> None:
+        if self._dirty and time.monotonic() - self._saved_at > SAVE_INTERVAL_SEC:
+            self.save()
+
+    # ---- シード ----
+    def _set_seed(self, seed: int, at: Optional[float] = None) -> None:
+        self.seed = seed
+        self.seed_at = at if at is not None else time.time()
+        self._rank = {}
+        self._memo = {}
+        self._lr = OrderedDict()
+
+    def reshuffle(self, seed: Optional[int] = None) -> int:
+        """新しいシードで並べ直す（random / shuffle_day の順番が変わる）"""
+        with self._lock:
+            self._set_seed(seed if seed is not None else random.getrandbits(32))
+            self._dirty = True
+        self.save()
+        print(f"[ORDER] reshuffled (seed {self.seed})")
+        return self.seed
+
+    def _ranks(self, images: List[Dict[str, Any]]) -> Dict[str, int]:
+        """id -> 順位キー（まだ計算していない ID の分だけ hash する）"""
+        rank = self._rank
+        key = self.seed.to_bytes(8, "big")
+        for it in images:
+            mid = it["id"]
+            if mid not in rank:
+                h = hashlib.blake2b(mid.encode("ascii", "replace"), digest_size=6, key=key)
+                rank[mid] = int.from_bytes(h.digest(), "big")
+        return rank
+
+    # ---- 表示の記録 ----
+    def mark_shown(self, mid: str) -> None:
+        with self._lock:
+            self._tick += 1
+            self._shown[mid] = self._tick
+            self._dirty = True
+            # 一番新しく表示した写真なので、least_recent では末尾
+            for slot in self._lr.values():
+                od = slot[2]
+                if mid in od:
+                    od[mid] = od.pop(mid)
+        self.maybe_save()
+
+    def last_shown(self, mid: str) -> int:
+        return self._shown.get(mid, 0)
+
+    # ---- 並べ替え ----
+    def arrange(self, images: List[Dict[str, Any]], order: Optional[str]) -> List[Dict[str, Any]]:
+        """images は ts 昇順のキャッシュ（書き換えない）。並べたリストを返す（date はそのまま）"""
+        order = normalize(order)
+        if order == "date":
+            return images
+        with self._lock:
+            if order == "least_recent":
+                return self._least_recent(images)
+            return self._memoized(images, order)
+
+    def _memoized(self, images: List[Dict[str, Any]], order: str) -> List[Dict[str, Any]]:
+        memo = self._memo.get(order)
+        if memo is not None and memo[0] is images and memo[1] == self.seed:
+            return memo[2]
+        if order == "random":
+            rank = self._ranks(images)
+            key = lambda it: rank[it["id"]]
+            if memo is not None and memo[1] == self.seed:
+                out = _carry(memo[2], images, key)
+            else:
+                out = sorted(images, key=key)
+        else:
+            out = self._shuffle_day(images)
+        self._memo[order] = (images, self.seed, out)
+        return out
+
+    def _shuffle_day(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # ts 昇順なので同じ日は連続している。日ごとの塊の中だけ順位で並べる
+        rank = self._ranks(images)
+        out: List[Dict[str, Any]] = []
+        start = 0
+        n = len(images)
+        for i in range(1, n + 1):
+            if i == n or images[i]["day_key"] != images[start]["day_key"]:
+                out.extend(sorted(images[start:i], key=lambda it: rank[it["id"]]))
+                start = i
+        return out
+
+    def _least_recent(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # 通し番号が小さい（古い・未表示）順。同じ番号（未表示どうし）はシード順
+        slot = self._lr.get(id(images))
+        if slot is not None and slot[0] is images and slot[1] == self.seed and not slot[3]:
+            self._lr.move_to_end(id(images))
+            return list(slot[2].values())
+        shown = self._shown
+        rank = self._ranks(images)
+        key = lambda it: (shown.get(it["id"], 0), rank[it["id"]])
+        if slot is None or slot[0] is not images or slot[1] != self.seed:
+            # 元リストが変わった（プレイリストの作り直しなど）: 直近の並びを写す。無ければ並べる
+            prev = next(reversed(self._lr.values()), None)
+            if prev is not None and prev[1] == self.seed and not prev[3]:
+                out = _carry(list(prev[2].values()), images, key)
+            else:
+                out = sorted(images, key=key)
+            slot = [images, self.seed, {it["id"]: it for it in out}, set()]
+            self._lr[id(images)] = slot
+            while len(self._lr) > LEAST_RECENT_SLOTS:
+                self._lr.popitem(last=False)
+        elif slot[3]:
+            # 他のワーカーで表示された写真だけ抜いて、並べ直して差し込む
+            od = slot[2]
+            moved = sorted((od.pop(mid) for mid in slot[3] if mid in od), key=key)
+            slot[2] = {it["id"]: it for it in heapq.merge(od.values(), moved, key=key)}
+            slot[3] = set()
+        self._lr.move_to_end(id(images))
+        return list(slot[2].values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {"seed": self.seed, "tick": self._tick, "tracked": len(self._shown)}
@@ -0,0 +1,651 @@
+# ~/raspiframe/app/photo_index.py
+"""
+写真メタデータの永続インデックス。
+
+- 1ファイル = 1エントリ（size / mtime_ns が変わっていなければ EXIF を読み直さない）
+- data/index.json に保存し、起動時に読み戻す（コールドスキャンを避ける）
+- day_key は TZ 依存なので保存せず、ts から都度計算する
+- 画素数（幅・高さ）と EXIF Orientation もヘッダから読んで持つ（プレイヤーが画像を取る前に
+  縦長・パノラマに合わせたレイアウトを決められるように）
+- 連写をまとめるための知覚ハッシュ（dhash。bursts.py）も、裏で作った分から持つ（行の末尾。無ければ未計算）
+- 写真ツリーの根に持ち運べるインデックス（<根>/.superphotoframe/index.json.gz、パスは根からの相対）を
+  書き出せる。USB メモリなどを別のフレームに挿した時は、それを数件の stat で確かめて取り込む
+  （EXIF を読み直さない）。.superphotoframe は走査しない
+"""
+import os
+import json
+import base64
+import gzip
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:  # pragma: no cover
+    ZoneInfo = None
+
+try:
+    from PIL import Image, ExifTags  # Pillow がある場合は EXIF を使う
+    _EXIF_TAGS = {v: k for k, v in ExifTags.TAGS.items()}
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif")
+
+INDEX_VERSION = 2             # 2: 幅・高さ・Orientation を追加
+
+# EXIF の日時はナイーブなので、従来どおり Asia/Tokyo として解釈する
+_EXIF_NAIVE_TZ = "Asia/Tokyo"
+
+
+# ==== EXIF 読み出し ===========================================================
+def _exposure_to_text(val) -> str:
+    """
+    EXIF ExposureTime なら 1/125s などに、ShutterSpeedValue(APEX) なら近い分数へ。
+    """
+    try:
+        # ExposureTime は (num, den) のタプルで来ることが多い
+        if isinstance(val, tuple) and len(val) == 2 and val[1] != 0:
+            num, den = int(val[0]), int(val[1])
+            # 1秒未満は 1/x 表記、1秒以上は x"s
+            if num/den < 1:
+                return f"1/{int(round(den/num))}s"
+            else:
+                return f"{num/den:.1f}s"
+        # 既に float の場合
+        v = float(val)
+        if v < 1:
+            return f"1/{int(round(1.0/v))}s"
+        return f"{v:.1f}s"
+    except Exception:
+        return ""
+
+
+def _exif_datetime_to_ts(val) -> Optional[float]:
+    """ "YYYY:MM:DD HH:MM:SS" → epoch秒（サブ秒・ヌル文字は落とす） """
+    if isinstance(val, bytes):
+        try:
+            val = val.decode(errors="ignore")
+        except Exception:
+            return None
+    if not isinstance(val, str):
+        return None
+    s = val.strip().split("\x00", 1)[0]
+    if "." in s:
+        s = s.split(".", 1)[0]
+    if len(s) < 19:
+        return None
+    try:
+        dt = datetime.strptime(s, "%Y:%m:%d %H:%M:%S").replace(tzinfo=ZoneInfo(_EXIF_NAIVE_TZ))
+        return float(dt.timestamp())
+    except Exception:
+        return None
+
+
+def read_metadata(path: str) -> Dict[str, Any]:
+    """
+    画像1枚から EXIF 由来のメタデータを読む（ヘッダのみ、デコードしない）。
+    戻り値: {"ts": float|None, "model": str, "exposure": str,
+             "width": int, "height": int, "orientation": int}
+    ts は EXIF(DateTimeOriginal→CreateDate→Digitized→DateTime) が取れた時だけ入る。
+    width / height は格納されている画素数（Orientation を当てる前。読めなければ 0）。
+    """
+    meta: Dict[str, Any] = {"ts": None, "model": "", "exposure": "",
+                            "width": 0, "height": 0, "orientation": 1}
+    if not _HAS_PIL:
+        return meta
+    try:
+        with Image.open(path) as im:
+            meta["width"], meta["height"] = im.size
+            exif = (im._getexif() if hasattr(im, "_getexif") else None) or {}
+    except Exception:
+        return meta
+    if not exif:
+        return meta
+
+    orientation = exif.get(_EXIF_TAGS.get("Orientation"))
+    if isinstance(orientation, int) and 1 <= orientation <= 8:
+        meta["orientation"] = orientation
+
+    for key_name in ("DateTimeOriginal", "CreateDate", "DateTimeDigitized", "DateTime"):
+        tag_id = _EXIF_TAGS.get(key_name)
+        if not tag_id:
+            continue
+        ts = _exif_datetime_to_ts(exif.get(tag_id))
+        if ts is not None:
+            meta["ts"] = ts
+            break
+
+    # Model / Make
+    model = exif.get(_EXIF_TAGS.get("Model"), "") or ""
+    make  = exif.get(_EXIF_TAGS.get("Make"), "") or ""
+    if isinstance(model, str) and isinstance(make, str):
+        meta["model"] = (f"{make} {model}".strip() or model or make).strip()
+
+    # 露出: ExposureTime優先、なければ ShutterSpeedValue(APEX)
+    exp = exif.get(_EXIF_TAGS.get("ExposureTime"))
+    if exp is not None:
+        meta["exposure"] = _exposure_to_text(exp)
+    else:
+        sv = exif.get(_EXIF_TAGS.get("ShutterSpeedValue"))
+        if sv is not None:
+            try:
+                if isinstance(sv, tuple) and len(sv) == 2 and sv[1] != 0:
+                    apex = float(sv[0]) / float(sv[1])
+                else:
+                    apex = float(sv)
+                meta["exposure"] = _exposure_to_text(2 ** (-apex))
+            except Exception:
+                pass
+    return meta
+
+
+def media_id(path: str) -> str:
+    """パスから決まる短い ID（blake2b 72bit → base64url 12文字。再起動しても同じ）"""
+    h = hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=9).digest()
+    return base64.urlsafe_b64encode(h).decode("ascii")
+
+
+def day_key(ts: float, tz) -> str:
+    """epoch秒 → 指定TZでの YYYY-MM-DD"""
+    try:
+        return datetime.fromtimestamp(ts, tz).strftime("%Y-%m-%d")
+    except Exception:
+        return datetime.fromtimestamp(0, tz).strftime("%Y-%m-%d")
+
+
+# ==== エントリ ================================================================
+class Entry:
+    """インデックス1件分。JSON にはリストで保存する（キー名の分だけ小さくなる）"""
+    __slots__ = ("size", "mtime_ns", "ts", "model", "exposure", "width", "height", "orientation", "dhash")
+
+    def __init__(self, size: int, mtime_ns: int, ts: float,
+                 model: str = "", exposure: str = "",
+                 width: int = 0, height: int = 0, orientation: int = 1,
+                 dhash: Optional[int] = None) -> None:
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ts = ts
+        self.model = model
+        self.exposure = exposure
+        self.width = width
+        self.height = height
+        self.orientation = orientation
+        self.dhash = dhash            # None: まだ作っていない / -1: 作れなかった
+
+    def to_row(self) -> list:
+        return [self.size, self.mtime_ns, self.ts, self.model, self.exposure,
+                self.width, self.height, self.orientation, self.dhash]
+
+    @classmethod
+    def from_row(cls, row: list) -> "Entry":
+        dhash = row[8] if len(row) > 8 else None
+        return cls(int(row[0]), int(row[1]), float(row[2]), row[3] or "", row[4] or "",
+                   int(row[5]), int(row[6]), int(row[7]),
+                   int(dhash) if dhash is not None else None)
+
+    def upright_size(self) -> Tuple[int, int]:
+        """Orientation を当てた後の (幅, 高さ)。5〜8 は90度回るので入れ替わる"""
+        if self.orientation >= 5:
+            return self.height, self.width
+        return self.width, self.height
+
+    def version(self) -> str:
+        """size / mtime から決まる短い版（base64url 8文字）。/media の URL に付けて、変わった写真を取り直させる"""
+        h = hashlib.blake2b(f"{self.size}:{self.mtime_ns}".encode("ascii"), digest_size=6).digest()
+        return base64.urlsafe_b64encode(h).decode("ascii")
+
+    def matches(self, st: os.stat_result) -> bool:
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns
+
+    def matches_entry(self, other: "Entry") -> bool:
+        return self.size == other.size and self.mtime_ns == other.mtime_ns
+
+
+def make_entry(path: str, st: os.stat_result) -> Entry:
+    """stat 済みファイルから新しいエントリを作る（EXIF が無ければ mtime）"""
+    meta = read_metadata(path)
+    ts = meta["ts"]
+    if ts is None:
+        ts = st.st_mtime_ns / 1e9
+    return Entry(st.st_size, st.st_mtime_ns, float(ts), meta["model"], meta["exposure"],
+                 meta["width"], meta["height"], meta["orientation"])
+
+
+def walk(root: str) -> Iterable[Tuple[str, os.stat_result]]:
+    """os.scandir で再帰走査（DirEntry.stat はキャッシュされるので stat 1回で済む）"""
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except Exception:
+            continue
+        with it:
+            for de in it:
+                try:
+                    if de.is_dir(follow_symlinks=False):
+                        if de.name != PACK_DIR:
+                            stack.append(de.path)
+                    elif de.name.lower().endswith(IMAGE_EXTS):
+                        yield de.path, de.stat()
+                except Exception:
+                    continue
+
+
+# ==== インデックス本体 ========================================================
+class PhotoIndex:
+    """
+    path -> Entry の辞書を保持し、選択フォルダを差分スキャンする。
+    スキャンはスレッドから呼ばれる前提なのでロックで守る。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Entry] = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        # 最後に自分が読んだ / 書いたファイルの mtime（他のワーカーが書いたかの判定用）
+        self._file_mtime_ns: Optional[int] = None
+        self._gone: set = set()       # 前回保存以降に捨てたパス（マージで復活させない）
+        self._packs: Dict[str, Dict[str, Any]] = {}   # パックのパス -> {"sig", "info"}（読んだもの）
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # ---- 永続化 ----
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file(self) -> Optional[Dict[str, Entry]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[INDEX] load failed: {e}")
+            return None
+        if not isinstance(raw, dict) or raw.get("version") != INDEX_VERSION:
+            print("[INDEX] version mismatch, starting fresh")
+            return None
+        entries: Dict[str, Entry] = {}
+        for p, row in (raw.get("entries") or {}).items():
+            try:
+                entries[p] = Entry.from_row(row)
+            except Exception:
+                continue
+        return entries
+
+    def load(self) -> int:
+        """data/index.json を読み込む。戻り値は読み込めた件数"""
+        mtime_ns = self._file_mtime()
+        entries = self._read_file()
+        if entries is None:
+            return 0
+        with self._lock:
+            self.entries = entries
+            self._dirty = False
+            self._file_mtime_ns = mtime_ns
+            self._gone.clear()
+        return len(entries)
+
+    def reload(self) -> bool:
+        """（走査しないワーカー用）ファイルが書き換わっていたら丸ごと読み直す（消えたファイルの行も落ちる）"""
+        mtime_ns = self._file_mtime()
+        if mtime_ns is None or mtime_ns == self._file_mtime_ns:
+            return False
+        self.load()
+        return True
+
+    def merge_from_disk(self) -> int:
+        """
+        他のワーカーがファイルを書き換えていたら、自分に無いエントリを取り込む
+        （同じパスは自分の方を優先。ただし同じファイルのハッシュが向こうにだけあればそれは貰う。
+        戻り値は取り込んだ件数）。
+        """
+        mtime_ns = self._file_mtime()
+        if mtime_ns is None or mtime_ns == self._file_mtime_ns:
+            return 0
+        entries = self._read_file() or {}
+        added = 0
+        with self._lock:
+            for p, e in entries.items():
+                cur = self.entries.get(p)
+                if cur is None:
+                    if p not in self._gone:
+                        self.entries[p] = e
+                        added += 1
+                elif cur.dhash is None and e.dhash is not None and cur.matches_entry(e):
+                    cur.dhash = e.dhash
+            self._file_mtime_ns = mtime_ns
+        return added
+
+    def save(self, force: bool = False) -> None:
+        """変更があれば一時ファイル経由でアトミックに保存"""
+        # 他のワーカーが書いた分を落とさないよう、先に取り込んでから書く
+        self.merge_from_disk()
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            data = {
+                "version": INDEX_VERSION,
+                "saved_at": time.time(),
+                "entries": {p: e.to_row() for p, e in self.entries.items()},
+            }
+            self._dirty = False
+        tmp = f"{self.path}.{os.getpid()}.tmp"     # ワーカーごとに別の一時ファイル
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+            with self._lock:
+                self._file_mtime_ns = self._file_mtime()
+                self._gone.clear()
+        except Exception as e:
+            print(f"[INDEX] save failed: {e}")
+            with self._lock:
+                self._dirty = True
+
+    # ---- スキャン ----
+    def _scan_folder(self, root: str, out: List[Tuple[str, Entry]],
+                     stop: threading.Event, state: Dict[str, Any],
+                     pace: Optional[Callable[[], None]] = None) -> None:
+        """
+        1フォルダ分の走査（専用スレッドで動く）。見つけた分は out に逐次追記する。
+        最後まで走査できた時だけ state["done"] = True にして、消えたファイルを捨てる。
+        EXIF を読む（新しい・変わった）ファイルの前には pace() を呼ぶ（温度などで待たせる用）。
+        """
+        if not os.path.isdir(root):
+            state["done"] = True
+            return
+        for p, st in walk(root):
+            if stop.is_set():
+                return
+            e = self.entries.get(p)
+            if e is not None and e.matches(st):
+                state["reused"] += 1
+            else:
+                if pace is not None:
+                    pace()
+                    if stop.is_set():
+                        return
+                e = make_entry(p, st)
+                with self._lock:
+                    self.entries[p] = e
+                    self._dirty = True
+                state["fresh"] += 1
+            out.append((p, e))
+        self._prune(root, {p for p, _ in out})
+        state["done"] = True
+
+    def scan(self, folders: List[str], job: Optional["ScanJob"] = None,
+             folder_deadline: Optional[float] = None,
+             pace: Optional[Callable[[], None]] = None
+             ) -> Tuple[List[Tuple[str, Entry]], List[Dict[str, Any]]]:
+        """
+        選択フォルダを差分スキャンして ((path, Entry) のリスト, 未完了フォルダ) を返す。
+        - size / mtime_ns が一致するファイルは EXIF を読まずにキャッシュを使う
+        - フォルダごとにスレッドで並行走査し、folder_deadline 秒で打ち切る
+          （遅い / 固まったファイルシステムで全体が待たされない）
+        - 打ち切ったフォルダは「そこまでの結果 + インデックス済みの分」を返し、
+          {"folder", "reason", "scanned"} として未完了リストに載せる
+        - job が cancel されたら（新しい選択が来たら）すぐに止める
+        - pace を渡すと EXIF を読む前に1件ずつ呼ぶ（governor.py）
+        """
+        running = []
+        for root in folders:
+            out: List[Tuple[str, Entry]] = []
+            stop = threading.Event()
+            state: Dict[str, Any] = {"done": False, "fresh": 0, "reused": 0}
+            t = threading.Thread(target=self._scan_folder, args=(root, out, stop, state, pace),
+                                 name=f"scan:{root}", daemon=True)
+            t.start()
+            running.append((root, t, out, stop, state))
+
+        t0 = time.monotonic()
+        items: List[Tuple[str, Entry]] = []
+        incomplete: List[Dict[str, Any]] = []
+        fresh = reused = 0
+        for root, t, out, stop, state in running:
+            while t.is_alive():
+                if job is not None and job.cancelled:
+                    break
+                wait = 0.1
+                if folder_deadline is not None:
+                    remaining = folder_deadline - (time.monotonic() - t0)
+                    if remaining <= 0:
+                        break
+                    wait = min(wait, remaining)
+                t.join(wait)
+            fresh += state["fresh"]
+            reused += state["reused"]
+            if state["done"]:
+                items.extend(out)
+                continue
+            # 打ち切り: ここまでの結果 + まだ見ていないインデックス済みエントリ
+            stop.set()
+            partial = list(out)
+            seen = {p for p, _ in partial}
+            partial.extend((p, e) for p, e in self.cached(root) if p not in seen)
+            items.extend(partial)
+            reason = "cancelled" if job is not None and job.cancelled else "deadline"
+            incomplete.append({"folder": root, "reason": reason, "scanned": len(out)})
+            print(f"[INDEX] {root}: scan {reason} after {len(out)} files")
+        if fresh:
+            print(f"[INDEX] scanned: {fresh} new/changed, {reused} cached")
+        return items, incomplete
+
+    def cached(self, root: str) -> List[Tuple[str, Entry]]:
+        """ディスクに触らず、root 配下のインデックス済みエントリを返す"""
+        prefix = root.rstrip(os.sep) + os.sep
+        with self._lock:
+            return [(p, e) for p, e in self.entries.items() if p.startswith(prefix)]
+
+    def _prune(self, root: str, seen: set) -> None:
+        """走査し終えたルート配下で、見つからなかったエントリを捨てる"""
+        prefix = root.rstrip(os.sep) + os.sep
+        with self._lock:
+            gone = [p for p in self.entries if p.startswith(prefix) and p not in seen]
+            for p in gone:
+                del self.entries[p]
+            self._gone.update(gone)
+            if gone:
+                self._dirty = True
+
+
+    def set_hash(self, path: str, entry: Entry, dhash: int) -> None:
+        """entry（path の今のエントリ）に知覚ハッシュを付ける。その間にファイルが変わっていたら捨てる"""
+        with self._lock:
+            cur = self.entries.get(path)
+            if cur is None or not cur.matches_entry(entry):
+                return
+            cur.dhash = dhash
+            self._dirty = True
+
+    # ---- 持ち運べるインデックス ----
+    def import_pack(self, folder: str) -> Optional[Dict[str, Any]]:
+        """
+        folder（かその数階層上）のパックを確かめて取り込む。パックが無ければ None。
+        同じパック（size / mtime が同じ）は2回目から読まずに前回の結果を返す（fresh: False）。
+        戻り値: {"ok", "pack", "root", "entries", "adopted", "shift_sec", "reason", "ms", "fresh"}
+        """
+        path = find_pack(folder)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        sig = (st.st_size, st.st_mtime_ns)
+        known = self._packs.get(path)
+        if known is not None and known["sig"] == sig:
+            return {**known["info"], "fresh": False}
+
+        t0 = time.monotonic()
+        info: Dict[str, Any] = {"ok": False, "pack": path, "root": os.path.dirname(os.path.dirname(path)),
+                                "entries": 0, "adopted": 0, "shift_sec": 0, "reason": ""}
+        entries = read_pack(path)
+        if entries is None:
+            info["reason"] = "unreadable"
+        else:
+            info["entries"] = len(entries)
+            ok, shift, reason = spot_check(entries)
+            info["ok"], info["reason"] = ok, reason
+            if ok:
+                info["shift_sec"] = shift / 1e9
+                added = 0
+                with self._lock:
+                    for p, e in entries.items():
+                        e.mtime_ns += shift
+                        cur = self.entries.get(p)
+                        if cur is not None and cur.matches_entry(e):
+                            if cur.dhash is None and e.dhash is not None:
+                                cur.dhash = e.dhash
+                                self._dirty = True
+                            continue
+                        self.entries[p] = e
+                        self._gone.discard(p)
+                        added += 1
+                    if added:
+                        self._dirty = True
+                info["adopted"] = added
+        info["ms"] = round((time.monotonic() - t0) * 1000)
+        if info["ok"]:
+            print(f"[INDEX] pack {path}: {info['entries']} entries ({info['adopted']} new) in {info['ms']}ms")
+        else:
+            print(f"[INDEX] pack {path} rejected: {info['reason']}")
+        self._packs[path] = {"sig": sig, "info": info}
+        return {**info, "fresh": True}
+
+    def export_pack(self, root: str) -> Dict[str, Any]:
+        """root 配下のインデックス済みエントリを root のパックに書き出す（先に scan しておくこと）"""
+        items = self.cached(root)
+        path = write_pack(root, items)
+        try:
+            st = os.stat(path)
+            self._packs[path] = {"sig": (st.st_size, st.st_mtime_ns),
+                                 "info": {"ok": True, "pack": path, "root": root, "entries": len(items),
+                                          "adopted": 0, "shift_sec": 0, "reason": "exported", "ms": 0}}
+        except OSError:
+            pass
+        print(f"[INDEX] exported {len(items)} entries -> {path}")
+        return {"pack": path, "entries": len(items)}
+
+
+# ==== 持ち運べるインデックス（index pack） ======================================
+PACK_DIR = ".superphotoframe"
+PACK_NAME = "index.json.gz"
+PACK_VERSION = 2              # 行の形は INDEX_VERSION と同じ
+PACK_SPOT_CHECKS = 48         # 取り込む前に stat して確かめる件数
+PACK_SEARCH_UP = 3            # 選択フォルダから何階層上までパックを探すか
+# FAT / exFAT（タイムスタンプが現地時刻）のメディアは、TZ の違うマシンで読むと mtime が
+# 15分単位で一様にずれる。全部が同じだけずれていれば、そのずれを足して取り込む
+_TZ_STEP_NS = 15 * 60 * 1_000_000_000
+_TZ_MAX_NS = 14 * 3600 * 1_000_000_000
+
+
+def pack_path(root: str) -> str:
+    return os.path.join(root, PACK_DIR, PACK_NAME)
+
+
+def find_pack(folder: str) -> Optional[str]:
+    d = os.path.abspath(folder)
+    for _ in range(PACK_SEARCH_UP + 1):
+        p = pack_path(d)
+        if os.path.isfile(p):
+            return p
+        parent = os.path.dirname(d)
+        if parent == d:
+            break
+        d = parent
+    return None
+
+
+def write_pack(root: str, items: Iterable[Tuple[str, Entry]], generator: str = "superphotoframe") -> str:
+    """(絶対パス, Entry) を root からの相対パス（/ 区切り）でパックに書く（一時ファイル経由）"""
+    prefix = root.rstrip(os.sep) + os.sep
+    rows = {p[len(prefix):].replace(os.sep, "/"): e.to_row() for p, e in items if p.startswith(prefix)}
+    data = {"version": PACK_VERSION, "generator": generator, "created_at": time.time(),
+            "count": len(rows), "entries": rows}
+    dst = pack_path(root)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, dst)
+    return dst
+
+
+def read_pack(path: str) -> Optional[Dict[str, Entry]]:
+    """パック → {絶対パス: Entry}。壊れている・版が違う時は None"""
+    root = os.path.dirname(os.path.dirname(path))
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            raw = json.load(f)
+    except Exception as e:
+        print(f"[INDEX] pack load failed {path}: {e}")
+        return None
+    if not isinstance(raw, dict) or raw.get("version") != PACK_VERSION:
+        return None
+    entries: Dict[str, Entry] = {}
+    for rel, row in (raw.get("entries") or {}).items():
+        if rel.startswith("/") or ".." in rel.split("/"):
+            continue
+        try:
+            entries[os.path.join(root, *rel.split("/"))] = Entry.from_row(row)
+        except Exception:
+            continue
+    return entries
+
+
+def spot_check(entries: Dict[str, Entry], n: int = PACK_SPOT_CHECKS) -> Tuple[bool, int, str]:
+    """無作為に n 件を stat して (使えるか, mtime のずれ ns, 理由)。size は完全一致が条件"""
+    if not entries:
+        return False, 0, "empty"
+    shift: Optional[int] = None
+    for p in random.sample(list(entries), min(n, len(entries))):
+        try:
+            st = os.stat(p)
+        except OSError:
+            return False, 0, f"missing: {p}"
+        e = entries[p]
+        if st.st_size != e.size:
+            return False, 0, f"size differs: {p}"
+        d = st.st_mtime_ns - e.mtime_ns
+        if shift is None:
+            if d % _TZ_STEP_NS or abs(d) > _TZ_MAX_NS:
+                return False, 0, f"mtime differs: {p}"
+            shift = d
+        elif d != shift:
+            return False, 0, f"mtime differs: {p}"
+    return True, shift or 0, ""
+
+
+class ScanJob:
+    """
+    スキャン1回分。generation が新しいジョブが来たら古いものは cancel() される。
+    done は（キャンセルされても）処理が終わった時にセットされる。
+    """
+
+    def __init__(self, generation: int, key: Any = None) -> None:
+        self.generation = generation
+        self.key = key
+        self.done = threading.Event()
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
@@ -0,0 +1,155 @@
+# ~/raspiframe/app/query.py
+"""
+プレイリストの絞り込み（テーマ別のプレイリスト）。config.json の playlist_mode で選ぶ:
+
+    {"mode": "all"}                                       全部（既定）
+    {"mode": "on_this_day", "window_days": 0}             毎年の今日（前後 window_days 日）
+    {"mode": "range", "from": "2023-01-01", "to": "2023-12-31"}
+    {"mode": "last_days", "days": 30}                     最近 N 日
+    {"mode": "camera", "model": "ILCE-7M3"}               機種で絞る
+
+ts 昇順のプレイリストキャッシュから、1回だけ次の配列と転置インデックスを作る:
+- days   : 各写真の撮影日の通し日数（date.toordinal()）。ts 昇順なのでこれも昇順 → 二分探索
+- by_md  : "MM-DD" -> 位置のリスト（on_this_day）
+- by_model: 機種名 -> 位置のリスト（camera）
+
+結果は元の順番（ts 昇順）のままの新しいリスト。同じキャッシュ・同じ条件・同じ日付なら
+同じリストオブジェクトを返す（ordering.py の並べ替え結果の使い回しが効くように）。
+"""
+import bisect
+import datetime as dt
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+MODES = ("all", "on_this_day", "range", "last_days", "camera")
+DAY_RELATIVE = ("on_this_day", "last_days")   # 日付が変わると結果が変わる
+MAX_WINDOW_DAYS = 15
+MEMO_SIZE = 16
+
+
+def normalize(spec: Any) -> Dict[str, Any]:
+    """設定値を正規化（文字列だけなら mode 名とみなす。不正なら all）"""
+    if isinstance(spec, str):
+        spec = {"mode": spec}
+    if not isinstance(spec, dict):
+        return {"mode": "all"}
+    mode = str(spec.get("mode") or "all").lower()
+    if mode not in MODES:
+        return {"mode": "all"}
+    return {**spec, "mode": mode}
+
+
+def _parse_day(s: Any) -> Optional[int]:
+    try:
+        return dt.date.fromisoformat(str(s)[:10]).toordinal()
+    except Exception:
+        return None
+
+
+def _is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+class TimeIndex:
+    """1つのプレイリスト（ts 昇順）に対する検索用の配列"""
+
+    def __init__(self, images: List[Dict[str, Any]]) -> None:
+        self.images = images
+        ordinal: Dict[str, int] = {}       # day_key -> 通し日数（同じ日は1回だけ変換）
+        self.days: List[int] = []
+        self.by_md: Dict[str, List[int]] = {}
+        self.by_model: Dict[str, List[int]] = {}
+        for i, it in enumerate(images):
+            dk = it.get("day_key") or ""
+            n = ordinal.get(dk)
+            if n is None:
+                n = ordinal[dk] = _parse_day(dk) or 0
+            self.days.append(n)
+            self.by_md.setdefault(dk[5:10], []).append(i)
+            model = it.get("model") or ""
+            if model:
+                self.by_model.setdefault(model, []).append(i)
+
+    def day_range(self, lo: int, hi: int) -> List[Dict[str, Any]]:
+        """lo <= 撮影日 <= hi（通し日数）"""
+        a = bisect.bisect_left(self.days, lo)
+        b = bisect.bisect_right(self.days, hi)
+        return self.images[a:b]
+
+    def on_this_day(self, today: dt.date, window: int) -> List[Dict[str, Any]]:
+        mds = set()
+        for d in range(-window, window + 1):
+            mds.add((today + dt.timedelta(days=d)).strftime("%m-%d"))
+        # うるう年でない年の 2/28 には 2/29 の写真も出す
+        if "02-28" in mds and not _is_leap(today.year):
+            mds.add("02-29")
+        pos: List[int] = []
+        for md in mds:
+            pos.extend(self.by_md.get(md, ()))
+        pos.sort()
+        return [self.images[i] for i in pos]
+
+    def camera(self, model: str) -> List[Dict[str, Any]]:
+        return [self.images[i] for i in self.by_model.get(model, ())]
+
+    def cameras(self) -> List[Dict[str, Any]]:
+        return [{"model": m, "count": len(p)}
+                for m, p in sorted(self.by_model.items(), key=lambda kv: -len(kv[1]))]
+
+
+class PlaylistQuery:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._tindex: Optional[TimeIndex] = None
+        self._memo: Dict[Tuple[str, dt.date], List[Dict[str, Any]]] = {}
+
+    def index(self, images: List[Dict[str, Any]]) -> TimeIndex:
+        with self._lock:
+            if self._tindex is None or self._tindex.images is not images:
+                self._tindex = TimeIndex(images)
+                self._memo = {}
+            return self._tindex
+
+    def select(self, images: List[Dict[str, Any]], spec: Any,
+               today: dt.date) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """(絞り込んだリスト, 情報)。1枚も当たらなければ全部に戻す（fallback: True）"""
+        spec = normalize(spec)
+        mode = spec["mode"]
+        if mode == "all":
+            return images, {"mode": "all", "matched": len(images), "fallback": False}
+        ti = self.index(images)
+        memo_key = (json.dumps(spec, sort_keys=True, default=str), today)
+        with self._lock:
+            out = self._memo.get(memo_key)
+        if out is None:
+            try:
+                out = self._run(ti, spec, today)
+            except (TypeError, ValueError) as e:
+                print(f"[QUERY] invalid playlist_mode {spec}: {e}")
+                out = []
+            with self._lock:
+                if self._tindex is ti:
+                    if len(self._memo) >= MEMO_SIZE:
+                        self._memo.clear()
+                    self._memo[memo_key] = out
+        info = {**spec, "matched": len(out), "fallback": not out}
+        return (out or images), info
+
+    def _run(self, ti: TimeIndex, spec: Dict[str, Any], today: dt.date) -> List[Dict[str, Any]]:
+        mode = spec["mode"]
+        if mode == "on_this_day":
+            window = max(0, min(MAX_WINDOW_DAYS, int(spec.get("window_days") or 0)))
+            return ti.on_this_day(today, window)
+        if mode == "range":
+            lo = _parse_day(spec.get("from")) or 1
+            hi = _parse_day(spec.get("to")) or dt.date.max.toordinal()
+            return ti.day_range(lo, hi)
+        if mode == "last_days":
+            n = max(1, int(spec.get("days") or 30))
+            t = today.toordinal()
+            return ti.day_range(t - n + 1, t)
+        if mode == "camera":
+            return ti.camera(str(spec.get("model") or ""))
+        return ti.images
@@ -0,0 +1,198 @@
+# ~/raspiframe/app/scheduler.py
+"""
+サーバ側の再生スケジューラ（任意。設定 server_scheduler: true の時だけ使う）。
+
+プレイヤーに全プレイリストを持たせる代わりに、サーバが再生位置とタイミング
+（display_ms / fade_ms）を持ち、SSE で "show" を送る:
+
+    {"type": "show", "frame", "seq", "idx", "total", "item": {...},
+     "prefetch": [次の K 枚], "display_ms", "fade_ms", "scrub": bool}
+
+- プレイヤーは今の1枚と先読みのヒントだけを持てばよい（キオスクのメモリが一定）
+- 次に出す K 枚が分かるので、サーバはちょうどその分の派生画像を先に作っておける
+- ロータリーの回転もサーバで受けて日付スクラブする（scrub: true の show を即送る）
+- セッションはフレーム名（名前無しは None）ごと。プレイヤーが attach() を送り続けている間だけ生きる
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+PREFETCH_HINTS = 3            # show に付ける「次に出す」ID の数
+SESSION_TTL_SEC = 180.0       # これだけ attach が来なければセッションを止める
+MIN_DISPLAY_SEC = 1.0
+
+# item のうちプレイヤーへ送るキー（パスは送らない）
+PUBLIC_KEYS = ("id", "v", "ts", "day_key", "model", "exposure", "w", "h", "orient")
+
+
+def public_item(it: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: it.get(k) for k in PUBLIC_KEYS}
+
+
+class Session:
+    def __init__(self, frame: Optional[str]) -> None:
+        self.frame = frame
+        self.seq: List[Dict[str, Any]] = []
+        self.seq_key: Any = None
+        self.idx = 0
+        self.shown = 0                 # 送った show の通し番号
+        self.days: List[str] = []      # 出てくる順ではなく日付順
+        self.first: Dict[str, int] = {}  # day_key -> seq 内で最初に出る位置
+        self.next_at = 0.0
+        self.pinged = time.monotonic()
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.resume_id: Optional[str] = None
+
+
+class Scheduler:
+    """
+    items(frame)    -> (key, [item, ...])  並べ済みのプレイリスト（スレッドで呼ぶ。key が変われば作り直す）
+    settings(frame) -> 設定 dict（display_ms / fade_ms）
+    send(frame, message) は SSE でそのフレームに送るコルーチン
+    on_show(frame, item, upcoming) は表示のたびに呼ぶ（カーソル保存・派生画像の先読み用）
+    resume(frame)   -> 前回の再生位置の ID（無ければ None）
+    """
+
+    def __init__(self,
+                 items: Callable[[Optional[str]], Tuple[Any, List[Dict[str, Any]]]],
+                 settings: Callable[[Optional[str]], Dict[str, Any]],
+                 send: Callable[[Optional[str], Dict[str, Any]], Awaitable[None]],
+                 on_show: Optional[Callable[[Optional[str], Dict[str, Any], List[Dict[str, Any]]], None]] = None,
+                 resume: Optional[Callable[[Optional[str]], Optional[str]]] = None) -> None:
+        self.items = items
+        self.settings = settings
+        self.send = send
+        self.on_show = on_show
+        self.resume = resume
+        self._sessions: Dict[Optional[str], Session] = {}
+
+    # ---- セッション ----
+    def attach(self, frame: Optional[str], resend: bool = False) -> None:
+        """
+        プレイヤーが生きている合図（定期）。セッションが無ければ作る。
+        resend はプレイヤーが（再）接続した時: 今の1枚をすぐ送り直す。定期の合図では表示の時刻を動かさない
+        """
+        s = self._sessions.get(frame)
+        if s is not None and s.task is not None and not s.task.done():
+            s.pinged = time.monotonic()
+            if resend:
+                s.next_at = 0.0        # すぐに今の位置を送り直す（再接続したプレイヤー用）
+                s.wake.set()
+            return
+        s = self._sessions[frame] = Session(frame)
+        s.resume_id = self.resume(frame) if self.resume else None
+        s.task = asyncio.get_running_loop().create_task(self._run(s))
+        print(f"[SCHED] session started: {frame or '(default)'}")
+
+    def stop(self) -> None:
+        for s in list(self._sessions.values()):
+            if s.task is not None:
+                s.task.cancel()
+        self._sessions.clear()
+
+    def sessions(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        out = []
+        for s in self._sessions.values():
+            cur = s.seq[s.idx] if s.seq else None
+            out.append({
+                "frame": s.frame, "idx": s.idx, "total": len(s.seq), "shown": s.shown,
+                "current": cur["id"] if cur else None,
+                "next_in_s": round(max(0.0, s.next_at - now), 2),
+                "idle_s": round(now - s.pinged, 1),
+            })
+        return out
+
+    def has(self, frame: Optional[str]) -> bool:
+        return frame in self._sessions
+
+    # ---- ロータリー ----
+    def rotary(self, frame: Optional[str], text: str) -> bool:
+        """"rotary_left" / "rotary_right" で前後の撮影日へ。処理したら True"""
+        s = self._sessions.get(frame)
+        if s is None or not s.seq or not s.days:
+            return False
+        t = text.strip().lower()
+        if "left" in t:
+            step = -1
+        elif "right" in t:
+            step = +1
+        else:
+            return False
+        day = s.seq[s.idx].get("day_key")
+        pos = s.days.index(day) if day in s.days else 0
+        s.idx = s.first[s.days[(pos + step) % len(s.days)]]
+        # 回している間は micro で即表示、次の自動送りは止まってから display_ms 後
+        s.next_at = time.monotonic() + self._display_sec(frame)
+        asyncio.get_running_loop().create_task(self._send_show(s, scrub=True))
+        s.wake.set()
+        return True
+
+    # ---- 本体 ----
+    def _display_sec(self, frame: Optional[str]) -> float:
+        cfg = self.settings(frame)
+        return max(MIN_DISPLAY_SEC, (cfg.get("display_ms") or 8000) / 1000.0)
+
+    async def _ensure_seq(self, s: Session) -> None:
+        key, items = await asyncio.to_thread(self.items, s.frame)
+        if key == s.seq_key:
+            return
+        cur = s.seq[s.idx]["id"] if s.seq else s.resume_id
+        seq = list(items)
+        s.seq, s.seq_key = seq, key
+        s.first = {}
+        for i, it in enumerate(seq):
+            s.first.setdefault(it.get("day_key"), i)
+        s.days = sorted(d for d in s.first if d is not None)
+        # 同じ写真が残っていればそこから続ける
+        pos = next((i for i, it in enumerate(seq) if it["id"] == cur), None) if cur else None
+        s.idx = pos if pos is not None else 0
+
+    async def _send_show(self, s: Session, scrub: bool = False) -> None:
+        if not s.seq:
+            return
+        n = len(s.seq)
+        item = s.seq[s.idx]
+        upcoming = [s.seq[(s.idx + k) % n] for k in range(1, min(PREFETCH_HINTS, n - 1) + 1)]
+        cfg = self.settings(s.frame)
+        s.shown += 1
+        await self.send(s.frame, {
+            "type": "show", "frame": s.frame, "seq": s.shown, "idx": s.idx, "total": n,
+            "item": public_item(item), "prefetch": [public_item(it) for it in upcoming],
+            "display_ms": cfg.get("display_ms") or 8000, "fade_ms": cfg.get("fade_ms") or 3000,
+            "scrub": scrub,
+        })
+        if self.on_show and not scrub:
+            try:
+                self.on_show(s.frame, item, upcoming)
+            except Exception as e:
+                print(f"[SCHED] on_show error: {e}")
+
+    async def _run(self, s: Session) -> None:
+        try:
+            while time.monotonic() - s.pinged < SESSION_TTL_SEC:
+                await self._ensure_seq(s)
+                await self._send_show(s)
+                s.next_at = time.monotonic() + self._display_sec(s.frame)
+                # 次の表示時刻まで待つ（ロータリー操作・再接続で時刻が動いたら待ち直す）
+                while True:
+                    s.wake.clear()
+                    timeout = s.next_at - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(s.wake.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if s.next_at != 0.0 and s.seq:
+                    s.idx = (s.idx + 1) % len(s.seq)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[SCHED] session {s.frame or '(default)'} failed: {e}")
+        finally:
+            if self._sessions.get(s.frame) is s:
+                del self._sessions[s.frame]
+            print(f"[SCHED] session stopped: {s.frame or '(default)'}")
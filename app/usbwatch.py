@@ -0,0 +1,111 @@
+# ~/raspiframe/app/usbwatch.py
+"""
+USBメモリの抜き差し検出（イベント駆動）。
+
+- /proc/self/mountinfo を poll(POLLPRI) で見張る。マウント表が変わるとカーネルが起こしてくれる
+  ので、/media 以下を毎回 listdir する必要がない
+- 現在の USB マウントポイントをキャッシュし、変化した時だけ on_change(old, new) を呼ぶ
+- poll が使えない環境では一定間隔の読み直しにフォールバック
+"""
+import os
+import select
+import threading
+from typing import Callable, Dict, List, Optional
+
+from app import mounts
+
+
+FALLBACK_INTERVAL_SEC = 5.0
+
+
+def pick_usb_mount(table: Dict[str, Dict[str, str]], candidates: List[str],
+                   media_base: str = "/media") -> Optional[str]:
+    """
+    マウント表から USB メモリらしいマウントポイントを選ぶ。
+    優先順位は従来の find_usb_mount と同じ: 固定マウントポイント → /media/<user>/<device>
+    """
+    for mp in candidates:
+        if mp.rstrip(os.sep) in table:
+            return mp
+    base = media_base.rstrip(os.sep) + os.sep
+    found = sorted(
+        mp for mp in table
+        if mp.startswith(base) and mp[len(base):].count(os.sep) == 1
+    )
+    return found[0] if found else None
+
+
+class UsbWatcher:
+    """
+    mountinfo の変化を待つバックグラウンドスレッド。
+    on_change(old, new) は監視スレッドから呼ばれる（new が None なら取り外し）。
+    """
+
+    def __init__(self, candidates: List[str],
+                 on_change: Optional[Callable[[Optional[str], Optional[str]], None]] = None,
+                 mountinfo: str = mounts.MOUNTINFO) -> None:
+        self.candidates = list(candidates)
+        self.on_change = on_change
+        self.mountinfo = mountinfo
+        self.running = False
+        self._current: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def current(self) -> Optional[str]:
+        with self._lock:
+            return self._current
+
+    def refresh(self) -> Optional[str]:
+        """マウント表を読み直してキャッシュを更新（変わっていれば on_change）"""
+        new = pick_usb_mount(mounts.read_mountinfo(self.mountinfo), self.candidates)
+        with self._lock:
+            old, self._current = self._current, new
+        if old != new:
+            print(f"[USB] {'inserted: ' + new if new else 'removed: ' + str(old)}")
+            if self.on_change:
+                try:
+                    self.on_change(old, new)
+                except Exception as e:
+                    print(f"[USB] on_change error: {e}")
+        return new
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        # 最初の状態は同期で読んでおく（起動直後の find_usb_mount に間に合わせる）
+        with self._lock:
+            self._current = pick_usb_mount(mounts.read_mountinfo(self.mountinfo), self.candidates)
+        self._stop.clear()
+        self.running = os.path.exists(self.mountinfo)
+        if not self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="usb-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        try:
+            f = open(self.mountinfo, "r")
+            poller = select.poll()
+            poller.register(f.fileno(), select.POLLPRI | select.POLLERR)
+        except Exception as e:
+            print(f"[USB] poll unavailable ({e}), falling back to periodic refresh")
+            while not self._stop.wait(FALLBACK_INTERVAL_SEC):
+                self.refresh()
+            return
+        with f:
+            # 最初の read で「ここまでは読んだ」ことをカーネルに伝える
+            f.read()
+            while not self._stop.is_set():
+                # タイムアウト付きにしておくと stop() がすぐ効く
+                events = poller.poll(1000)
+                if not events:
+                    continue
+                f.seek(0)
+                f.read()
+                self.refresh()
+        self.running = False
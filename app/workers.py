@@ -0,0 +1,303 @@
+# ~/raspiframe/app/workers.py
+"""
+複数ワーカー（uvicorn --workers N）で動かすための共有部品。
+
+- Bus        : ワーカー間の pub/sub。各ワーカーが data/run/bus-<pid>.sock に
+               Unix データグラムソケットを bind し、publish は同じディレクトリの
+               他のソケット全部へ sendto する（ブローカーのプロセスは持たない）。
+               送れないソケット（落ちたワーカーの残骸）はその場で消す。
+               ソケットの一覧は数秒だけ使い回し、送れなかった時・新しいワーカーの
+               挨拶（start() で送る）が届いた時に取り直す
+- LeaderLock : flock によるリーダー選出。avahi の常駐検出・マウント監視・
+               USB 挿入時の自動処理など「1つだけ動けばよい」裏方はリーダーだけが動かす。
+               リーダーが落ちるとロックが外れ、残ったワーカーの1つが引き継ぐ
+- SharedState: リーダーしか知らない状態（マウントの健康状態・検出済み NAS・起動ステージ）を
+               JSON ファイルで他のワーカーに見せる（mtime が変わった時だけ読み直す）
+- FileWatch  : 設定ファイルなどが他のワーカーに書き換えられたかを mtime で判定する
+
+設定・選択フォルダ・インデックスはもともと data/ 以下のファイルなので、
+各ワーカーは「変わっていたら読み直す」だけで揃う。
+"""
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import fcntl
+    _HAS_FCNTL = True
+except Exception:  # pragma: no cover
+    _HAS_FCNTL = False
+
+
+BUS_PREFIX = "bus-"
+BUS_SUFFIX = ".sock"
+MAX_DGRAM = 64 * 1024             # 1メッセージの上限（SSE のイベントはずっと小さい）
+LEADER_RETRY_SEC = 2.0
+PEERS_TTL_SEC = 5.0               # 送り先の一覧（listdir）を使い回す時間
+HELLO_CH = "_bus_hello"           # 起動したワーカーの挨拶（受け手は一覧を取り直すだけで、on_message には渡さない）
+
+
+# ==== ワーカー間 pub/sub ======================================================
+class Bus:
+    """
+    on_message(msg) は受信スレッドから呼ばれる（自分が publish したものは届かない。
+    自ワーカー内の配送は呼び出し側で直接行う）。
+    """
+
+    def __init__(self, run_dir: str, on_message: Callable[[Dict[str, Any]], None]) -> None:
+        self.run_dir = run_dir
+        self.on_message = on_message
+        self.path = os.path.join(run_dir, f"{BUS_PREFIX}{os.getpid()}{BUS_SUFFIX}")
+        self.dropped = 0
+        self._sock: Optional[socket.socket] = None
+        self._out: Optional[socket.socket] = None
+        self._out_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._peers: Optional[list] = None
+        self._peers_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._sock is not None
+
+    def start(self) -> None:
+        if self._sock is not None:
+            return
+        try:
+            os.makedirs(self.run_dir, exist_ok=True)
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.path)
+            out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # 受け手が詰まっていても送り手（イベントループ）は待たない
+            out.setblocking(False)
+        except OSError as e:
+            print(f"[BUS] disabled: {e}")
+            return
+        self._sock, self._out = sock, out
+        self._thread = threading.Thread(target=self._run, name="worker-bus", daemon=True)
+        self._thread.start()
+        # 先に動いているワーカーの一覧に自分を入れてもらう
+        self.publish({"ch": HELLO_CH})
+
+    def stop(self) -> None:
+        sock, self._sock = self._sock, None
+        for s in (sock, self._out):
+            if s is not None:
+                try:
+                    s.close()
+                except OSError:
+                    pass
+        self._out = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def peers(self) -> list:
+        """他のワーカーのソケット（PEERS_TTL_SEC の間は前に読んだ一覧）"""
+        now = time.monotonic()
+        peers = self._peers
+        if peers is not None and now - self._peers_at < PEERS_TTL_SEC:
+            return list(peers)
+        try:
+            names = os.listdir(self.run_dir)
+        except OSError:
+            names = []
+        peers = [os.path.join(self.run_dir, n) for n in names
+                 if n.startswith(BUS_PREFIX) and n.endswith(BUS_SUFFIX)
+                 and os.path.join(self.run_dir, n) != self.path]
+        self._peers, self._peers_at = peers, now
+        return list(peers)
+
+    def publish(self, msg: Dict[str, Any]) -> int:
+        """他のワーカー全部へ送る。戻り値は送れた数"""
+        if self._out is None:
+            return 0
+        data = json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if len(data) > MAX_DGRAM:
+            print(f"[BUS] message too large ({len(data)} bytes), dropped")
+            self.dropped += 1
+            return 0
+        sent = 0
+        with self._out_lock:
+            for p in self.peers():
+                try:
+                    self._out.sendto(data, p)
+                    sent += 1
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # 受け手のいないソケット（落ちたワーカー）。一覧は次の publish で取り直す
+                    self._peers = None
+                    try:
+                        os.unlink(p)
+                    except OSError:
+                        pass
+                except BlockingIOError:
+                    self.dropped += 1
+                    print(f"[BUS] {os.path.basename(p)} is not reading, dropped")
+                except OSError as e:
+                    self.dropped += 1
+                    print(f"[BUS] send to {os.path.basename(p)} failed: {e}")
+        return sent
+
+    def _run(self) -> None:
+        while True:
+            sock = self._sock
+            if sock is None:
+                return
+            try:
+                data = sock.recv(MAX_DGRAM)
+            except OSError:
+                return
+            try:
+                msg = json.loads(data.decode("utf-8"))
+            except Exception:
+                continue
+            if isinstance(msg, dict) and msg.get("ch") == HELLO_CH:
+                self._peers = None
+                continue
+            try:
+                self.on_message(msg)
+            except Exception as e:
+                print(f"[BUS] handler error: {e}")
+
+
+# ==== リーダー選出 ============================================================
+class LeaderLock:
+    """
+    data/run/leader.lock を flock で取れたワーカーがリーダー。
+    取れなかったワーカーは裏で取り直し続け、取れた時に on_acquire() を呼ぶ（監視スレッドから）。
+    fcntl が無い環境では単一ワーカーとみなして常にリーダー。
+    """
+
+    def __init__(self, path: str, on_acquire: Optional[Callable[[], None]] = None) -> None:
+        self.path = path
+        self.on_acquire = on_acquire
+        self.is_leader = False
+        self.since: Optional[float] = None
+        self._fd: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """すぐに1回試す（取れたら on_acquire は呼ばず True を返す）"""
+        if self._try():
+            return True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="leader-lock", daemon=True)
+        self._thread.start()
+        return False
+
+    def stop(self) -> None:
+        self._stop.set()
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            try:
+                os.close(fd)      # flock も外れる
+            except OSError:
+                pass
+        self.is_leader = False
+
+    def _try(self) -> bool:
+        if not _HAS_FCNTL:
+            self.is_leader, self.since = True, time.time()
+            return True
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            print(f"[LEADER] lock file unavailable ({e}), acting as leader")
+            self.is_leader, self.since = True, time.time()
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        try:
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode("ascii"))
+        except OSError:
+            pass
+        self._fd = fd
+        self.is_leader, self.since = True, time.time()
+        print(f"[LEADER] pid {os.getpid()} is the leader")
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(LEADER_RETRY_SEC):
+            if self._try():
+                if self.on_acquire:
+                    try:
+                        self.on_acquire()
+                    except Exception as e:
+                        print(f"[LEADER] on_acquire error: {e}")
+                return
+
+
+# ==== 共有状態ファイル ========================================================
+class SharedState:
+    """書くのはリーダーだけ。読む側は mtime が変わった時だけ読み直す"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime_ns: Optional[int] = None
+        self._data: Dict[str, Any] = {}
+
+    def write(self, data: Dict[str, Any]) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[SHARED] write failed: {e}")
+
+    def read(self) -> Dict[str, Any]:
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return {}
+        with self._lock:
+            if mtime_ns != self._mtime_ns:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._data = json.load(f)
+                    self._mtime_ns = mtime_ns
+                except Exception:
+                    pass
+            return self._data
+
+
+class FileWatch:
+    """changed() は前回 mark() / changed() 以降にファイルが置き換わっていれば True"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._sig = self._stat()
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_ino, st.st_size)
+        except OSError:
+            return None
+
+    def mark(self) -> None:
+        self._sig = self._stat()
+
+    def changed(self) -> bool:
+        sig = self._stat()
+        if sig == self._sig:
+            return False
+        self._sig = sig
+        return True
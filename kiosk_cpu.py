@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+キオスクの Chromium の CPU 使用率を測る（プレイヤーの変更の前後を比べる用）。
+
+/proc/<pid>/stat の utime + stime を一定時間の前後で読み、Chromium のプロセスを種類ごと
+（browser / renderer / gpu-process / utility など。cmdline の --type=）に合計する。
+値は「1コアの何 %」（4コアの Pi なら最大 400%）。
+
+使い方（Pi の上で、スライドショーが動いている状態で）:
+    python3 kiosk_cpu.py --seconds 60
+    python3 kiosk_cpu.py --seconds 60 --json before.json     # 変更前
+    python3 kiosk_cpu.py --seconds 60 --json after.json      # 変更後（同じ表示秒数・フェードで）
+
+標準ライブラリだけで動く。
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+NAMES = ("chromium", "chromium-browse", "chromium-browser", "chrome")
+
+
+def _clk_tck() -> int:
+    try:
+        return os.sysconf("SC_CLK_TCK")
+    except (ValueError, OSError, AttributeError):
+        return 100
+
+
+def _proc_kind(pid: int) -> Optional[str]:
+    """Chromium なら種類（--type= の値、無ければ browser）。違えば None"""
+    try:
+        with open(f"/proc/{pid}/comm", "r") as f:
+            comm = f.read().strip()
+        if comm not in NAMES:
+            return None
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            args = f.read().split(b"\0")
+    except OSError:
+        return None
+    for a in args:
+        if a.startswith(b"--type="):
+            return a[7:].decode("ascii", "replace")
+    return "browser"
+
+
+def _cpu_ticks(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return int(fields[11]) + int(fields[12])     # utime + stime
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def snapshot() -> Dict[int, Tuple[str, int]]:
+    out: Dict[int, Tuple[str, int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        pid = int(name)
+        kind = _proc_kind(pid)
+        if kind is None:
+            continue
+        ticks = _cpu_ticks(pid)
+        if ticks is not None:
+            out[pid] = (kind, ticks)
+    return out
+
+
+def measure(seconds: float, interval: float) -> Dict[str, object]:
+    tck = _clk_tck()
+    first = snapshot()
+    if not first:
+        sys.exit("[kiosk_cpu] no Chromium processes found")
+    prev = dict(first)
+    seen = dict(first)                 # 途中で消えたプロセスも最後に読めた値を残す
+    samples: List[float] = []
+    t0 = last = time.monotonic()
+    while time.monotonic() - t0 < seconds:
+        time.sleep(interval)
+        cur = snapshot()
+        now = time.monotonic()
+        used = sum(t - prev[p][1] for p, (_, t) in cur.items() if p in prev)
+        samples.append(used / tck / (now - last) * 100.0)
+        seen.update(cur)
+        prev, last = cur, now
+    elapsed = last - t0
+
+    # 途中で消えたプロセス（レンダラの入れ替えなど）は最後に読めた値まで、途中で増えたものは 0 から数える
+    by_kind: Dict[str, float] = {}
+    for pid, (kind, t_end) in seen.items():
+        start = first[pid][1] if pid in first else 0
+        by_kind[kind] = by_kind.get(kind, 0.0) + (t_end - start)
+    total = sum(by_kind.values())
+    v = sorted(samples)
+    return {
+        "seconds": round(elapsed, 1),
+        "processes": len(seen),
+        "cpu_pct": round(total / tck / elapsed * 100.0, 1) if elapsed else None,
+        "by_type_pct": {k: round(t / tck / elapsed * 100.0, 1)
+                        for k, t in sorted(by_kind.items(), key=lambda kv: -kv[1])},
+        "peak_pct": round(v[-1], 1) if v else None,
+        "p50_pct": round(v[len(v) // 2], 1) if v else None,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Measure kiosk Chromium CPU usage")
+    ap.add_argument("--seconds", type=float, default=30.0, help="measurement length")
+    ap.add_argument("--interval", type=float, default=1.0, help="sample interval for peak/p50")
+    ap.add_argument("--json", help="also write the result to this file")
+    args = ap.parse_args()
+
+    print(f"[kiosk_cpu] measuring {args.seconds:.0f}s ...")
+    out = measure(args.seconds, max(0.1, args.interval))
+    print(f"[kiosk_cpu] total {out['cpu_pct']}% of one core (p50 {out['p50_pct']}%, "
+          f"peak {out['peak_pct']}%) over {out['seconds']}s, {out['processes']} processes")
+    for kind, pct in out["by_type_pct"].items():
+        print(f"  {kind:16s} {pct:6.1f}%")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+        print(f"[kiosk_cpu] written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
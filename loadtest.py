@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SuperPhotoframe 負荷試験（何台のフレーム・スマホまで1台の Pi で持つかを見る）。
+
+同時に動かすもの:
+- SSE      : N 本の /api/events（フレームのプレイヤー相当）。/api/events/probe で流した
+             "probe" の到着遅延と取りこぼしを数える
+- ロータリー: M 本の /ws/rotary。それぞれが回転のバーストを送り、他のクライアントへの
+             中継遅延と取りこぼしを数える
+- プレイヤー: K 台が /api/playlist を取り、スライドショーの間隔で /media/{id}?size=display を取る
+- メモリ    : サーバの RSS を1秒ごとに記録（--spawn なら全ワーカーの合計、それ以外は /api/metrics）
+
+使い方:
+    # 使い捨てのデータディレクトリと合成ライブラリでサーバを立てて試す（本番のデータに触らない）
+    python3 loadtest.py --spawn --photos 2000 --workers 2 --sse 20 --ws 8 --players 10 --duration 60
+
+    # 動いているサーバに対して（選択フォルダはそのまま使う。SSE の遅延を測るならサーバを
+    # RASPIFRAME_LOADTEST=1 で起動しておく）
+    python3 loadtest.py --url http://raspiframe.local:8000 --sse 10 --players 5
+
+依存は websockets（rotary.py と同じ）と、合成ライブラリを作る時だけ Pillow。
+HTTP は標準ライブラリの asyncio で話す（keep-alive・chunked だけ対応した最小限のクライアント）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    import websockets
+    _HAS_WS = True
+except Exception:
+    _HAS_WS = False
+
+try:
+    from PIL import Image
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS = ("ACME Alpha", "ACME Beta", "Contoso X100", "Fabrikam Z9")
+
+
+# ==== 集計 ====================================================================
+class Stats:
+    def __init__(self) -> None:
+        self.latency: Dict[str, List[float]] = {}     # ルート -> 秒
+        self.errors: Dict[str, int] = {}
+        self.sse_delay: List[float] = []
+        self.sse_expected = 0
+        self.sse_received = 0
+        self.ws_delay: List[float] = []
+        self.ws_expected = 0
+        self.ws_received = 0
+        self.rss: List[float] = []
+
+    def record(self, route: str, sec: float, ok: bool) -> None:
+        self.latency.setdefault(route, []).append(sec)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def _pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    v = sorted(values)
+    return v[min(len(v) - 1, int(round(p / 100.0 * (len(v) - 1))))]
+
+
+def _ms(v: Optional[float]) -> str:
+    return "-" if v is None else f"{v * 1000:.1f}"
+
+
+# ==== 最小限の HTTP/1.1 クライアント ==========================================
+class HttpConn:
+    """1本の keep-alive 接続。切れていたら次のリクエストでつなぎ直す"""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host, self.port = host, port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method: str, path: str,
+                      body: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes]:
+        for attempt in (0, 1):
+            if self.writer is None:
+                await self._connect()
+            try:
+                await self._send(method, path, body)
+                return await self._read_response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt:
+                    raise
+        raise ConnectionError("unreachable")
+
+    async def _send(self, method: str, path: str, body: Optional[Dict[str, Any]]) -> None:
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+        if body is not None:
+            head += f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+        self.writer.write(head.encode("ascii") + b"\r\n" + data)
+        await self.writer.drain()
+
+    async def _read_response(self) -> Tuple[int, bytes]:
+        status, headers = await read_head(self.reader)
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            async for chunk in read_chunks(self.reader):
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await self.reader.read()
+            self.close()
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, data
+
+
+async def read_head(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str]]:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    status = int(line.split()[1])
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return status, headers
+
+
+async def read_chunks(reader: asyncio.StreamReader):
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            await reader.readline()
+            return
+        chunk = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield chunk
+
+
+async def timed(stats: Stats, conn: HttpConn, route: str, method: str, path: str,
+                body: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes]:
+    t0 = time.perf_counter()
+    try:
+        status, data = await conn.request(method, path, body)
+    except (OSError, ConnectionError, asyncio.IncompleteReadError):
+        stats.record(route, time.perf_counter() - t0, False)
+        return 0, b""
+    stats.record(route, time.perf_counter() - t0, status < 400)
+    return status, data
+
+
+# ==== 各クライアント ==========================================================
+class SseClient:
+    def __init__(self, host: str, port: int, frame: str, stats: Stats) -> None:
+        self.host, self.port, self.frame, self.stats = host, port, frame, stats
+        self.connected = asyncio.Event()
+        self.seen: set = set()
+
+    async def run(self) -> None:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write((f"GET /api/events?frame={self.frame} HTTP/1.1\r\n"
+                          f"Host: {self.host}:{self.port}\r\nAccept: text/event-stream\r\n\r\n").encode("ascii"))
+            await writer.drain()
+            await read_head(reader)
+            buf = b""
+            async for chunk in read_chunks(reader):
+                self.connected.set()
+                buf += chunk
+                while b"\n\n" in buf:
+                    block, buf = buf.split(b"\n\n", 1)
+                    self._on_block(block)
+        finally:
+            writer.close()
+
+    def _on_block(self, block: bytes) -> None:
+        for line in block.split(b"\n"):
+            if not line.startswith(b"data: "):
+                continue
+            try:
+                msg = json.loads(line[6:])
+            except Exception:
+                continue
+            if msg.get("type") == "probe" and msg.get("seq") not in self.seen:
+                self.seen.add(msg.get("seq"))
+                self.stats.sse_received += 1
+                self.stats.sse_delay.append(time.time() - float(msg.get("t") or 0))
+
+
+async def sse_prober(host: str, port: int, clients: List[SseClient], stats: Stats,
+                     interval: float, stop: asyncio.Event) -> None:
+    conn = HttpConn(host, port)
+    seq = 0
+    while not stop.is_set():
+        seq += 1
+        live = sum(1 for c in clients if c.connected.is_set())
+        status, _ = await timed(stats, conn, "POST /api/events/probe", "POST", "/api/events/probe",
+                                {"seq": seq, "t": time.time()})
+        if status == 200:
+            stats.sse_expected += live
+        elif status == 404:
+            # サーバが RASPIFRAME_LOADTEST=1 で起動していない（probe のルートが無い）
+            print("[loadtest] /api/events/probe is not enabled (start the server with RASPIFRAME_LOADTEST=1); "
+                  "SSE delay is not measured")
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    conn.close()
+
+
+async def ws_client(url: str, idx: int, peers: int, stats: Stats, burst: int,
+                    interval: float, stop: asyncio.Event, ready: asyncio.Barrier) -> None:
+    async with websockets.connect(url, max_queue=None) as ws:
+        await ready.wait()
+
+        async def receiver():
+            async for text in ws:
+                # "rotary_left lt:<送り手>:<seq>:<送信時刻>"
+                parts = str(text).split(" lt:", 1)
+                if len(parts) != 2:
+                    continue
+                try:
+                    sent = float(parts[1].split(":")[2])
+                except (IndexError, ValueError):
+                    continue
+                stats.ws_received += 1
+                stats.ws_delay.append(time.time() - sent)
+
+        rx = asyncio.create_task(receiver())
+        seq = 0
+        try:
+            # 全員が同時にバーストしないように少しずらす
+            await asyncio.sleep(random.random() * interval)
+            while not stop.is_set():
+                for _ in range(burst):
+                    seq += 1
+                    d = random.choice(("left", "right"))
+                    await ws.send(f"rotary_{d} lt:{idx}:{seq}:{time.time()}")
+                    stats.ws_expected += peers
+                    await asyncio.sleep(0.01)    # ノブを速く回した時くらいの間隔
+                try:
+                    await asyncio.wait_for(stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.sleep(1.0)             # 中継の残りを受け取る
+        finally:
+            rx.cancel()
+
+
+async def player(host: str, port: int, frame: str, stats: Stats, cadence: float,
+                 stop: asyncio.Event) -> None:
+    conn = HttpConn(host, port)
+    status, data = await timed(stats, conn, "GET /api/playlist", "GET", f"/api/playlist?frame={frame}")
+    try:
+        ids = [it["id"] for it in json.loads(data)["images"]] if status == 200 else []
+    except Exception:
+        ids = []
+    if not ids:
+        print(f"[loadtest] player {frame}: empty playlist")
+        conn.close()
+        return
+    i = random.randrange(len(ids))
+    await asyncio.sleep(random.random() * cadence)
+    while not stop.is_set():
+        await timed(stats, conn, "GET /media/{id}", "GET", f"/media/{ids[i % len(ids)]}?size=display")
+        i += 1
+        # 1周したらプレイリストを取り直す（プレイヤーの selection_changed 相当）
+        if i % len(ids) == 0:
+            await timed(stats, conn, "GET /api/playlist", "GET", f"/api/playlist?frame={frame}")
+        try:
+            await asyncio.wait_for(stop.wait(), cadence)
+        except asyncio.TimeoutError:
+            pass
+    conn.close()
+
+
+# ==== サーバのメモリ ==========================================================
+def _proc_rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _tree_pids(root: int) -> List[int]:
+    """root とその子孫（uvicorn --workers の子プロセス）"""
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    out, todo = [], [root]
+    while todo:
+        p = todo.pop()
+        out.append(p)
+        todo.extend(children.get(p, ()))
+    return out
+
+
+async def rss_sampler(host: str, port: int, server_pid: Optional[int], stats: Stats,
+                      stop: asyncio.Event) -> None:
+    conn = HttpConn(host, port)
+    while not stop.is_set():
+        if server_pid is not None:
+            stats.rss.append(sum(_proc_rss_mb(p) for p in _tree_pids(server_pid)))
+        else:
+            try:
+                status, data = await conn.request("GET", "/api/metrics")
+                rss = json.loads(data).get("worker", {}).get("rss_mb") if status == 200 else None
+                if rss is not None:
+                    stats.rss.append(float(rss))
+            except Exception:
+                conn.close()
+        try:
+            await asyncio.wait_for(stop.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+    conn.close()
+
+
+# ==== 合成ライブラリと使い捨てサーバ ==========================================
+def make_library(root: str, n: int) -> None:
+    """撮影日・機種を散らした JPEG を n 枚（フォルダ100枚ずつ）"""
+    if not _HAS_PIL:
+        sys.exit("[loadtest] Pillow is required to build the synthetic library")
+    rnd = random.Random(1)
+    t0 = time.time()
+    for i in range(n):
+        sub = os.path.join(root, f"{2015 + i % 10}", f"d{i // 100:04d}")
+        os.makedirs(sub, exist_ok=True)
+        im = Image.new("RGB", (1600, 1200), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        exif = im.getexif()
+        exif[0x0132] = (f"{2015 + i % 10}:{1 + rnd.randrange(12):02d}:{1 + rnd.randrange(28):02d} "
+                        f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00")
+        exif[0x0110] = rnd.choice(MODELS)
+        im.save(os.path.join(sub, f"IMG_{i:06d}.jpg"), quality=80, exif=exif)
+    print(f"[loadtest] synthetic library: {n} photos in {time.time() - t0:.1f}s -> {root}")
+
+
+def spawn_server(work: str, port: int, workers: int, photos: int) -> subprocess.Popen:
+    lib = os.path.join(work, "library")
+    data = os.path.join(work, "data")
+    os.makedirs(data, exist_ok=True)
+    make_library(lib, photos)
+    with open(os.path.join(data, "selection.json"), "w", encoding="utf-8") as f:
+        json.dump({"folders": [lib]}, f)
+    env = {**os.environ, "RASPIFRAME_DATA_DIR": data, "RASPIFRAME_LOADTEST": "1"}
+    cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+           "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    print(f"[loadtest] starting server: {' '.join(cmd[2:])}")
+    return subprocess.Popen(cmd, cwd=ROOT_DIR, env=env, start_new_session=True)
+
+
+async def wait_ready(host: str, port: int, timeout: float) -> None:
+    conn = HttpConn(host, port)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, data = await conn.request("GET", "/api/ready")
+            if status == 200 and json.loads(data).get("ready"):
+                conn.close()
+                return
+        except (OSError, ConnectionError, ValueError):
+            conn.close()
+        await asyncio.sleep(0.5)
+    sys.exit("[loadtest] server did not become ready")
+
+
+async def warm_playlist(host: str, port: int) -> None:
+    """最初のスキャン（EXIF 読み）は計測に入れない"""
+    conn = HttpConn(host, port)
+    t0 = time.monotonic()
+    await conn.request("GET", "/api/playlist")
+    conn.close()
+    print(f"[loadtest] initial playlist build: {time.monotonic() - t0:.1f}s")
+
+
+# ==== 本体 ====================================================================
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    u = urlsplit(args.url)
+    host, port = u.hostname or "127.0.0.1", u.port or 80
+    ws_base = f"ws://{host}:{port}/ws/rotary"
+    server: Optional[subprocess.Popen] = None
+    work: Optional[str] = None
+    if args.spawn:
+        work = tempfile.mkdtemp(prefix="spf-loadtest-")
+        server = spawn_server(work, port, args.workers, args.photos)
+    try:
+        await wait_ready(host, port, 120.0)
+        await warm_playlist(host, port)
+        stats = Stats()
+        stop = asyncio.Event()
+        tasks: List[asyncio.Task] = []
+
+        sse = [SseClient(host, port, f"lt-sse-{i}", stats) for i in range(args.sse)]
+        tasks += [asyncio.create_task(c.run()) for c in sse]
+        if sse:
+            await asyncio.wait([asyncio.create_task(c.connected.wait()) for c in sse], timeout=10)
+            tasks.append(asyncio.create_task(sse_prober(host, port, sse, stats, args.probe_interval, stop)))
+
+        if args.ws:
+            if not _HAS_WS:
+                sys.exit("[loadtest] websockets is required for --ws")
+            # 同じフレームのクライアント同士で中継し合う（フレームごとに ws_group 台）
+            ready = asyncio.Barrier(args.ws)
+            for i in range(args.ws):
+                group = i // args.ws_group
+                peers = min(args.ws_group, args.ws - group * args.ws_group) - 1
+                tasks.append(asyncio.create_task(ws_client(
+                    f"{ws_base}?frame=lt-ws-{group}", i, peers, stats, args.burst,
+                    args.burst_interval, stop, ready)))
+
+        tasks += [asyncio.create_task(player(host, port, f"lt-player-{i}", stats, args.cadence, stop))
+                  for i in range(args.players)]
+        tasks.append(asyncio.create_task(rss_sampler(host, port, server.pid if server else None,
+                                                     stats, stop)))
+
+        print(f"[loadtest] running {args.duration:.0f}s: sse={args.sse} ws={args.ws} players={args.players}")
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.sleep(1.5)       # 最後の probe・中継が届くのを待つ
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if server is None and sse:
+            # 動いているサーバには試験用のフレームを残さない
+            conn = HttpConn(host, port)
+            for c in sse:
+                await conn.request("DELETE", f"/api/frames/{c.frame}")
+            conn.close()
+        return report(stats, args)
+    finally:
+        if server is not None:
+            os.killpg(server.pid, signal.SIGTERM)
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+        if work and not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+def report(stats: Stats, args: argparse.Namespace) -> Dict[str, Any]:
+    out: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items() if k != "json"}, "routes": {}}
+    print("")
+    print(f"{'route':28s} {'count':>7s} {'err':>5s} {'p50 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    for route, vals in sorted(stats.latency.items()):
+        row = {"count": len(vals), "errors": stats.errors.get(route, 0),
+               "p50_ms": _pct(vals, 50), "p99_ms": _pct(vals, 99), "max_ms": max(vals)}
+        out["routes"][route] = {k: (round(v * 1000, 2) if k.endswith("_ms") else v) for k, v in row.items()}
+        print(f"{route:28s} {row['count']:7d} {row['errors']:5d} {_ms(row['p50_ms']):>9s} "
+              f"{_ms(row['p99_ms']):>9s} {_ms(row['max_ms']):>9s}")
+
+    def delivery(name: str, delays: List[float], expected: int, received: int) -> None:
+        dropped = max(0, expected - received)
+        out[name] = {"expected": expected, "received": received, "dropped": dropped,
+                     "p50_ms": round(_pct(delays, 50) * 1000, 2) if delays else None,
+                     "p99_ms": round(_pct(delays, 99) * 1000, 2) if delays else None}
+        print(f"{name:28s} delivered {received}/{expected} (dropped {dropped}), "
+              f"delay p50 {_ms(_pct(delays, 50))} ms / p99 {_ms(_pct(delays, 99))} ms")
+
+    print("")
+    if args.sse:
+        delivery("sse_events", stats.sse_delay, stats.sse_expected, stats.sse_received)
+    if args.ws:
+        delivery("ws_relay", stats.ws_delay, stats.ws_expected, stats.ws_received)
+    if stats.rss:
+        out["server_rss_mb"] = {"start": round(stats.rss[0], 1), "peak": round(max(stats.rss), 1),
+                                "end": round(stats.rss[-1], 1)}
+        print(f"{'server RSS':28s} start {stats.rss[0]:.1f} MB, peak {max(stats.rss):.1f} MB, "
+              f"end {stats.rss[-1]:.1f} MB" + ("" if args.spawn else " (one worker, via /api/metrics)"))
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="SuperPhotoframe load test")
+    ap.add_argument("--url", default="http://127.0.0.1:8000", help="server base URL")
+    ap.add_argument("--spawn", action="store_true",
+                    help="start a throwaway server on --url's port with a synthetic library")
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn workers for --spawn")
+    ap.add_argument("--photos", type=int, default=1000, help="synthetic library size for --spawn")
+    ap.add_argument("--keep", action="store_true", help="keep the --spawn work directory")
+    ap.add_argument("--sse", type=int, default=10, help="SSE streams (N)")
+    ap.add_argument("--ws", type=int, default=4, help="rotary WebSocket clients (M)")
+    ap.add_argument("--ws-group", type=int, default=2, help="rotary clients sharing one frame")
+    ap.add_argument("--burst", type=int, default=10, help="rotary messages per burst")
+    ap.add_argument("--burst-interval", type=float, default=2.0, help="seconds between bursts")
+    ap.add_argument("--players", type=int, default=5, help="slideshow players (K)")
+    ap.add_argument("--cadence", type=float, default=2.0, help="seconds per slide for players")
+    ap.add_argument("--probe-interval", type=float, default=0.5, help="seconds between SSE probes")
+    ap.add_argument("--duration", type=float, default=30.0, help="test length in seconds")
+    ap.add_argument("--json", help="also write the report to this file")
+    args = ap.parse_args()
+    if args.ws == 1:
+        ap.error("--ws needs at least 2 clients (messages are relayed to the others)")
+    args.ws_group = max(2, args.ws_group)
+
+    out = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+        print(f"[loadtest] report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
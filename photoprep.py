@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+写真ライブラリを前もって下ごしらえする（フレームではなく、デスクトップの全コアで）。
+
+大きな NAS のライブラリを Pi が自分で縮小すると何日もかかる。そこで、アプリと同じコード
+（app/photo_index.py の EXIF 読み・app/derivatives.py の縮小）で、ツリーの根に次を書く:
+
+    <根>/.superphotoframe/index.json.gz                 持ち運べるインデックス（パックと同じ形式。連写をまとめる dHash 入り）
+    <根>/.superphotoframe/display/<相対パス>.jpg         表示用（1280x800 に収める）
+    <根>/.superphotoframe/thumb/<相対パス>.jpg           サムネイル（160px）
+    <根>/.superphotoframe/micro/<相対パス>.jpg           スクラブ用（320px。--kinds で指定した時）
+
+サーバはパックをそのまま取り込み（EXIF を読み直さない）、派生画像は自分で作らずにこれを返す。
+派生画像の mtime は元ファイルに揃えてあり、揃っていないもの（元ファイルが変わった）は使わない。
+
+何度でも実行できる: インデックスは size / mtime が同じなら読み直さず、派生画像は mtime が
+揃っていれば作り直さない。途中で止めても（Ctrl-C）それまでの分は残り、次はその続きから。
+パックは --checkpoint 秒ごとにも書く。
+
+使い方（アプリのディレクトリで。Pillow が要る）:
+    python3 photoprep.py /mnt/nas/Photos
+    python3 photoprep.py /mnt/nas/Photos --jobs 8 --kinds display,thumb,micro
+    python3 photoprep.py /mnt/nas/Photos --dry-run       # やることを数えるだけ
+    python3 photoprep.py /mnt/nas/Photos --prune         # 元ファイルが無くなった派生画像を消す
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import bursts, derivatives, photo_index
+
+
+PROGRESS_SEC = 5.0
+
+
+def _init_worker() -> None:
+    # Ctrl-C は親だけが受ける（親がプールを止めてパックを書く）
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _work(task: Tuple[str, os.stat_result, str, bool, List[str]]
+          ) -> Tuple[str, Optional[list], List[str], List[str]]:
+    """1ファイル分（子プロセスで動く）: (パス, インデックスの行 or None, 作った種類, 失敗した種類)"""
+    path, st, root, need_entry, kinds = task
+    row = None
+    if need_entry:
+        try:
+            e = photo_index.make_entry(path, st)
+            h = bursts.dhash(path)
+            e.dhash = h if h is not None else bursts.UNHASHABLE
+            row = e.to_row()
+        except Exception as e:
+            print(f"[prep] metadata failed {path}: {e}")
+    done: List[str] = []
+    failed: List[str] = []
+    for kind in kinds:
+        (done if derivatives.make_prebuilt(path, st, root, kind) else failed).append(kind)
+    return path, row, done, failed
+
+
+def plan(root: str, kinds: List[str], force: bool
+         ) -> Tuple[Dict[str, photo_index.Entry], List[Tuple[str, os.stat_result, str, bool, List[str]]], set]:
+    """
+    ツリーを歩いて (使い回せるインデックス, 仕事, 見つけたパス) を返す。
+    パックに同じ size / mtime の行（dHash 入り）があれば EXIF は読まない。派生画像は mtime が揃っていれば作らない。
+    """
+    pack = photo_index.pack_path(root)
+    old = (photo_index.read_pack(pack) or {}) if os.path.isfile(pack) and not force else {}
+    keep: Dict[str, photo_index.Entry] = {}
+    tasks = []
+    seen = set()
+    for path, st in photo_index.walk(root):
+        seen.add(path)
+        e = old.get(path)
+        need_entry = e is None or not e.matches(st) or e.dhash is None
+        if not need_entry:
+            keep[path] = e
+        todo = [k for k in kinds
+                if force or not derivatives.prebuilt_fresh(derivatives.prebuilt_path(root, path, k), st.st_mtime_ns)]
+        if need_entry or todo:
+            tasks.append((path, st, root, need_entry, todo))
+    return keep, tasks, seen
+
+
+def prune(root: str, kinds: List[str], seen: set, dry_run: bool) -> int:
+    """元ファイルの無くなった派生画像を消す"""
+    removed = 0
+    for kind in kinds:
+        base = os.path.join(root, photo_index.PACK_DIR, kind)
+        for d, _, files in os.walk(base):
+            for name in files:
+                if not name.endswith(".jpg"):
+                    continue
+                rel = os.path.relpath(os.path.join(d, name), base)[:-4]
+                if os.path.join(root, rel) in seen:
+                    continue
+                removed += 1
+                if not dry_run:
+                    try:
+                        os.remove(os.path.join(d, name))
+                    except OSError as e:
+                        print(f"[prep] cannot remove {name}: {e}")
+    return removed
+
+
+def _fmt_sec(sec: float) -> str:
+    sec = int(sec)
+    return f"{sec // 3600}h{sec // 60 % 60:02d}m" if sec >= 3600 else f"{sec // 60}m{sec % 60:02d}s"
+
+
+def run(root: str, kinds: List[str], jobs: int, force: bool, checkpoint: float
+        ) -> Tuple[Dict[str, Any], set]:
+    t0 = time.monotonic()
+    entries, tasks, seen = plan(root, kinds, force)
+    total = len(tasks)
+    print(f"[prep] {len(seen)} photos under {root}: {len(entries)} indexed already, "
+          f"{total} to process with {jobs} worker(s)")
+    stats: Dict[str, Any] = {"photos": len(seen), "processed": 0, "indexed": 0,
+                             "rendered": {k: 0 for k in kinds}, "failed": 0, "interrupted": False}
+
+    def save() -> None:
+        photo_index.write_pack(root, sorted(entries.items()), generator="photoprep")
+
+    if tasks:
+        last_save = last_log = time.monotonic()
+        # 重いファイル（大きい順）を先に配ると、最後に1プロセスだけ残って待つ時間が短くなる
+        tasks.sort(key=lambda t: -t[1].st_size)
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+        try:
+            for path, row, done, failed in pool.imap_unordered(_work, tasks, chunksize=4):
+                stats["processed"] += 1
+                if row is not None:
+                    entries[path] = photo_index.Entry.from_row(row)
+                    stats["indexed"] += 1
+                for k in done:
+                    stats["rendered"][k] += 1
+                if failed:
+                    stats["failed"] += 1
+                now = time.monotonic()
+                if now - last_log >= PROGRESS_SEC:
+                    n = stats["processed"]
+                    rate = n / (now - t0)
+                    print(f"[prep] {n}/{total} ({n * 100 / total:.1f}%), {rate:.1f} files/s, "
+                          f"ETA {_fmt_sec((total - n) / rate) if rate else '?'}")
+                    last_log = now
+                if now - last_save >= checkpoint:
+                    save()
+                    last_save = now
+        except KeyboardInterrupt:
+            stats["interrupted"] = True
+            print("[prep] interrupted; saving progress (run again to continue)")
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # 見つからなくなったファイルの行は落とす
+    for p in [p for p in entries if p not in seen]:
+        del entries[p]
+    save()
+    stats["entries"] = len(entries)
+    stats["seconds"] = round(time.monotonic() - t0, 1)
+    return stats, seen
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Build derivatives and an index pack for a photo tree")
+    ap.add_argument("root", help="photo tree root (the folder the frame selects, or a parent of it)")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    ap.add_argument("--kinds", default="display,thumb",
+                    help="derivatives to build, comma separated (display, thumb, micro; empty for index only)")
+    ap.add_argument("--force", action="store_true", help="rebuild everything")
+    ap.add_argument("--prune", action="store_true", help="remove derivatives whose original is gone")
+    ap.add_argument("--dry-run", action="store_true", help="only count what would be done")
+    ap.add_argument("--checkpoint", type=float, default=30.0, help="write the index pack every N seconds")
+    args = ap.parse_args()
+
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(root):
+        sys.exit(f"[prep] not a directory: {root}")
+    kinds = [k.strip() for k in args.kinds.split(",") if k.strip()]
+    bad = [k for k in kinds if k not in derivatives.SIZES]
+    if bad:
+        sys.exit(f"[prep] unknown kind(s): {', '.join(bad)} (choose from {', '.join(derivatives.SIZES)})")
+    if kinds and not derivatives._HAS_PIL:
+        sys.exit("[prep] Pillow is required to build derivatives (pip install Pillow)")
+
+    if args.dry_run:
+        entries, tasks, seen = plan(root, kinds, args.force)
+        need_entry = sum(1 for t in tasks if t[3])
+        print(f"[prep] {len(seen)} photos: {len(entries)} indexed already, {need_entry} need metadata")
+        for k in kinds:
+            print(f"  {k:8s} {sum(1 for t in tasks if k in t[4])} to build")
+        if args.prune:
+            print(f"[prep] {prune(root, kinds, seen, dry_run=True)} stale derivative(s) would be removed")
+        return
+
+    stats, seen = run(root, kinds, max(1, args.jobs), args.force, max(1.0, args.checkpoint))
+    built = ", ".join(f"{k} {n}" for k, n in stats["rendered"].items()) or "no derivatives"
+    print(f"[prep] {stats['processed']} processed in {_fmt_sec(stats['seconds'])}: "
+          f"{stats['indexed']} indexed, {built}, {stats['failed']} failed")
+    print(f"[prep] index pack: {stats['entries']} entries -> {photo_index.pack_path(root)}")
+    if args.prune and not stats["interrupted"]:
+        print(f"[prep] removed {prune(root, kinds, seen, dry_run=False)} stale derivative(s)")
+    if stats["interrupted"]:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
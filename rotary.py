@@ -4,28 +4,47 @@
 """
 Raspberry Pi rotary encoder → WebSocket event feeder.
 
-- gpiozero の pin factory を lgpio 固定
+- gpiozero の pin factory は既定で lgpio（GPIOZERO_PIN_FACTORY を指定すればそれ。
+  mock にすればハードウェア無しで動く。rotary_replay.py が使う）
 - 回転: 'rotary_left' / 'rotary_right'
 - 押し込み(任意): 'rotary_push'
+- 遅延計測: 既定では上の種類を JSON で送り、連番と monotonic の時刻を付ける
+    {"type": "rotary_left", "seq": 12, "trace": {"edge", "haptic_ms", "queued", "sent", "boot"}}
+  （boot は起動ごとの ID。サーバが同じマシンの時だけ時刻どうしを比べる）
+  （サーバ・プレイヤーが区間ごとの時間を足し、/api/rotary/latency に集計される）
 - ハプティクスフィードバック (DRV2605L + LRA)
 - 環境変数:
     ROT_A, ROT_B, ROT_SW, ROT_REVERSE
+    GPIOZERO_PIN_FACTORY (lgpio / mock など。未指定なら lgpio)
     ROTARY_WS_URL  (旧互換: RASPIFRAME_WS)
     HAPTIC_ENABLE  (0/1, デフォルト=1)
     HAPTIC_EFFECT  (1-123, デフォルト=1: Strong Click)
+    ROTARY_TRACE   (0/1, デフォルト=1。0 なら素の文字列だけ送る)
 """
 
 import asyncio
+import json
 import os
 import sys
-from typing import Optional, Callable
+import time
+from typing import Any, Callable, Dict, Optional
 
-# ---- gpiozero を lgpio で使う（Bookworm向け） -------------------------------
-from gpiozero import Device
-from gpiozero.pins.lgpio import LGPIOFactory
-Device.pin_factory = LGPIOFactory()
+from gpiozero import Device, RotaryEncoder, Button
+
+# 起動ごとの ID（サーバが同じマシンの時計か見分ける。app/latency.py と同じものを使う）
+from app.latency import BOOT_ID
 
-from gpiozero import RotaryEncoder, Button
+# ---- gpiozero を lgpio で使う（Bookworm向け） -------------------------------
+def setup_pin_factory() -> None:
+    """
+    GPIOZERO_PIN_FACTORY が指定されていれば gpiozero に任せる（mock でハードウェア無しなど）。
+    無ければ lgpio に固定する（Bookworm の既定の自動選択は RPi.GPIO を探しに行くため）。
+    RotarySource を作る前に呼ぶ。
+    """
+    if os.environ.get("GPIOZERO_PIN_FACTORY"):
+        return
+    from gpiozero.pins.lgpio import LGPIOFactory
+    Device.pin_factory = LGPIOFactory()
 
 # ---- 設定（環境変数優先・デフォルト併用） ---------------------------------
 def _env_int(name: str, default: Optional[int]) -> Optional[int]:
@@ -56,9 +75,13 @@ SEND_INTERVAL_SEC: float = 0.002  # 送り過ぎ防止のごく短い間隔
 HAPTIC_ENABLE: bool = os.environ.get("HAPTIC_ENABLE", "1") not in ("", "0", "false", "False")
 HAPTIC_EFFECT: int = _env_int("HAPTIC_EFFECT", 1) or 1
 
+# 遅延計測のトレースを付けるか
+TRACE: bool = os.environ.get("ROTARY_TRACE", "1") not in ("", "0", "false", "False")
+
+
 print(f"[rotary] PIN_A={PIN_A} PIN_B={PIN_B} PIN_SW={PIN_SW} REVERSE={REVERSE}")
 print(f"[rotary] WS_URL={WS_URL}")
-print(f"[rotary] HAPTIC_ENABLE={HAPTIC_ENABLE} EFFECT={HAPTIC_EFFECT}")
+print(f"[rotary] HAPTIC_ENABLE={HAPTIC_ENABLE} EFFECT={HAPTIC_EFFECT} TRACE={TRACE}")
 
 # ---- Haptic Feedback (DRV2605L) --------------------------------------------
 class HapticFeedback:
@@ -104,11 +127,15 @@ class HapticFeedback:
                 pass
 
 # ---- Rotary ラッパ ---------------------------------------------------------
+# コールバックに渡すトレース: {"seq", "edge"(monotonic), "haptic_ms"}
+Trace = Dict[str, Any]
+
 class RotarySource:
     """
     gpiozero.RotaryEncoder (+ optional Button) を包んで
     on_left/on_right/on_push コールバックを提供。
     オプションでハプティクスフィードバックも統合。
+    コールバックにはイベントごとの連番とエッジ時刻（Trace）を渡す。
     """
     def __init__(self, pin_a: int, pin_b: int,
                  pin_sw: Optional[int] = None, reverse: bool = False,
@@ -117,27 +144,33 @@ class RotarySource:
         self._last_steps = 0
         self._reverse = bool(reverse)
         self._haptic = haptic
+        self._seq = 0
 
-        self._cb_left: Optional[Callable[[], None]]  = None
-        self._cb_right: Optional[Callable[[], None]] = None
-        self._cb_push: Optional[Callable[[], None]]  = None
+        self._cb_left: Optional[Callable[[Trace], None]]  = None
+        self._cb_right: Optional[Callable[[Trace], None]] = None
+        self._cb_push: Optional[Callable[[Trace], None]]  = None
 
         def _on_rotated():
+            edge = time.monotonic()
             steps = self._enc.steps
             delta = steps - self._last_steps
             self._last_steps = steps
             if delta == 0:
                 return
             
-            # ハプティクスフィードバック
+            # ハプティクスフィードバック（I2C 書き込みの時間も測る）
+            haptic_ms = None
             if self._haptic:
+                t0 = time.monotonic()
                 self._haptic.trigger()
+                haptic_ms = (time.monotonic() - t0) * 1000.0
+            trace = self._next_trace(edge, haptic_ms)
             
             # 正方向判定（必要なら反転）
             if (delta > 0) ^ self._reverse:
-                if self._cb_right: self._cb_right()
+                if self._cb_right: self._cb_right(trace)
             else:
-                if self._cb_left:  self._cb_left()
+                if self._cb_left:  self._cb_left(trace)
 
         self._enc.when_rotated = _on_rotated
 
@@ -145,15 +178,20 @@ class RotarySource:
         if pin_sw is not None:
             # GND 落ち配線を想定 → 内部プルアップ
             self._btn = Button(pin_sw, pull_up=True, bounce_time=0.08)
-            self._btn.when_pressed = lambda: self._cb_push and self._cb_push()
+            self._btn.when_pressed = lambda: self._cb_push and self._cb_push(
+                self._next_trace(time.monotonic(), None))
+
+    def _next_trace(self, edge: float, haptic_ms: Optional[float]) -> Trace:
+        self._seq += 1
+        return {"seq": self._seq, "edge": edge, "haptic_ms": haptic_ms}
 
-    def on_left(self, cb: Callable[[], None]) -> None:
+    def on_left(self, cb: Callable[[Trace], None]) -> None:
         self._cb_left = cb
 
-    def on_right(self, cb: Callable[[], None]) -> None:
+    def on_right(self, cb: Callable[[Trace], None]) -> None:
         self._cb_right = cb
 
-    def on_push(self, cb: Callable[[], None]) -> None:
+    def on_push(self, cb: Callable[[Trace], None]) -> None:
         self._cb_push = cb
 
     def close(self) -> None:
@@ -173,6 +211,23 @@ class RotarySource:
                 pass
 
 # ---- WebSocket へ流す非同期ループ -----------------------------------------
+def encode(kind: str, trace: Trace) -> str:
+    """送る直前に呼ぶ（sent の時刻を入れる）"""
+    if not TRACE:
+        return kind
+    return json.dumps({
+        "type": kind, "seq": trace["seq"],
+        "trace": {"edge": trace["edge"], "haptic_ms": trace["haptic_ms"],
+                  "queued": trace.get("queued"), "sent": time.monotonic(), "boot": BOOT_ID or None},
+    }, separators=(",", ":"))
+
+def enqueue(loop: asyncio.AbstractEventLoop, q: "asyncio.Queue", kind: str) -> Callable[[Trace], None]:
+    """GPIO のコールバック（gpiozero のスレッド）からイベントループのキューへ"""
+    def cb(trace: Trace) -> None:
+        trace["queued"] = time.monotonic()
+        loop.call_soon_threadsafe(q.put_nowait, (kind, trace))
+    return cb
+
 async def ws_loop() -> None:
     import websockets  # インストール済み前提（venv）
 
@@ -184,21 +239,21 @@ async def ws_loop() -> None:
                 backoff = 1.0
 
                 loop = asyncio.get_event_loop()
-                q: "asyncio.Queue[str]" = asyncio.Queue()
+                q: "asyncio.Queue[tuple]" = asyncio.Queue()
 
                 # ハプティクス初期化
                 haptic = HapticFeedback(HAPTIC_EFFECT) if HAPTIC_ENABLE else None
 
                 rot = RotarySource(PIN_A, PIN_B, PIN_SW, REVERSE, haptic=haptic)
-                rot.on_left (lambda: loop.call_soon_threadsafe(q.put_nowait, "rotary_left"))
-                rot.on_right(lambda: loop.call_soon_threadsafe(q.put_nowait, "rotary_right"))
+                rot.on_left (enqueue(loop, q, "rotary_left"))
+                rot.on_right(enqueue(loop, q, "rotary_right"))
                 if PIN_SW is not None:
-                    rot.on_push(lambda: loop.call_soon_threadsafe(q.put_nowait, "rotary_push"))
+                    rot.on_push(enqueue(loop, q, "rotary_push"))
 
                 try:
                     while True:
-                        msg = await q.get()
-                        await ws.send(msg)
+                        kind, trace = await q.get()
+                        await ws.send(encode(kind, trace))
                         await asyncio.sleep(SEND_INTERVAL_SEC)
                 finally:
                     rot.close()
@@ -209,6 +264,7 @@ async def ws_loop() -> None:
             backoff = min(backoff * 1.7, 15.0)
 
 def main() -> None:
+    setup_pin_factory()
     try:
         asyncio.run(ws_loop())
     except KeyboardInterrupt:
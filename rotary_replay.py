@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ロータリーエンコーダのエッジ列を再生してベンチマークする（ハードウェア無しで rotary.py を試す）。
+
+gpiozero の MockFactory のピンに A/B のエッジを時刻どおりに流し込み、rotary.py の RotarySource・
+enqueue・encode をそのまま通して、動いているサーバの /ws/rotary に送る。同じフレームにもう1本
+つないだ受け手で中継されたイベントを受け取り、次を数える:
+
+- デコード : エッジ列から期待されるクリック数（左/右）と、RotarySource が出したイベントの差
+             （取りこぼし・余分・向きの間違い）
+- 配送     : 送った seq と受け取った seq の差（取りこぼし・重複・順番の入れ替わり）
+- 遅延     : エッジ → 送信、送信 → サーバの中継、中継 → 受信、エッジ → 受信（p50/p99）
+- スループット: 受け取ったイベント数 / 最初のエッジから最後の受信まで
+
+エッジ列は合成（--scenario）か記録したもの（--load）。記録は本物のエンコーダから --capture で取れる
+（Pi の上で。rotary.py と同じピン・同じ pin factory）。
+
+使い方:
+    python3 rotary_replay.py                                   # 合成シナリオを全部
+    python3 rotary_replay.py --scenario fast --repeat 5 --json out.json
+    python3 rotary_replay.py --dump fast.json --scenario fast  # 合成したエッジ列を保存するだけ
+    python3 rotary_replay.py --capture knob.json --seconds 20  # Pi で実機のエッジを記録
+    python3 rotary_replay.py --load knob.json --url ws://raspiframe.local:8000/ws/rotary
+
+遅延は送り手・サーバ・受け手の time.monotonic() を比べるので、サーバが同じマシンの時だけ
+（既定の ws://127.0.0.1:8000）区間ごとの値が出る。別のマシンならエッジ → 受信だけを見る。
+
+エッジ列のファイル:
+    {"name": "fast", "edges": [[秒, "a" | "b", 0 | 1], ...], "expected": {"left": 0, "right": 100}}
+    （expected が無ければ参照用のデコーダで数える。ピンはプルアップなので待機中は 1）
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import websockets
+    _HAS_WS = True
+except Exception:
+    _HAS_WS = False
+
+
+Edge = Tuple[float, str, int]          # (開始からの秒, "a" / "b", レベル)
+SCENARIOS = ("slow", "fast", "bounce", "mixed")
+SETTLE_SEC = 1.0                       # 再生し終わってから中継の残りを待つ時間
+
+
+def _pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    v = sorted(values)
+    return v[min(len(v) - 1, int(round(p / 100.0 * (len(v) - 1))))]
+
+
+def _ms(v: Optional[float]) -> str:
+    return "-" if v is None else f"{v * 1000:.2f}"
+
+
+# ==== エッジ列 ================================================================
+# 1クリック = 4回の遷移。右（gpiozero の steps が +1）は A が先に落ちる:
+#   (A,B) = 11 → 01 → 00 → 10 → 11      左はその逆順（B が先に落ちる）
+_CW = (("a", 0), ("b", 0), ("a", 1), ("b", 1))
+_CCW = (("b", 0), ("a", 0), ("b", 1), ("a", 1))
+
+
+class Timeline:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.t = 0.0
+        self.edges: List[Edge] = []
+        self.expected = {"left": 0, "right": 0}
+
+    def detent(self, right: bool, step: float, bounce: int = 0, glitch: float = 0.0002,
+               rnd: Optional[random.Random] = None) -> None:
+        """1クリック分。step は遷移の間隔（秒）。bounce > 0 なら各遷移のあとに接点のばたつきを足す"""
+        for pin, level in (_CW if right else _CCW):
+            self.edges.append((self.t, pin, level))
+            for _ in range(bounce if rnd is None else rnd.randint(0, bounce)):
+                # 同じピンが一瞬戻ってまた来る（もう片方は安定しているのでクリック数は変わらない）
+                self.t += glitch
+                self.edges.append((self.t, pin, 1 - level))
+                self.t += glitch
+                self.edges.append((self.t, pin, level))
+            self.t += step
+        self.expected["right" if right else "left"] += 1
+
+    def pause(self, sec: float) -> None:
+        self.t += sec
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"name": self.name, "edges": [[round(t, 6), p, v] for t, p, v in self.edges],
+                "expected": dict(self.expected)}
+
+
+def synth(name: str, seed: int = 1) -> Timeline:
+    tl = Timeline(name)
+    rnd = random.Random(seed)
+    if name == "slow":
+        # ゆっくり1クリックずつ（指でカチカチ送る）
+        for right in (True, False):
+            for _ in range(20):
+                tl.detent(right, 0.005)
+                tl.pause(0.2)
+            tl.pause(0.5)
+    elif name == "fast":
+        # 速い回転（1クリック 8ms ≒ 1秒で125クリック）
+        for right in (True, False):
+            for _ in range(100):
+                tl.detent(right, 0.002)
+            tl.pause(0.3)
+    elif name == "bounce":
+        # 接点のばたつき（各遷移のあとに 200µs 間隔で最大3回）
+        for right in (True, False, True):
+            for _ in range(30):
+                tl.detent(right, 0.004, bounce=3, rnd=rnd)
+                tl.pause(0.04)
+    elif name == "mixed":
+        # 速さ・向き・ばたつきを混ぜたバースト
+        for _ in range(30):
+            right = rnd.random() < 0.6
+            step = rnd.choice((0.001, 0.002, 0.005, 0.01))
+            bounce = rnd.choice((0, 0, 1, 3))
+            for _ in range(rnd.randint(1, 25)):
+                tl.detent(right, step, bounce=bounce, rnd=rnd)
+            tl.pause(rnd.uniform(0.02, 0.4))
+    else:
+        raise ValueError(f"unknown scenario: {name}")
+    return tl
+
+
+def reference_count(edges: List[Edge]) -> Dict[str, int]:
+    """記録したエッジ列の期待値（4遷移で 11 に戻ったら1クリック。ばたつきは行って戻るので相殺）"""
+    order = (3, 1, 0, 2)               # 右回りの状態 (A<<1)|B: 11 → 01 → 00 → 10
+    pos = {s: i for i, s in enumerate(order)}
+    a = b = 1
+    acc = 0
+    out = {"left": 0, "right": 0}
+    for _, pin, level in edges:
+        prev = pos[(a << 1) | b]
+        if pin == "a":
+            a = level
+        else:
+            b = level
+        d = (pos[(a << 1) | b] - prev) % 4
+        if d == 1:
+            acc += 1
+        elif d == 3:
+            acc -= 1
+        if a == 1 and b == 1:
+            if acc >= 4:
+                out["right"] += 1
+            elif acc <= -4:
+                out["left"] += 1
+            acc = 0
+    return out
+
+
+def load_timeline(path: str) -> Timeline:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    tl = Timeline(str(data.get("name") or os.path.basename(path)))
+    tl.edges = [(float(t), str(p).lower(), int(v)) for t, p, v in data["edges"]]
+    tl.edges.sort(key=lambda e: e[0])
+    tl.expected = data.get("expected") or reference_count(tl.edges)
+    return tl
+
+
+# ==== 実機のエッジを記録（Pi の上で） =========================================
+def capture(path: str, seconds: float) -> None:
+    import rotary
+    from gpiozero import Device
+    rotary.setup_pin_factory()
+    pins = {"a": Device.pin_factory.pin(rotary.PIN_A), "b": Device.pin_factory.pin(rotary.PIN_B)}
+    edges: List[Edge] = []
+    t0 = time.monotonic()
+    lock = threading.Lock()
+
+    def on_change(name):
+        def cb(ticks, state):
+            with lock:
+                edges.append((time.monotonic() - t0, name, int(state)))
+        return cb
+
+    for name, pin in pins.items():
+        pin.function = "input"
+        pin.pull = "up"
+        pin.edges = "both"
+        pin.when_changed = on_change(name)
+    print(f"[replay] capturing A={rotary.PIN_A} B={rotary.PIN_B} for {seconds:.0f}s ... turn the knob")
+    time.sleep(seconds)
+    for pin in pins.values():
+        pin.when_changed = None
+        pin.close()
+    tl = Timeline(os.path.splitext(os.path.basename(path))[0])
+    tl.edges = sorted(edges, key=lambda e: e[0])
+    tl.expected = reference_count(tl.edges)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tl.to_json(), f)
+    print(f"[replay] {len(tl.edges)} edges, expected {tl.expected} -> {path}")
+
+
+# ==== 再生 ====================================================================
+class Replayer:
+    """MockFactory のピンと RotarySource（gpiozero のデコーダ・rotary.py のコールバック）"""
+
+    def __init__(self) -> None:
+        os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+        import rotary
+        Device.pin_factory = MockFactory()
+        rotary.TRACE = True                          # 遅延はトレースから測る
+        self.rotary = rotary
+        self.source = rotary.RotarySource(rotary.PIN_A, rotary.PIN_B, reverse=False, haptic=None)
+        self.pins = {"a": Device.pin_factory.pin(rotary.PIN_A),
+                     "b": Device.pin_factory.pin(rotary.PIN_B)}
+
+    def play(self, edges: List[Edge], speed: float, done: threading.Event) -> None:
+        """エッジを時刻どおりにピンへ（別スレッド。短い間隔はビジーウェイト）"""
+        t0 = time.perf_counter()
+        for t, pin, level in edges:
+            target = t0 + t / speed
+            while True:
+                left = target - time.perf_counter()
+                if left <= 0:
+                    break
+                if left > 0.002:
+                    time.sleep(left - 0.001)
+            p = self.pins[pin]
+            if level:
+                p.drive_high()
+            else:
+                p.drive_low()
+        done.set()
+
+    def close(self) -> None:
+        self.source.close()
+
+
+class Run:
+    def __init__(self, name: str, expected: Dict[str, int]) -> None:
+        self.name = name
+        self.expected = expected
+        self.decoded = {"left": 0, "right": 0}
+        self.sent: Dict[int, str] = {}               # seq -> 種類
+        self.received: Dict[int, int] = {}           # seq -> 受け取った回数
+        self.out_of_order = 0
+        self.misdirected = 0
+        self.first_edge: Optional[float] = None
+        self.last_recv: Optional[float] = None
+        self.stage: Dict[str, List[float]] = {"edge_to_sent": [], "sent_to_relay": [],
+                                              "relay_to_recv": [], "edge_to_recv": []}
+
+
+async def replay_one(rep: Replayer, tl: Timeline, url: str, speed: float) -> Run:
+    run = Run(tl.name, tl.expected)
+    loop = asyncio.get_running_loop()
+    q: "asyncio.Queue[tuple]" = asyncio.Queue()
+    for kind in ("left", "right"):
+        cb = rep.rotary.enqueue(loop, q, f"rotary_{kind}")
+
+        def counted(trace, cb=cb, kind=kind):
+            run.decoded[kind] += 1
+            cb(trace)
+        getattr(rep.source, f"on_{kind}")(counted)
+
+    async with websockets.connect(url, max_queue=None) as rx, \
+            websockets.connect(url, max_queue=None) as tx:
+
+        async def receiver():
+            last_seq = 0
+            async for text in rx:
+                now = time.monotonic()
+                try:
+                    msg = json.loads(text)
+                    seq, tr = int(msg["seq"]), msg["trace"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                n = run.received.get(seq, 0)
+                run.received[seq] = n + 1
+                if n:
+                    continue                         # 重複は遅延に入れない
+                if seq < last_seq:
+                    run.out_of_order += 1
+                last_seq = max(last_seq, seq)
+                if run.sent.get(seq) not in (None, msg.get("type")):
+                    run.misdirected += 1
+                run.last_recv = now
+                for stage, a, b in (("edge_to_sent", tr.get("edge"), tr.get("sent")),
+                                    ("sent_to_relay", tr.get("sent"), tr.get("relayed")),
+                                    ("relay_to_recv", tr.get("relayed"), now),
+                                    ("edge_to_recv", tr.get("edge"), now)):
+                    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and b >= a:
+                        run.stage[stage].append(b - a)
+
+        async def sender():
+            while True:
+                kind, trace = await q.get()
+                run.sent[trace["seq"]] = kind
+                await tx.send(rep.rotary.encode(kind, trace))
+                await asyncio.sleep(rep.rotary.SEND_INTERVAL_SEC)   # ws_loop と同じ間隔
+
+        rx_task = asyncio.create_task(receiver())
+        tx_task = asyncio.create_task(sender())
+        done = threading.Event()
+        run.first_edge = time.monotonic()
+        player = threading.Thread(target=rep.play, args=(tl.edges, speed, done), daemon=True)
+        player.start()
+        await asyncio.to_thread(done.wait)
+        await asyncio.sleep(SETTLE_SEC)
+        tx_task.cancel()
+        rx_task.cancel()
+        await asyncio.gather(rx_task, tx_task, return_exceptions=True)
+
+    for kind in ("left", "right"):
+        getattr(rep.source, f"on_{kind}")(None)
+    return run
+
+
+def summarize(run: Run) -> Dict[str, Any]:
+    exp, dec = run.expected, run.decoded
+    sent = set(run.sent)
+    got = set(run.received)
+    span = (run.last_recv - run.first_edge) if run.last_recv and run.first_edge else None
+    out = {
+        "scenario": run.name,
+        "expected": dict(exp),
+        "decoded": dict(dec),
+        "decode_lost": sum(max(0, exp.get(k, 0) - dec[k]) for k in dec),
+        "decode_extra": sum(max(0, dec[k] - exp.get(k, 0)) for k in dec),
+        "sent": len(sent),
+        "received": len(got & sent),
+        "lost": len(sent - got),
+        "duplicated": sum(n - 1 for n in run.received.values() if n > 1),
+        "out_of_order": run.out_of_order,
+        "misdirected": run.misdirected,
+        "events_per_sec": round(len(got) / span, 1) if span else None,
+        "latency_ms": {},
+    }
+    for stage, vals in run.stage.items():
+        out["latency_ms"][stage] = {
+            "p50": round(_pct(vals, 50) * 1000, 3) if vals else None,
+            "p99": round(_pct(vals, 99) * 1000, 3) if vals else None,
+            "max": round(max(vals) * 1000, 3) if vals else None,
+        }
+    return out
+
+
+def print_summary(s: Dict[str, Any]) -> None:
+    e, d = s["expected"], s["decoded"]
+    print("")
+    print(f"[{s['scenario']}]")
+    print(f"  decode   expected L{e.get('left', 0)}/R{e.get('right', 0)}  got L{d['left']}/R{d['right']}"
+          f"  (lost {s['decode_lost']}, extra {s['decode_extra']})")
+    print(f"  relay    received {s['received']}/{s['sent']}  (lost {s['lost']}, dup {s['duplicated']},"
+          f" out-of-order {s['out_of_order']}, misdirected {s['misdirected']})"
+          f"  {s['events_per_sec'] or '-'} events/s")
+    for stage, v in s["latency_ms"].items():
+        f = lambda x: "-" if x is None else f"{x:.2f}"
+        print(f"  {stage:14s} p50 {f(v['p50']):>8s} ms   p99 {f(v['p99']):>8s} ms   max {f(v['max']):>8s} ms")
+
+
+async def run_all(args: argparse.Namespace, timelines: List[Timeline]) -> List[Dict[str, Any]]:
+    url = f"{args.url}{'&' if '?' in args.url else '?'}frame={args.frame}"
+    rep = Replayer()
+    out = []
+    try:
+        for tl in timelines:
+            for i in range(args.repeat):
+                print(f"[replay] {tl.name} ({len(tl.edges)} edges, {tl.edges[-1][0] / args.speed:.2f}s)"
+                      + (f" #{i + 1}" if args.repeat > 1 else ""))
+                s = summarize(await replay_one(rep, tl, url, args.speed))
+                print_summary(s)
+                out.append(s)
+    finally:
+        rep.close()
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Replay rotary encoder edges through gpiozero's mock pins")
+    ap.add_argument("--url", default="ws://127.0.0.1:8000/ws/rotary", help="rotary WebSocket URL")
+    ap.add_argument("--frame", default="rotary-replay",
+                    help="frame name to relay on (keeps real players out of the test)")
+    ap.add_argument("--scenario", action="append", choices=SCENARIOS,
+                    help="synthetic timeline (repeatable; default: all)")
+    ap.add_argument("--load", action="append", help="recorded timeline JSON (repeatable)")
+    ap.add_argument("--dump", help="write the (first) timeline to this file and exit")
+    ap.add_argument("--capture", help="record edges from the real encoder to this file and exit")
+    ap.add_argument("--seconds", type=float, default=15.0, help="capture length")
+    ap.add_argument("--seed", type=int, default=1, help="seed for the mixed/bounce scenarios")
+    ap.add_argument("--speed", type=float, default=1.0, help="playback speed multiplier")
+    ap.add_argument("--repeat", type=int, default=1, help="play each timeline this many times")
+    ap.add_argument("--json", help="also write the report to this file")
+    args = ap.parse_args()
+
+    if args.capture:
+        capture(args.capture, args.seconds)
+        return
+    timelines = [load_timeline(p) for p in (args.load or [])]
+    if args.scenario or not timelines:
+        timelines += [synth(n, args.seed) for n in (args.scenario or SCENARIOS)]
+    timelines = [tl for tl in timelines if tl.edges]
+    if not timelines:
+        sys.exit("[replay] no edges to play")
+    if args.dump:
+        with open(args.dump, "w", encoding="utf-8") as f:
+            json.dump(timelines[0].to_json(), f)
+        print(f"[replay] {timelines[0].name}: {len(timelines[0].edges)} edges -> {args.dump}")
+        return
+    if not _HAS_WS:
+        sys.exit("[replay] websockets is required")
+    args.speed = max(0.01, args.speed)
+    args.repeat = max(1, args.repeat)
+
+    out = asyncio.run(run_all(args, timelines))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "json"},
+                       "runs": out}, f, indent=2)
+        print(f"[replay] report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,21 +31,29 @@ else
     log "WiFi setup script not found, skipping"
 fi
 
-# 2. サービス起動待機
+# 2. サービス起動待機（/api/ready が応答するまで）
+READY_URL="http://localhost:8000/api/ready"
+
+# /api/ready の JSON からフィールドを1つ取り出す（true/false）
+ready_field() {
+    curl -fsS --max-time 2 "$READY_URL" 2>/dev/null | \
+        python3 -c "import json,sys; print(str(bool(json.load(sys.stdin).get('$1'))).lower())" 2>/dev/null
+}
+
 log "Step 2: Waiting for Raspiframe service..."
-max_wait=30
+max_wait=60
 count=0
 while [ $count -lt $max_wait ]; do
-    if systemctl is-active --quiet raspiframe; then
-        log "Raspiframe service is running"
+    if curl -fsS --max-time 2 "$READY_URL" > /dev/null 2>&1; then
+        log "Raspiframe service is responding"
         break
     fi
-    sleep 1
+    sleep 0.5
     count=$((count + 1))
 done
 
 if [ $count -ge $max_wait ]; then
-    log "WARNING: Raspiframe service did not start within ${max_wait}s"
+    log "WARNING: Raspiframe service did not respond within $((max_wait / 2))s"
 fi
 
 # 3. ネットワーク接続確認
@@ -65,17 +73,16 @@ if [ $count -ge $max_wait ]; then
     log "WARNING: No network connection detected"
 fi
 
-# 4. QRコード生成確認（サービスが生成するのを待つ）
+# 4. QRコード生成確認（サービスの起動パイプラインが qr 段階を終えるのを待つ）
 log "Step 4: Waiting for QR code generation..."
-QR_FILE="$SCRIPT_DIR/static/qr2.png"
-max_wait=10
+max_wait=20
 count=0
 while [ $count -lt $max_wait ]; do
-    if [ -f "$QR_FILE" ]; then
-        log "QR code found: $QR_FILE"
+    if [ "$(ready_field qr)" = "true" ]; then
+        log "QR code ready"
         break
     fi
-    sleep 1
+    sleep 0.5
     count=$((count + 1))
 done
 
@@ -191,6 +198,20 @@ else
     log "WARNING: chromium-browser not found"
 fi
 
+# 6. 起動→初回表示の時間を記録（プレイヤーが /api/ready/first_photo を報告する）
+max_wait=120
+count=0
+while [ $count -lt $max_wait ]; do
+    first_photo=$(curl -fsS --max-time 2 "$READY_URL" 2>/dev/null | \
+        python3 -c "import json,sys; fp=json.load(sys.stdin).get('first_photo'); print(fp['boot_to_first_photo_s'] if fp else '')" 2>/dev/null || true)
+    if [ -n "$first_photo" ]; then
+        log "Boot-to-first-photo: ${first_photo}s"
+        break
+    fi
+    sleep 1
+    count=$((count + 1))
+done
+
 log "========================================="
 log "Startup pipeline complete"
 log "========================================="
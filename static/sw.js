@@ -0,0 +1,181 @@
+// ~/raspiframe/static/sw.js
+// プレイヤー用 Service Worker
+// - プレイヤーの画像（/media/{id}）を Cache Storage に置き、2周目以降はローカルから返す
+//   （キオスクの Chromium は --disk-cache-dir=/dev/null なので HTTP キャッシュが効かない）
+// - 容量上限つきの LRU。最終利用時刻とサイズはメモリに持ち、ときどきキャッシュ内に保存
+//   （容量上限とヒット数も一緒に。Chromium はアイドルの SW を止めるので、メモリだけだと初期値に戻る）
+// - /api/playlist・/api/config はネットワーク優先、落ちていれば最後の応答を返す
+//   （バックエンド再起動中・NAS が固まっている間もスライドショーを続けられる）
+// - ヒット率は player.html が postMessage で問い合わせ、サーバへ送る
+
+const MEDIA_CACHE = 'spf-media-v1';
+const API_CACHE   = 'spf-api-v1';
+const META_URL    = '/__sw_meta__';
+const API_TIMEOUT_MS = 5000;
+const SAVE_META_MS   = 5000;
+
+let quotaBytes = 256 * 1024 * 1024;   // player.html から設定（sw_cache_mb）
+let metaReady = null;                  // Promise<Map<url, {b: bytes, t: lastUsed}>>（読み込みで quota / stats も戻す）
+let totalBytes = 0;
+let saveTimer = null;
+const stats = {hits: 0, misses: 0, errors: 0, evictions: 0, stale_api: 0};
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (e) => {
+  e.waitUntil((async () => {
+    // 古い版のキャッシュを消す
+    for (const k of await caches.keys()){
+      if (k.startsWith('spf-') && k !== MEDIA_CACHE && k !== API_CACHE) await caches.delete(k);
+    }
+    await self.clients.claim();
+  })());
+});
+
+/* ---- LRU メタデータ ---- */
+function loadMeta(){
+  if (metaReady) return metaReady;
+  metaReady = (async () => {
+    const meta = new Map();
+    const cache = await caches.open(MEDIA_CACHE);
+    let saved = {};
+    try{
+      const r = await cache.match(META_URL);
+      if (r){
+        const doc = await r.json();
+        // 旧形式は url -> ent だけ
+        saved = doc.entries || doc;
+        if (doc.quota > 0) quotaBytes = doc.quota;
+        // 読み込み前に数えた分（API のフォールバック）に足す
+        for (const k of Object.keys(stats)) stats[k] += Number((doc.stats || {})[k]) || 0;
+      }
+    }catch{}
+    totalBytes = 0;
+    for (const req of await cache.keys()){
+      if (new URL(req.url).pathname === META_URL) continue;
+      let ent = saved[req.url];
+      if (!ent){
+        // メタデータ保存前に SW が止まった分はサイズを測り直す
+        const r = await cache.match(req);
+        ent = {b: r ? (await r.blob()).size : 0, t: 0};
+      }
+      meta.set(req.url, ent);
+      totalBytes += ent.b;
+    }
+    return meta;
+  })();
+  return metaReady;
+}
+
+function scheduleSave(){
+  if (saveTimer) return;
+  saveTimer = setTimeout(async () => {
+    saveTimer = null;
+    const meta = await loadMeta();
+    const cache = await caches.open(MEDIA_CACHE);
+    const doc = {entries: Object.fromEntries(meta), quota: quotaBytes, stats};
+    await cache.put(META_URL, new Response(JSON.stringify(doc),
+                                           {headers: {'Content-Type': 'application/json'}}));
+  }, SAVE_META_MS);
+}
+
+async function evict(){
+  const meta = await loadMeta();
+  if (totalBytes <= quotaBytes) return;
+  const cache = await caches.open(MEDIA_CACHE);
+  // 上限の 90% まで古い順に捨てる（毎回ぎりぎりで追い出し続けないように）
+  const target = quotaBytes * 0.9;
+  const oldest = [...meta.entries()].sort((a, b) => a[1].t - b[1].t);
+  for (const [url, ent] of oldest){
+    if (totalBytes <= target) break;
+    await cache.delete(url);
+    meta.delete(url);
+    totalBytes -= ent.b;
+    stats.evictions++;
+  }
+  scheduleSave();
+}
+
+/* ---- 画像: キャッシュ優先 ---- */
+async function media(req){
+  const meta = await loadMeta();
+  const cache = await caches.open(MEDIA_CACHE);
+  const hit = await cache.match(req);
+  if (hit){
+    stats.hits++;
+    const ent = meta.get(req.url);
+    if (ent) ent.t = Date.now();
+    scheduleSave();
+    return hit;
+  }
+  stats.misses++;
+  scheduleSave();
+  let res;
+  try{
+    res = await fetch(req);
+  }catch(err){
+    stats.errors++;
+    throw err;
+  }
+  if (res.status === 200){
+    const copy = res.clone();
+    (async () => {
+      const blob = await copy.blob();
+      // 1枚で上限の 1/8 を超えるもの（派生画像が作れなかったオリジナルなど）は置かない
+      if (blob.size > quotaBytes / 8) return;
+      await cache.put(req, new Response(blob, {headers: copy.headers}));
+      const old = meta.get(req.url);
+      if (old) totalBytes -= old.b;
+      meta.set(req.url, {b: blob.size, t: Date.now()});
+      totalBytes += blob.size;
+      await evict();
+      scheduleSave();
+    })().catch(() => {});
+  }
+  return res;
+}
+
+/* ---- API: ネットワーク優先、落ちていれば最後の応答 ---- */
+async function networkFirst(req){
+  const cache = await caches.open(API_CACHE);
+  try{
+    const res = await fetch(req, {signal: AbortSignal.timeout(API_TIMEOUT_MS)});
+    if (res.ok) await cache.put(req, res.clone());
+    return res;
+  }catch(err){
+    const cached = await cache.match(req);
+    if (cached){ stats.stale_api++; scheduleSave(); return cached; }
+    throw err;
+  }
+}
+
+self.addEventListener('fetch', (e) => {
+  const req = e.request;
+  if (req.method !== 'GET') return;
+  const url = new URL(req.url);
+  if (url.origin !== self.location.origin) return;
+  if (url.pathname.startsWith('/media/')){
+    e.respondWith(media(req));
+  }else if (url.pathname === '/api/playlist' || url.pathname === '/api/config'){
+    e.respondWith(networkFirst(req));
+  }
+});
+
+self.addEventListener('message', (e) => {
+  const d = e.data || {};
+  if (d.type === 'quota' && d.bytes > 0){
+    e.waitUntil((async () => {
+      await loadMeta();            // 保存済みの値で上書きされないように、読み込んでから
+      if (quotaBytes === d.bytes) return;
+      quotaBytes = d.bytes;
+      scheduleSave();
+      await evict();
+    })());
+  }else if (d.type === 'stats'){
+    e.waitUntil((async () => {
+      const meta = await loadMeta();
+      const port = e.ports && e.ports[0];
+      if (port) port.postMessage({...stats, bytes: totalBytes, entries: meta.size, quota: quotaBytes});
+    })());
+  }
+});